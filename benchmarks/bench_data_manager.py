@@ -0,0 +1,295 @@
+'''
+Бенчмарк DataManager на синтетических историях заказов.
+
+Генерирует orders.json нужного размера (пользователи распределены по закону Ципфа:
+немного постоянных покупателей с сотнями заказов и длинный хвост разовых),
+замеряет время основных операций DataManager и выгрузки отчёта, пиковую память
+(tracemalloc) и пишет результаты в JSON, который можно сравнить с прошлым прогоном.
+
+    python benchmarks/bench_data_manager.py run --sizes 1000,10000 --output results/new.json
+    python benchmarks/bench_data_manager.py compare results/old.json results/new.json
+'''
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Awaitable, Callable, Dict, List, Optional
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(REPO_DIR, "src")
+sys.path.insert(0, SRC_DIR)
+
+from data_manager import DataManager  # noqa: E402
+from excel_generator import json_to_xlsx_async  # noqa: E402
+from models import Order  # noqa: E402
+from order_storage import create_order_storage  # noqa: E402
+
+
+PRODUCTS_FILE = os.path.join(REPO_DIR, "data", "products.json")
+COURSES_FILE = os.path.join(REPO_DIR, "data", "courses.json")
+
+DEFAULT_SIZES = "1000,10000,100000,1000000"
+# Средние размеры истории на пользователя и доля оплаченных заказов
+ORDERS_PER_USER = 8
+PAID_SHARE = 0.7
+HISTORY_DAYS = 365
+ZIPF_EXPONENT = 1.1
+# Сколько вызовов точечных операций усредняем
+POINT_CALLS = 200
+# Порог замедления, после которого compare считает результат регрессией
+REGRESSION_THRESHOLD = 1.25
+
+
+def _catalog_items() -> List[dict]:
+    items = []
+    with open(PRODUCTS_FILE, 'r', encoding='utf-8') as f:
+        for category in json.load(f):
+            for item in category.get("items", []):
+                items.append({"item": item["item"], "type": "product", "price": item["price"]})
+    with open(COURSES_FILE, 'r', encoding='utf-8') as f:
+        for course in json.load(f):
+            items.append({"item": course["item"], "type": "course", "price": course["price"]})
+    return items
+
+
+def generate_orders(size: int, seed: int = 0) -> Dict[str, List[dict]]:
+    ''' Синтетическая история из size заказов: user_id -> заказы в формате orders.json '''
+    rng = random.Random(seed)
+    items = _catalog_items()
+    users_count = max(1, size // ORDERS_PER_USER)
+    user_ids = [str(1_000_000_000 + rng.randrange(9_000_000_000)) for _ in range(users_count)]
+    weights = [1 / (rank ** ZIPF_EXPONENT) for rank in range(1, users_count + 1)]
+
+    now = int(time.time())
+    data: Dict[str, List[dict]] = {}
+    for user_id in rng.choices(user_ids, weights, k=size):
+        orders = data.setdefault(user_id, [])
+        item = rng.choice(items)
+        timestamp = now - rng.randrange(HISTORY_DAYS * 24 * 60 * 60)
+        orders.append({
+            "order_id": len(orders) + 1,
+            "item": item["item"],
+            "type": item["type"],
+            "price": item["price"] * rng.randint(1, 3),
+            "paid": rng.random() < PAID_SHARE,
+            "date": datetime.date.fromtimestamp(timestamp).isoformat(),
+            "timestamp": timestamp,
+        })
+    return data
+
+
+async def prepare_storage(work_dir: str, backend: str, data: Dict[str, List[dict]]) -> str:
+    ''' Раскладываем историю в файлы выбранного хранилища, возвращаем путь к orders.json '''
+    orders_file_path = os.path.join(work_dir, "orders.json")
+    with open(orders_file_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+
+    if backend in ("sqlite", "sharded"):
+        storage = create_order_storage(backend, orders_file_path)
+        await storage.import_orders({
+            user_id: [Order(**order) for order in orders] for user_id, orders in data.items()
+        })
+        await storage.close()
+    return orders_file_path
+
+
+async def _timed(func: Callable[[], Awaitable], calls: int = 1) -> float:
+    ''' Среднее время одного вызова, секунды '''
+    started = time.perf_counter()
+    for _ in range(calls):
+        await func()
+    return (time.perf_counter() - started) / calls
+
+
+async def _peak_memory(func: Callable[[], Awaitable]) -> int:
+    ''' Пиковая память (байты), выделенная за время вызова '''
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        await func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _new_data_manager(orders_file_path: str, backend: str) -> DataManager:
+    return DataManager(
+        orders_file_path, PRODUCTS_FILE, COURSES_FILE,
+        orders_storage=create_order_storage(backend, orders_file_path),
+    )
+
+
+async def bench_size(size: int, backend: str, measure_memory: bool, seed: int) -> List[dict]:
+    data = generate_orders(size, seed)
+    user_ids = list(data)
+    rng = random.Random(seed + 1)
+    items = _catalog_items()
+    results = []
+
+    def record(operation: str, seconds: float, peak_bytes: Optional[int], calls: int = 1) -> None:
+        results.append({
+            "size": size, "operation": operation, "calls": calls,
+            "seconds": seconds, "peak_bytes": peak_bytes,
+        })
+        memory = f", пик {peak_bytes / 2**20:.1f} МБ" if peak_bytes is not None else ""
+        print(f"  {operation:<24} {seconds * 1000:10.3f} мс{memory}", file=sys.stderr)
+
+    work_dir = tempfile.mkdtemp(prefix=f"bench_{size}_")
+    try:
+        orders_file_path = await prepare_storage(work_dir, backend, data)
+        del data
+
+        # Холодная загрузка: каждый раз новое хранилище
+        async def load():
+            data_manager = _new_data_manager(orders_file_path, backend)
+            await data_manager.load_orders_base()
+            await data_manager.orders_storage.close()
+
+        seconds = await _timed(load)
+        record("load_orders_base", seconds, await _peak_memory(load) if measure_memory else None)
+
+        data_manager = _new_data_manager(orders_file_path, backend)
+        await data_manager.load_orders_base()
+
+        async def get_orders():
+            await data_manager.get_orders(int(rng.choice(user_ids)))
+
+        async def check_not_paid():
+            with contextlib.redirect_stdout(io.StringIO()):
+                await data_manager.check_not_paid(int(rng.choice(user_ids)))
+
+        async def get_all_not_paid():
+            await data_manager.get_all_not_paid_orders()
+
+        async def add_order():
+            item = rng.choice(items)
+            await data_manager.add_order(int(rng.choice(user_ids)), {
+                "item": item["item"], "type": item["type"], "price": item["price"],
+                "paid": False, "date": datetime.date.today().isoformat(),
+            })
+
+        for operation, func, calls in (
+            ("get_orders", get_orders, POINT_CALLS),
+            ("check_not_paid", check_not_paid, POINT_CALLS),
+            ("get_all_not_paid_orders", get_all_not_paid, 1),
+            ("add_order", add_order, POINT_CALLS),
+        ):
+            seconds = await _timed(func, calls)
+            record(operation, seconds, await _peak_memory(func) if measure_memory else None, calls)
+
+        seconds = await _timed(data_manager.close)
+        record("close", seconds, None)
+
+        report_path = os.path.join(work_dir, "orders.xlsx")
+
+        async def export():
+            await json_to_xlsx_async(orders_file_path, report_path, backend)
+
+        seconds = await _timed(export)
+        record("json_to_xlsx", seconds, await _peak_memory(export) if measure_memory else None)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(sizes: List[int], backend: str, measure_memory: bool, seed: int) -> dict:
+    results = []
+    for size in sizes:
+        print(f"{size} заказов ({backend}):", file=sys.stderr)
+        results.extend(await bench_size(size, backend, measure_memory, seed))
+    return {
+        "meta": {
+            "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": backend,
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def compare(old: dict, new: dict, threshold: float) -> bool:
+    ''' Печатаем сравнение двух прогонов; False, если есть замедление больше threshold '''
+    old_results = {(r["size"], r["operation"]): r for r in old["results"]}
+    ok = True
+    if old["meta"].get("backend") != new["meta"].get("backend"):
+        print(f"Внимание: прогоны на разных хранилищах ({old['meta'].get('backend')} и {new['meta'].get('backend')})")
+    print(f"{'размер':>8} {'операция':<24} {'было, мс':>12} {'стало, мс':>12} {'x':>7}")
+    for result in new["results"]:
+        key = (result["size"], result["operation"])
+        previous = old_results.get(key)
+        if previous is None or not previous["seconds"]:
+            continue
+        ratio = result["seconds"] / previous["seconds"]
+        mark = ""
+        if ratio > threshold:
+            mark = "  <- регрессия"
+            ok = False
+        print(f"{key[0]:>8} {key[1]:<24} {previous['seconds'] * 1000:12.3f} "
+              f"{result['seconds'] * 1000:12.3f} {ratio:7.2f}{mark}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк DataManager на синтетических заказах")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="прогнать бенчмарк")
+    run_parser.add_argument("--sizes", default=DEFAULT_SIZES, help="размеры истории через запятую")
+    run_parser.add_argument("--backend", default="journal", choices=["json", "journal", "sqlite", "sharded"])
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--no-memory", action="store_true", help="не замерять пиковую память")
+    run_parser.add_argument("--output", help="куда записать JSON с результатами (по умолчанию stdout)")
+
+    compare_parser = commands.add_parser("compare", help="сравнить два прогона")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                                help="во сколько раз операция может замедлиться без ошибки")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        with open(args.old, 'r', encoding='utf-8') as f:
+            old = json.load(f)
+        with open(args.new, 'r', encoding='utf-8') as f:
+            new = json.load(f)
+        sys.exit(0 if compare(old, new, args.threshold) else 1)
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    report = asyncio.run(run(sizes, args.backend, not args.no_memory, args.seed))
+    content = json.dumps(report, ensure_ascii=False, indent=4)
+    if args.output:
+        directory = os.path.dirname(args.output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(content)
+    else:
+        print(content)
+
+
+if __name__ == "__main__":
+    main()
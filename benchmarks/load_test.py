@@ -0,0 +1,267 @@
+'''
+Нагрузочный тест бота без сети: настоящий Dispatcher с роутерами из bot.py, Bot с
+поддельной сессией, которая отвечает на вызовы Bot API правдоподобными объектами
+(с настраиваемой задержкой) и считает их. Каждый виртуальный покупатель проходит
+/order -> категория -> товар -> +1, +1, -1 -> подтвердить -> /cart -> оформить заказ,
+обновления подаются через feed_update.
+
+    python benchmarks/load_test.py --users 2000 --concurrency 200
+'''
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Any, AsyncGenerator, Dict, List, Optional
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(REPO_DIR, "src")
+sys.path.insert(0, SRC_DIR)
+
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.methods import TelegramMethod  # noqa: E402
+from aiogram.types import Chat, Message, PhotoSize, Update  # noqa: E402
+
+from bot import build_dispatcher  # noqa: E402
+from catalog import ProductCatalog  # noqa: E402
+from config import MetricsSettings  # noqa: E402
+from data_manager import DataManager  # noqa: E402
+from fsm_storage import SqliteFsmStorage  # noqa: E402
+from handlers.utils import QUANTITY_EDIT_DELAY  # noqa: E402
+from image_registry import ImageRegistry  # noqa: E402
+from metrics import metrics as metrics_registry  # noqa: E402
+from order_storage import create_order_storage  # noqa: E402
+from outbound import OutboundDispatcher  # noqa: E402
+
+
+PRODUCTS_FILE = os.path.join(REPO_DIR, "data", "products.json")
+COURSES_FILE = os.path.join(REPO_DIR, "data", "courses.json")
+BOT_TOKEN = "42:LOAD-TEST"
+# Сколько ждём ответа "Telegram" на каждый вызов, секунды
+DEFAULT_API_LATENCY = 0.02
+
+
+class FakeSession(BaseSession):
+    ''' Сессия Bot API без сети: считает вызовы и возвращает подходящие объекты '''
+
+    def __init__(self, latency: float = DEFAULT_API_LATENCY):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1_000_000)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None) -> Any:
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method.__returning__ is bool:
+            return True
+        chat_id = getattr(method, "chat_id", None) or 0
+        photo = None
+        if type(method).__name__ == "SendPhoto":
+            message_id = next(self._message_ids)
+            photo = [PhotoSize(file_id=f"photo-{message_id}", file_unique_id=f"u-{message_id}", width=800, height=600)]
+        return Message(
+            message_id=getattr(method, "message_id", None) or next(self._message_ids),
+            date=datetime.datetime.now(),
+            chat=Chat(id=chat_id, type="private"),
+            text=getattr(method, "text", None),
+            photo=photo,
+        )
+
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+
+class Shopper:
+    ''' Виртуальный покупатель: собирает обновления от своего имени '''
+
+    _update_ids = itertools.count(1)
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self._user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        self._chat = {"id": user_id, "type": "private"}
+        self._message_ids = itertools.count(1)
+
+    def message(self, text: str) -> Update:
+        return Update.model_validate({
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids), "date": int(time.time()),
+                "chat": self._chat, "from": self._user, "text": text,
+            },
+        })
+
+    def callback(self, data: str, message_id: int) -> Update:
+        return Update.model_validate({
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": f"{self.user_id}-{next(self._message_ids)}", "from": self._user,
+                "chat_instance": str(self.user_id), "data": data,
+                "message": {"message_id": message_id, "date": int(time.time()), "chat": self._chat},
+            },
+        })
+
+
+def _scenario(shopper: Shopper, category: str, item: str) -> List[Update]:
+    # Номер сообщения с карточкой для бота не важен - Bot API поддельный
+    card_message_id = 10_000
+    return [
+        shopper.message("/order"),
+        shopper.callback(category, 1),
+        shopper.callback(item, 2),
+        shopper.callback("increase", card_message_id),
+        shopper.callback("increase", card_message_id),
+        shopper.callback("decrease", card_message_id),
+        shopper.callback("confirm", card_message_id),
+        shopper.message("/cart"),
+        shopper.callback("confirm_order", 3),
+    ]
+
+
+def _percentile(quantiles: List[float], p: int) -> float:
+    return quantiles[p - 1] if quantiles else 0.0
+
+
+async def run(users: int, concurrency: int, latency: float, backend: str, rate_limit: bool, seed: int,
+              metrics_port: Optional[int] = None) -> dict:
+    rng = random.Random(seed)
+    with open(PRODUCTS_FILE, 'r', encoding='utf-8') as f:
+        catalog = ProductCatalog.from_raw(json.load(f))
+    choices = [(category.category, item.callback_data) for category in catalog.categories for item in category.items]
+
+    work_dir = tempfile.mkdtemp(prefix="load_test_")
+    session = FakeSession(latency)
+    bot = Bot(token=BOT_TOKEN, session=session)
+    orders_file_path = os.path.join(work_dir, "orders.json")
+    data_manager = DataManager(
+        orders_file_path, PRODUCTS_FILE, COURSES_FILE,
+        orders_storage=create_order_storage(backend, orders_file_path),
+    )
+    outbound = None
+    if not rate_limit:
+        unlimited = float("inf")
+        outbound = OutboundDispatcher(bot, global_rate=unlimited, global_burst=unlimited,
+                                      per_chat_rate=unlimited, per_chat_burst=unlimited)
+    dp = build_dispatcher(
+        bot, data_manager,
+        image_registry=ImageRegistry(os.path.join(work_dir, "images.json")),
+        fsm_storage=SqliteFsmStorage(os.path.join(work_dir, "fsm.db")),
+        outbound=outbound,
+        reminders_state_file_path=os.path.join(work_dir, "reminders.json"),
+        # Метрики включаются только явно (--metrics-port), переменные окружения не влияют на замер
+        metrics_settings=MetricsSettings(enabled=metrics_port is not None, host="127.0.0.1", port=metrics_port or 0),
+    )
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def shop(user_id: int) -> None:
+        shopper = Shopper(user_id)
+        category, item = rng.choice(choices)
+        async with semaphore:
+            for update in _scenario(shopper, category, item):
+                kind = update.message.text if update.message else update.callback_query.data
+                if update.callback_query and update.callback_query.data in (category, item):
+                    kind = "category" if update.callback_query.data == category else "item"
+                started = time.perf_counter()
+                await dp.feed_update(bot, update)
+                latencies[kind].append(time.perf_counter() - started)
+
+    try:
+        await dp.emit_startup(bot=bot)
+        started = time.perf_counter()
+        await asyncio.gather(*(shop(1_000_000 + index) for index in range(users)))
+        elapsed = time.perf_counter() - started
+        # Даём отработать отложенным перерисовкам карточек
+        await asyncio.sleep(QUANTITY_EDIT_DELAY + 0.1)
+        orders_count = len(await data_manager.get_all_not_paid_orders())
+        await dp.emit_shutdown(bot=bot)
+        await dp.storage.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    all_latencies = [value for values in latencies.values() for value in values]
+
+    def summary(values: List[float]) -> dict:
+        quantiles = statistics.quantiles(values, n=100) if len(values) > 1 else values * 99
+        return {
+            "count": len(values),
+            "p50_ms": _percentile(quantiles, 50) * 1000,
+            "p95_ms": _percentile(quantiles, 95) * 1000,
+            "p99_ms": _percentile(quantiles, 99) * 1000,
+        }
+
+    return {
+        "users": users,
+        "concurrency": concurrency,
+        "api_latency_ms": latency * 1000,
+        "backend": backend,
+        "rate_limit": rate_limit,
+        "updates": len(all_latencies),
+        "seconds": elapsed,
+        "updates_per_second": len(all_latencies) / elapsed if elapsed else 0.0,
+        "latency": summary(all_latencies),
+        "latency_by_step": {kind: summary(values) for kind, values in latencies.items()},
+        "api_calls": dict(session.calls.most_common()),
+        "orders_created": orders_count,
+    }
+
+
+def print_report(report: dict) -> None:
+    latency = report["latency"]
+    print(f"Покупателей: {report['users']} (одновременно до {report['concurrency']}), "
+          f"задержка API {report['api_latency_ms']:.0f} мс, хранилище {report['backend']}")
+    print(f"Обновлений: {report['updates']} за {report['seconds']:.2f} с - {report['updates_per_second']:.0f} в секунду")
+    print(f"Задержка обработки: p50 {latency['p50_ms']:.1f} мс, p95 {latency['p95_ms']:.1f} мс, p99 {latency['p99_ms']:.1f} мс")
+    for kind, step in report["latency_by_step"].items():
+        print(f"  {kind:<14} p50 {step['p50_ms']:8.1f}  p95 {step['p95_ms']:8.1f}  p99 {step['p99_ms']:8.1f}")
+    print("Вызовы Bot API:")
+    for method, count in report["api_calls"].items():
+        print(f"  {method:<24} {count}")
+    print(f"Оформлено заказов: {report['orders_created']} (ожидалось {report['users']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на поддельном Bot API")
+    parser.add_argument("--users", type=int, default=1000, help="сколько покупателей")
+    parser.add_argument("--concurrency", type=int, default=100, help="сколько покупателей действуют одновременно")
+    parser.add_argument("--api-latency", type=float, default=DEFAULT_API_LATENCY, help="задержка ответа Bot API, с")
+    parser.add_argument("--backend", default="journal", choices=["json", "journal", "sqlite", "sharded"])
+    parser.add_argument("--no-rate-limit", action="store_true",
+                        help="снять ограничения скорости исходящих сообщений (по умолчанию - как для Telegram)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="куда дополнительно записать отчёт в JSON")
+    parser.add_argument("--metrics-port", type=int,
+                        help="включить метрики с /metrics на этом порту (чтобы оценить их накладные расходы)")
+    parser.add_argument("--metrics-output", help="куда записать метрики в формате Prometheus после прогона")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args.users, args.concurrency, args.api_latency, args.backend,
+                             not args.no_rate_limit, args.seed, args.metrics_port))
+    print_report(report)
+    if args.metrics_output:
+        with open(args.metrics_output, 'w', encoding='utf-8') as f:
+            f.write(metrics_registry.render())
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == "__main__":
+    main()
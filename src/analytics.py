@@ -0,0 +1,162 @@
+import argparse
+import asyncio
+import json
+import os
+from typing import Dict, Optional
+
+from catalog import ProductCatalog
+from config import read_orders_backend
+from order_archive import OrderArchive, archive_dir_for
+from order_storage import OrderStorage, create_order_storage
+
+
+ORDERS_FILE = "../data/orders.json"
+PRODUCTS_FILE = "../data/products.json"
+ANALYTICS_FILE = "../reports/analytics.xlsx"
+
+COURSES_CATEGORY = "Курсы"
+UNKNOWN_CATEGORY = "Другое"
+# Поля заказа, которые нужны для агрегатов
+FRAME_FIELDS = ("item", "type", "price", "paid", "date")
+
+SUMMARY_COLUMNS = {
+    "orders": "Заказов",
+    "revenue": "Выручка",
+    "paid_revenue": "Оплачено",
+    "unpaid_revenue": "Не оплачено",
+}
+
+
+def load_item_categories(products_file_path: str = PRODUCTS_FILE) -> Dict[str, str]:
+    ''' Название товара -> название категории из products.json (нет файла - пустой словарь) '''
+    if not os.path.exists(products_file_path):
+        return {}
+
+    with open(products_file_path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    if not content.strip():
+        return {}
+
+    catalog = ProductCatalog.from_raw(json.loads(content))
+    return {item.item: category.name for category in catalog.categories for item in category.items}
+
+
+async def load_orders_frame(storage: OrderStorage, item_categories: Dict[str, str],
+                            archive: Optional[OrderArchive] = None):
+    '''
+    Заказы хранилища (и архива, если он передан) читаются сразу колонками, без сортировки
+    и без сборки Order, и из них строится DataFrame с нужными типами: товар, вид и категория -
+    categorical, дата - datetime. Дальше все агрегаты считаются groupby по колонкам, без циклов по заказам.
+    '''
+    import pandas as pd
+
+    columns = await storage.load_columns(FRAME_FIELDS)
+    if archive is not None:
+        archived = await archive.load_columns(FRAME_FIELDS)
+        for name, values in archived.items():
+            columns[name].extend(values)
+
+    frame = pd.DataFrame({
+        "user_id": pd.Series(columns["user_id"], dtype="category"),
+        "item": pd.Series(columns["item"], dtype="category"),
+        "type": pd.Series(columns["type"], dtype="category"),
+        "price": pd.Series(columns["price"], dtype="int64"),
+        "paid": pd.Series(columns["paid"], dtype="bool"),
+        "date": pd.to_datetime(pd.Series(columns["date"], dtype="object"), format="%Y-%m-%d"),
+    })
+
+    # map по categorical применяется к уникальным товарам, а не к каждой строке
+    category = frame["item"].map(item_categories).astype("object")
+    category = category.where(frame["type"] != "course", COURSES_CATEGORY).fillna(UNKNOWN_CATEGORY)
+    frame["category"] = category.astype("category")
+    frame["paid_price"] = frame["price"].where(frame["paid"], 0)
+    return frame
+
+
+def _summarize(frame, by):
+    ''' Число заказов, выручка и оплаченная часть по группам '''
+    grouped = frame.groupby(by, observed=True, sort=True)
+    summary = grouped.agg(
+        orders=("price", "size"),
+        revenue=("price", "sum"),
+        paid_revenue=("paid_price", "sum"),
+    )
+    summary["unpaid_revenue"] = summary["revenue"] - summary["paid_revenue"]
+    return summary.rename(columns=SUMMARY_COLUMNS)
+
+
+def build_aggregates(frame) -> Dict[str, object]:
+    ''' Название листа -> таблица с агрегатом '''
+    import pandas as pd
+
+    by_item = _summarize(frame, ["item", "type"]).sort_values(SUMMARY_COLUMNS["revenue"], ascending=False)
+    by_category = _summarize(frame, "category").sort_values(SUMMARY_COLUMNS["revenue"], ascending=False)
+    by_day = _summarize(frame, "date")
+    by_day.index = by_day.index.date
+    by_week = _summarize(frame, pd.Grouper(key="date", freq="W-MON", label="left", closed="left"))
+    by_week.index = by_week.index.date
+    by_paid = frame.groupby("paid", sort=True).agg(orders=("price", "size"), revenue=("price", "sum"))
+    by_paid.index = by_paid.index.map({True: "Оплачено", False: "Не оплачено"})
+    by_paid = by_paid.rename(columns=SUMMARY_COLUMNS)
+
+    by_item.index.names = ["Товар", "Вид товара"]
+    by_category.index.name = "Категория"
+    by_day.index.name = "Дата"
+    by_week.index.name = "Неделя (с понедельника)"
+    by_paid.index.name = "Статус"
+
+    return {
+        "По товарам": by_item,
+        "По категориям": by_category,
+        "По дням": by_day,
+        "По неделям": by_week,
+        "Оплата": by_paid,
+    }
+
+
+def write_aggregates(aggregates: Dict[str, object], destination: str) -> None:
+    import pandas as pd
+
+    directory = os.path.dirname(destination)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with pd.ExcelWriter(destination, engine="openpyxl") as writer:
+        for sheet_name, table in aggregates.items():
+            table.to_excel(writer, sheet_name=sheet_name)
+
+
+async def build_report_async(source: str = ORDERS_FILE, destination: str = ANALYTICS_FILE,
+                             products: str = PRODUCTS_FILE, backend: Optional[str] = None, with_archive: bool = True) -> int:
+    storage = create_order_storage(backend or read_orders_backend(), source)
+    archive = OrderArchive(archive_dir_for(source)) if with_archive else None
+    try:
+        frame = await load_orders_frame(storage, load_item_categories(products), archive)
+    finally:
+        await storage.close()
+
+    write_aggregates(build_aggregates(frame), destination)
+    return len(frame)
+
+
+def build_report(source: str = ORDERS_FILE, destination: str = ANALYTICS_FILE,
+                 products: str = PRODUCTS_FILE, backend: Optional[str] = None, with_archive: bool = True) -> int:
+    ''' Аналитика продаж по заказам из source (и архива рядом с ним) в destination, по листу на каждый срез '''
+    return asyncio.run(build_report_async(source, destination, products, backend, with_archive))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Аналитика продаж в Excel")
+    parser.add_argument("--source", default=ORDERS_FILE, help="путь к orders.json (журнал и база ищутся рядом)")
+    parser.add_argument("--products", default=PRODUCTS_FILE, help="products.json для категорий товаров")
+    parser.add_argument("--dest", default=ANALYTICS_FILE, help="куда сохранить xlsx")
+    parser.add_argument("--backend", default=read_orders_backend(), choices=["json", "journal", "sqlite", "sharded"],
+                        help="хранилище заказов, из которого читаем")
+    parser.add_argument("--no-archive", action="store_true", help="не учитывать заказы из архива")
+    args = parser.parse_args()
+
+    count = build_report(args.source, args.dest, args.products, args.backend, not args.no_archive)
+    print(f"Аналитика сохранена: {args.dest} (заказов: {count})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import argparse
+import asyncio
+import logging
+from typing import Optional
+
+from config import read_orders_backend
+from data_manager import DataManager, ORDERS_FILE
+from order_archive import ARCHIVE_AFTER_DAYS
+from order_storage import create_order_storage
+
+
+# Как часто бот переносит старые оплаченные заказы в архив, секунды
+ARCHIVE_INTERVAL = 24 * 60 * 60
+# Первый перенос - вскоре после запуска, когда бот уже поднялся
+ARCHIVE_START_DELAY = 60
+
+logger = logging.getLogger(__name__)
+
+
+class OrderArchiver:
+    '''
+    Фоновая архивация: раз в interval секунд оплаченные заказы старше after_days дней
+    переезжают из хранилища заказов в сжатый архив, так что живая база остаётся маленькой.
+    '''
+
+    def __init__(self, data_manager: DataManager, after_days: int = ARCHIVE_AFTER_DAYS,
+                 interval: float = ARCHIVE_INTERVAL, start_delay: float = ARCHIVE_START_DELAY):
+        self.data_manager = data_manager
+        self.after_days = after_days
+        self.interval = interval
+        self.start_delay = start_delay
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def archive(self) -> int:
+        ''' Один перенос в архив '''
+        count = await self.data_manager.archive_paid_orders(self.after_days)
+        if count:
+            logger.info("В архив перенесено заказов: %s", count)
+        return count
+
+    async def _run(self) -> None:
+        await asyncio.sleep(self.start_delay)
+        while True:
+            try:
+                await self.archive()
+            except Exception:
+                logger.exception("Ошибка при архивации заказов")
+            await asyncio.sleep(self.interval)
+
+
+async def archive_once(source: str, backend: str, after_days: int) -> int:
+    data_manager = DataManager(source, orders_storage=create_order_storage(backend, source))
+    try:
+        return await data_manager.archive_paid_orders(after_days)
+    finally:
+        await data_manager.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Перенос старых оплаченных заказов в архив (запускать при остановленном боте)"
+    )
+    parser.add_argument("--source", default=ORDERS_FILE, help="путь к orders.json (журнал, база и архив ищутся рядом)")
+    parser.add_argument("--backend", default=read_orders_backend(), choices=["json", "journal", "sqlite", "sharded"],
+                        help="хранилище заказов")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS, help="переносим заказы старше стольких дней")
+    args = parser.parse_args()
+
+    count = asyncio.run(archive_once(args.source, args.backend, args.days))
+    print(f"В архив перенесено заказов: {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,155 @@
 import asyncio
+from typing import Optional
+from aiohttp import web
 from aiogram import Bot, Dispatcher
-from config import read_bot_token
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from config import (
+    read_bot_token, read_bot_mode, read_webhook_settings, read_metrics_settings, read_archive_after_days,
+    WebhookSettings, MetricsSettings,
+)
 from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
+from aiogram.fsm.storage.base import BaseStorage
 
 from handlers.common import common_router
 from handlers.menu import menu_router
 from handlers.courses import courses_router
 
 from data_manager import DataManager
+from fsm_storage import SqliteFsmStorage
+from catalog_watcher import CatalogWatcher
+from archiver import OrderArchiver
+from image_registry import ImageRegistry
+from reminder import PaymentReminder, REMINDERS_STATE_FILE
+from outbound import OutboundDispatcher
+from middlewares.chat_serializer import ChatSerializerMiddleware
+from middlewares.metrics import setup_metrics
+from metrics_server import start_metrics_server
 
 
-BOT_TOKEN = read_bot_token()
+def create_bot(token: str) -> Bot:
+    return Bot(token=token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
-data_manager = DataManager()
 
-async def on_startup():
-    """Вызывается при старте бота."""
-    await data_manager.load_products_base()  # Загружаем данные
+def build_dispatcher(bot: Bot, data_manager: Optional[DataManager] = None,
+                     image_registry: Optional[ImageRegistry] = None,
+                     fsm_storage: Optional[BaseStorage] = None,
+                     outbound: Optional[OutboundDispatcher] = None,
+                     reminders_state_file_path: str = REMINDERS_STATE_FILE,
+                     metrics_settings: Optional[MetricsSettings] = None) -> Dispatcher:
+    """
+    Собирает диспетчер со всеми роутерами, middleware и фоновыми службами.
+    По умолчанию всё работает с файлами из data/, нагрузочный тест подставляет свои.
+    Роутеры - объекты модуля, поэтому диспетчер в процессе можно собрать только один раз.
+    """
+    # Общие для всего бота объекты попадают в хэндлеры через workflow data диспетчера
+    # (аргументы data_manager, image_registry, outbound)
+    data_manager = data_manager or DataManager()
+    image_registry = image_registry or ImageRegistry()
+    outbound = outbound or OutboundDispatcher(bot)
+    # Лимиты Telegram считаются для всех вызовов Bot API, а не только для очереди исходящих
+    outbound.install(bot.session)
+    catalog_watcher = CatalogWatcher(data_manager)
+    payment_reminder = PaymentReminder(outbound, data_manager, reminders_state_file_path)
+    # Старые оплаченные заказы раз в сутки уходят в архив (ARCHIVE_AFTER_DAYS, 0 - не архивировать)
+    archive_after_days = read_archive_after_days()
+    order_archiver = OrderArchiver(data_manager, archive_after_days) if archive_after_days > 0 else None
+    # Состояния и корзины пользователей переживают перезапуск бота
+    # (несохранённые изменения дописываются при остановке: диспетчер сам закрывает хранилище FSM)
+    fsm_storage = fsm_storage or SqliteFsmStorage()
+    dp = Dispatcher(storage=fsm_storage, data_manager=data_manager, image_registry=image_registry, outbound=outbound)
+    # Метрики (METRICS_ENABLED) отдаются на локальном порту в формате Prometheus
+    metrics_settings = metrics_settings or read_metrics_settings()
+    metrics_runner: Optional[web.AppRunner] = None
 
-dp.startup.register(on_startup)
-dp.include_router(courses_router)
-dp.include_router(common_router)
-dp.include_router(menu_router)
+    async def on_startup():
+        """Вызывается при старте бота."""
+        nonlocal metrics_runner
+        await data_manager.load_products_base()  # Загружаем каталог товаров
+        await data_manager.load_courses_base()  # и курсов
+        await data_manager.load_orders_base()  # Поднимаем заказы: снапшот + журнал
+        await image_registry.load()  # file_id уже загруженных в Telegram картинок
+        outbound.start()  # Очередь исходящих сообщений с ограничением скорости
+        catalog_watcher.start()  # Подхватываем правки products.json / courses.json без перезапуска
+        await payment_reminder.start()  # Напоминания об оплате
+        if order_archiver is not None:
+            order_archiver.start()
+        if metrics_settings.enabled:
+            metrics_runner = await start_metrics_server(metrics_settings.host, metrics_settings.port)
+
+    async def on_shutdown():
+        """Вызывается при остановке бота."""
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await catalog_watcher.stop()
+        await payment_reminder.stop()
+        if order_archiver is not None:
+            await order_archiver.stop()
+        await outbound.stop()
+        await data_manager.close()  # Сворачиваем журнал заказов / закрываем базу
+
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    if metrics_settings.enabled:
+        # Регистрируется раньше сериализатора, чтобы время обновления включало ожидание очереди чата
+        setup_metrics(bot, dp, [courses_router, common_router, menu_router])
+    # Обновления одного чата обрабатываются по очереди, разных чатов - параллельно
+    dp.update.outer_middleware(ChatSerializerMiddleware())
+    dp.include_router(courses_router)
+    dp.include_router(common_router)
+    dp.include_router(menu_router)
+    return dp
+
+
+# Сколько секунд при остановке ждём обновления, которые ещё обрабатываются
+WEBHOOK_DRAIN_TIMEOUT = 30
+
+
+async def healthz(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok"})
+
+
+def build_webhook_app(bot: Bot, dp: Dispatcher, settings: WebhookSettings) -> web.Application:
+    """Приложение aiohttp для режима webhook: приём обновлений, /healthz и корректная остановка."""
+    if not settings.secret:
+        raise ValueError("Для режима webhook нужен WEBHOOK_SECRET")
+    app = web.Application()
+    request_handler = SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=settings.secret)
+
+    async def on_app_startup(app: web.Application):
+        if settings.base_url:
+            await bot.set_webhook(
+                settings.base_url.rstrip("/") + settings.path,
+                secret_token=settings.secret,
+                allowed_updates=dp.resolve_used_update_types(),
+                drop_pending_updates=True,
+            )
+
+    async def drain_updates(app: web.Application):
+        # Обновления обрабатываются в фоне после ответа Telegram - даём им завершиться
+        tasks = list(request_handler._background_feed_update_tasks)
+        if tasks:
+            await asyncio.wait(tasks, timeout=WEBHOOK_DRAIN_TIMEOUT)
+
+    # Порядок остановки: дождаться обновлений -> on_shutdown бота -> закрыть сессию Bot API
+    app.on_startup.append(on_app_startup)
+    app.on_shutdown.append(drain_updates)
+    setup_application(app, dp, bot=bot)
+    request_handler.register(app, path=settings.path)
+    app.router.add_get("/healthz", healthz)
+    return app
+
+
+def run_webhook():
+    settings = read_webhook_settings()
+    bot = create_bot(read_bot_token())
+    dp = build_dispatcher(bot)
+    web.run_app(build_webhook_app(bot, dp, settings), host=settings.host, port=settings.port)
 
 
 async def main():
+    bot = create_bot(read_bot_token())
+    dp = build_dispatcher(bot)
     try:
         await bot.delete_webhook(drop_pending_updates=True)
         await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
@@ -37,4 +158,7 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if read_bot_mode() == "webhook":
+        run_webhook()
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,66 @@
+from types import MappingProxyType
+from typing import List, Mapping, Optional, Tuple
+
+from pydantic import BaseModel, ConfigDict
+
+from models import Course
+
+
+class CatalogItem(BaseModel):
+    ''' Товар из products.json '''
+    model_config = ConfigDict(frozen=True)
+
+    item: str
+    callback_data: str
+    price: int
+    image_url: Optional[str] = None
+    type: str = "product"
+
+
+class Category(BaseModel):
+    ''' Категория товаров из products.json '''
+    model_config = ConfigDict(frozen=True)
+
+    category: str
+    name: str
+    items: Tuple[CatalogItem, ...] = ()
+
+
+class ProductCatalog:
+    '''
+    Неизменяемый индекс каталога товаров, строится один раз при загрузке products.json:
+    категория -> товары, callback_data -> товар, название -> товар.
+    '''
+
+    def __init__(self, categories: Tuple[Category, ...] = ()):
+        self.categories = categories
+        self.by_category: Mapping[str, Category] = MappingProxyType(
+            {category.category: category for category in categories}
+        )
+        self.by_callback: Mapping[str, CatalogItem] = MappingProxyType(
+            {item.callback_data: item for category in categories for item in category.items}
+        )
+        self.by_name: Mapping[str, CatalogItem] = MappingProxyType(
+            {item.item: item for category in categories for item in category.items}
+        )
+
+    @classmethod
+    def from_raw(cls, raw_data: List[dict]) -> "ProductCatalog":
+        ''' Строим каталог из содержимого products.json (ошибки валидации пробрасываются) '''
+        return cls(tuple(Category(**category) for category in raw_data))
+
+
+class CourseCatalog:
+    '''
+    Неизменяемый индекс курсов. Идентификатор курса - его название,
+    оно же используется в callback_data кнопок (course_<название>).
+    '''
+
+    def __init__(self, courses: Tuple[Course, ...] = ()):
+        self.courses = courses
+        self.by_id: Mapping[str, Course] = MappingProxyType({course.item: course for course in courses})
+
+    @classmethod
+    def from_raw(cls, raw_data: List[dict]) -> "CourseCatalog":
+        ''' Строим каталог из содержимого courses.json (ошибки валидации пробрасываются) '''
+        return cls(tuple(Course(**course) for course in raw_data))
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import os
+from typing import Dict, Optional, Tuple
+
+from data_manager import DataManager
+
+
+# Как часто проверяем products.json и courses.json, секунды
+CATALOG_POLL_INTERVAL = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogWatcher:
+    '''
+    Фоновая проверка файлов каталога. Раз в interval секунд сравниваем время модификации
+    и размер products.json / courses.json; если файл изменился - перезагружаем каталог
+    через DataManager. Разбор идёт вне обработчиков, подмена каталога - одно присваивание,
+    так что пользователи в /order и /courses не замечают перезагрузки. Некорректный файл
+    отклоняется, остаётся старый каталог.
+    '''
+
+    def __init__(self, data_manager: DataManager, interval: float = CATALOG_POLL_INTERVAL):
+        self.data_manager = data_manager
+        self.interval = interval
+        self._fingerprints: Dict[str, Optional[Tuple[int, int]]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _fingerprint(file_path: str) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _watched(self):
+        return (
+            (self.data_manager.products_file_path, self.data_manager.reload_products),
+            (self.data_manager.courses_file_path, self.data_manager.reload_courses),
+        )
+
+    def start(self) -> None:
+        ''' Запоминаем текущее состояние файлов и запускаем фоновую проверку '''
+        for file_path, _ in self._watched():
+            self._fingerprints[file_path] = self._fingerprint(file_path)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def check(self) -> None:
+        ''' Одна проверка файлов каталога '''
+        for file_path, reload in self._watched():
+            fingerprint = self._fingerprint(file_path)
+            if fingerprint == self._fingerprints.get(file_path):
+                continue
+
+            # Запоминаем отпечаток в любом случае: битый файл не перечитываем, пока его снова не поправят
+            self._fingerprints[file_path] = fingerprint
+            if await reload():
+                logger.info("Каталог %s перезагружен", file_path)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception:
+                logger.exception("Ошибка при проверке файлов каталога")
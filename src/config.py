@@ -1,7 +1,67 @@
 from environs import Env
+from marshmallow.validate import Regexp
+from typing import NamedTuple
+
+# Секрет webhook по правилам Telegram: 1-256 символов A-Z, a-z, 0-9, _ и -
+WEBHOOK_SECRET_PATTERN = r"^[A-Za-z0-9_-]{1,256}$"
 
 def read_bot_token():
     env = Env()
     env.read_env()
 
-    return env.str("BOT_TOKEN")
\ No newline at end of file
+    return env.str("BOT_TOKEN")
+
+def read_orders_backend():
+    env = Env()
+    env.read_env()
+
+    return env.str("ORDERS_BACKEND", "journal")
+
+def read_bot_mode():
+    ''' Как бот получает обновления: polling (по умолчанию) или webhook '''
+    env = Env()
+    env.read_env()
+
+    return env.str("BOT_MODE", "polling")
+
+class WebhookSettings(NamedTuple):
+    base_url: str  # Публичный адрес, пустой - webhook в Telegram не регистрируем (локальная отладка)
+    path: str
+    secret: str
+    host: str
+    port: int
+
+def read_webhook_settings():
+    env = Env()
+    env.read_env()
+
+    return WebhookSettings(
+        base_url=env.str("WEBHOOK_BASE_URL", ""),
+        path=env.str("WEBHOOK_PATH", "/webhook"),
+        # Без секрета принимать обновления нельзя: любой, кто знает адрес, сможет их подделать
+        secret=env.str("WEBHOOK_SECRET", validate=Regexp(WEBHOOK_SECRET_PATTERN, error="нужен секрет из 1-256 символов A-Z, a-z, 0-9, _ и -")),
+        host=env.str("WEBHOOK_HOST", "0.0.0.0"),
+        port=env.int("WEBHOOK_PORT", 8080),
+    )
+
+class MetricsSettings(NamedTuple):
+    enabled: bool
+    host: str  # По умолчанию только локальный интерфейс - метрики наружу не публикуем
+    port: int
+
+def read_metrics_settings():
+    env = Env()
+    env.read_env()
+
+    return MetricsSettings(
+        enabled=env.bool("METRICS_ENABLED", False),
+        host=env.str("METRICS_HOST", "127.0.0.1"),
+        port=env.int("METRICS_PORT", 9100),
+    )
+
+def read_archive_after_days():
+    ''' Через сколько дней оплаченные заказы уходят в архив (0 - бот не архивирует сам) '''
+    env = Env()
+    env.read_env()
+
+    return env.int("ARCHIVE_AFTER_DAYS", 90)
@@ -1,64 +1,95 @@
 import aiofiles
+import asyncio
 import json
+import logging
 import os
-from typing import List, Dict, Optional
-from pydantic import BaseModel, Field
+import time
+from typing import List, Dict, Optional, Tuple
 from datetime import date
 from hashlib import sha256
-import time
 
+from config import read_orders_backend
+from metrics import metrics
+from models import Course, Order
+from catalog import ProductCatalog, CourseCatalog
+from order_storage import OrderStorage, create_order_storage
+from order_archive import OrderArchive, archive_dir_for, archive_orders, merge_history
 
 ORDERS_FILE = "../data/orders.json"
 PRODUCTS_FILE = "../data/products.json"
 COURSES_FILE = "../data/courses.json"
 
-'''АРТЁМ: поменял атрибуты класса'''
-class Course(BaseModel):
-    item: str
-    type: str
-    description: str
-    price: int
-    image_url: str = None  # Новое поле для URL изображения
-
-class Product(BaseModel):
-    item: str
-    type: str
-    price: int
-
-class Order(BaseModel):
-    order_id: int
-    item: str
-    type: str
-    price: int
-    paid: bool
-    date: str
-    timestamp: int = Field(default_factory=lambda: int(time.time()))
+logger = logging.getLogger(__name__)
+
+
+class OrderListener:
+    ''' Подписчик DataManager на изменения заказов. Методы вызываются синхронно сразу после записи '''
+
+    def on_orders_added(self, user_id: str, orders: List[Order]) -> None:
+        pass
+
+    def on_order_paid_changed(self, user_id: str, order: Order) -> None:
+        pass
 
 
 class DataManager:
-    def __init__(self, orders_file_path: str = ORDERS_FILE, products_file_path: str = PRODUCTS_FILE, courses_file_path: str = COURSES_FILE):
+    def __init__(self, orders_file_path: str = ORDERS_FILE, products_file_path: str = PRODUCTS_FILE, courses_file_path: str = COURSES_FILE,
+                 orders_storage: Optional[OrderStorage] = None, orders_archive: Optional[OrderArchive] = None):
         self.orders_file_path = orders_file_path
+        # Хранилище заказов выбирается переменной окружения ORDERS_BACKEND (json / journal / sqlite / sharded),
+        # журнал (orders.journal), база (orders.db) и папка шардов (orders.shards) лежат рядом с orders.json
+        self.orders_storage = orders_storage or create_order_storage(read_orders_backend(), orders_file_path)
+        # Старые оплаченные заказы переезжают в сжатый архив (orders.archive рядом с orders.json)
+        self.orders_archive = orders_archive or OrderArchive(archive_dir_for(orders_file_path))
         self.products_file_path = products_file_path
         self.courses_file_path = courses_file_path
         self._products_data: List[Dict] = []
         self._courses_data: List[Course] = []  # Новое поле для кэширования курсов
+        # Индексы каталогов строятся при загрузке, чтобы кнопки находили товар за O(1)
+        self._products_catalog = ProductCatalog()
+        self._courses_catalog = CourseCatalog()
+        # Меняется при каждой загрузке каталогов - по ней сбрасываются закэшированные клавиатуры
+        self.catalog_version = 0
+        # Подписчики на изменения заказов (например, напоминания об оплате)
+        self._order_listeners: List[OrderListener] = []
+
+    @staticmethod
+    async def _read_catalog_file(file_path: str) -> Optional[str]:
+        """Читаем файл каталога; None, если файла нет или он пустой."""
+        if not os.path.exists(file_path):
+            return None
+
+        with metrics.timer("storage_read_seconds", store="catalog"):
+            async with aiofiles.open(file_path, mode='r', encoding='utf-8') as f:
+                content = await f.read()
+        metrics.count_bytes("storage_read_bytes_total", content, store="catalog")
+        return content if content.strip() else None
+
+    @staticmethod
+    def _parse_products(content: str) -> Tuple[List[Dict], ProductCatalog]:
+        data = json.loads(content)
+        return data, ProductCatalog.from_raw(data)
+
+    def _swap_products(self, data: List[Dict], catalog: ProductCatalog) -> None:
+        # Данные, индекс и версия меняются вместе, без await между ними
+        self._products_data = data
+        self._products_catalog = catalog
+        self.catalog_version += 1
 
     async def _load_products_initial(self) -> None:
         """Асинхронная загрузка данных из products.json."""
-        if not os.path.exists(self.products_file_path):
-            self._products_data = []
-            return
+        data: List[Dict] = []
+        catalog = ProductCatalog()
 
         try:
-            async with aiofiles.open(self.products_file_path, mode='r', encoding='utf-8') as f:
-                content = await f.read()
-                if not content.strip():
-                    self._products_data = []
-                    return
-
-                self._products_data = json.loads(content)
+            content = await self._read_catalog_file(self.products_file_path)
+            if content is not None:
+                data, catalog = self._parse_products(content)
         except (json.JSONDecodeError, Exception):
-            self._products_data = []
+            data = []
+            catalog = ProductCatalog()
+
+        self._swap_products(data, catalog)
 
     async def load_products_base(self) -> List[Dict]:
         """Возвращает кэшированные данные."""
@@ -66,9 +97,29 @@ class DataManager:
             await self._load_products_initial()
         return self._products_data
 
-    async def reload_products(self) -> None:
-        """Перезагружает данные из products.json."""
-        await self._load_products_initial()
+    async def get_products_catalog(self) -> ProductCatalog:
+        """Возвращает индекс каталога товаров."""
+        if not self._products_catalog.categories:
+            await self._load_products_initial()
+        return self._products_catalog
+
+    async def reload_products(self) -> bool:
+        """
+        Перезагружает данные из products.json. Файл разбирается и проверяется в отдельном потоке,
+        новый каталог подменяет старый одним присваиванием. Пустой или некорректный файл
+        отклоняется - остаётся старый каталог, возвращается False.
+        """
+        try:
+            content = await self._read_catalog_file(self.products_file_path)
+            if content is None:
+                raise ValueError("products.json пуст или отсутствует")
+            data, catalog = await asyncio.to_thread(self._parse_products, content)
+        except Exception:
+            logger.exception("Не удалось перезагрузить %s, оставляем старый каталог", self.products_file_path)
+            return False
+
+        self._swap_products(data, catalog)
+        return True
 
     '''ПАША: Закомментировал код Влада, так как не получалось подгрузить данные'''
     # async def load_products_base(self) -> List[Dict]:
@@ -91,23 +142,28 @@ class DataManager:
     #         # ПАША: исправил на просто возвращение списка для файла product.json с категориями
     #         return data
 
+    @staticmethod
+    def _parse_courses(content: str) -> CourseCatalog:
+        return CourseCatalog.from_raw(json.loads(content))
+
+    def _swap_courses(self, catalog: CourseCatalog) -> None:
+        # Данные, индекс и версия меняются вместе, без await между ними
+        self._courses_data = list(catalog.courses)
+        self._courses_catalog = catalog
+        self.catalog_version += 1
+
     async def _load_courses_initial(self) -> None:
         """Асинхронная загрузка данных из courses.json."""
-        if not os.path.exists(self.courses_file_path):
-            self._courses_data = []
-            return
+        catalog = CourseCatalog()
 
         try:
-            async with aiofiles.open(self.courses_file_path, mode='r', encoding='utf-8') as f:
-                content = await f.read()
-                if not content.strip():
-                    self._courses_data = []
-                    return
-
-                data = json.loads(content)
-                self._courses_data = [Course(**item) for item in data]
+            content = await self._read_catalog_file(self.courses_file_path)
+            if content is not None:
+                catalog = self._parse_courses(content)
         except (json.JSONDecodeError, Exception):
-            self._courses_data = []
+            catalog = CourseCatalog()
+
+        self._swap_courses(catalog)
 
     async def load_courses_base(self) -> List[Course]:
         """Возвращает кэшированные данные о курсах."""
@@ -115,20 +171,36 @@ class DataManager:
             await self._load_courses_initial()
         return self._courses_data
 
-    async def reload_courses(self) -> None:
-        """Перезагружает данные из courses.json."""
-        await self._load_courses_initial()
+    async def get_courses_catalog(self) -> CourseCatalog:
+        """Возвращает индекс курсов."""
+        if not self._courses_catalog.courses:
+            await self._load_courses_initial()
+        return self._courses_catalog
+
+    async def reload_courses(self) -> bool:
+        """
+        Перезагружает данные из courses.json. Пустой или некорректный файл отклоняется -
+        остаётся старый каталог, возвращается False.
+        """
+        try:
+            content = await self._read_catalog_file(self.courses_file_path)
+            if content is None:
+                raise ValueError("courses.json пуст или отсутствует")
+            catalog = await asyncio.to_thread(self._parse_courses, content)
+        except Exception:
+            logger.exception("Не удалось перезагрузить %s, оставляем старый каталог", self.courses_file_path)
+            return False
+
+        self._swap_courses(catalog)
+        return True
 
     '''АРТЁМ: заккоментил владовский код, сделал такую же реализацию как у паши с кэшем'''
 
     # async def load_courses_base(self) -> List[Course]:
-<<<<<<< HEAD
-=======
     #     '''
     #     Получаем всю базу курсов
     #     надо будет распарсить, когда будем состыковывать модули
     #     '''
->>>>>>> 9fcf79536583e16a3232d91847e190ac524c3574
     #
     #     if not os.path.exists(self.courses_file_path):
     #         return {}
@@ -143,93 +215,112 @@ class DataManager:
     #         return [Course(**item) for item in data]
 
     async def load_orders_base(self) -> Dict[str, List[Order]]:
-        ''' Получаем всю базу заказов '''
-
-        if not os.path.exists(self.orders_file_path):
-            return {}
-
-        async with aiofiles.open(self.orders_file_path, mode='r', encoding='utf-8') as f:
-            content = await f.read()
-            if not content.strip():
-                return {}
-
-            raw_data = json.loads(content)
-            return {
-                user_id: [Order(**order) for order in orders]
-                for user_id, orders in raw_data.items()
-            }
+        ''' Получаем всю базу заказов. Для журнала возвращается кэш из памяти - не изменяйте его снаружи '''
+        return await self.orders_storage.load_all()
 
     async def save_all_data(self, data: Dict[str, List[Order]]):
         ''' Сохраняем всю базу заказов '''
+        await self.orders_storage.replace_all(data)
+
+    async def compact_orders(self) -> None:
+        ''' Обслуживание хранилища заказов: для журнала - сворачивание в снапшот orders.json '''
+        await self.orders_storage.compact()
 
-        async with aiofiles.open(self.orders_file_path, mode='w', encoding='utf-8') as f:
-            serializable_data = {
-                user_id: [order.model_dump() for order in orders]
-                for user_id, orders in data.items()
-            }
-            await f.write(json.dumps(serializable_data, indent=4, ensure_ascii=False))
+    async def close(self) -> None:
+        ''' Вызывается при остановке бота: сбрасываем и закрываем хранилище заказов '''
+        await self.orders_storage.compact()
+        await self.orders_storage.close()
 
     async def add_order(self, user_id: int, order_data: dict) -> Order:
         ''' Добавляем заказ в базу '''
-        user_id_str = str(user_id)
-        data = await self.load_orders_base()
-        order_list = data.get(user_id_str, [])
+        orders = await self.add_orders(user_id, [order_data])
+        return orders[0]
 
-        next_order_id = (
-            max((order.order_id for order in order_list), default=0) + 1
-        )
-        order = Order(order_id=next_order_id, **order_data)
-        order_list.append(order)
-        data[user_id_str] = order_list
+    async def add_orders(self, user_id: int, items: List[dict]) -> List[Order]:
+        ''' Добавляем сразу несколько заказов пользователя (всю корзину) одной записью в хранилище '''
+        if not items:
+            return []
 
-        await self.save_all_data(data)
+        user_id_str = str(user_id)
+        orders = await self.orders_storage.add_orders(user_id_str, items)
+        for listener in self._order_listeners:
+            listener.on_orders_added(user_id_str, orders)
+        return orders
+
+    async def set_order_paid(self, user_id: int, order_id: int, paid: bool = True) -> Optional[Order]:
+        ''' Меняем статус оплаты заказа. Возвращает заказ или None, если его нет '''
+        user_id_str = str(user_id)
+        order = await self.orders_storage.set_paid(user_id_str, order_id, paid)
+        if order is not None:
+            for listener in self._order_listeners:
+                listener.on_order_paid_changed(user_id_str, order)
         return order
 
+    def add_order_listener(self, listener: OrderListener) -> None:
+        ''' Подписываемся на новые заказы и изменения оплаты '''
+        self._order_listeners.append(listener)
+
     async def get_orders(self, user_id: int) -> List[Order]:
         ''' Получаем список заказов от определенного пользователя. Нужно чтобы посмотреть неоплаченные заказы '''
-        data = await self.load_orders_base()
-        return data.get(str(user_id), [])
+        return await self.orders_storage.get_user_orders(str(user_id))
+
+    async def get_order_history(self, user_id: int) -> List[Order]:
+        ''' Полная история заказов пользователя вместе с архивом, по order_id '''
+        user_id_str = str(user_id)
+        live = await self.orders_storage.get_user_orders(user_id_str)
+        archived = await self.orders_archive.get_user_orders(user_id_str)
+        return merge_history(live, archived)
+
+    async def archive_paid_orders(self, older_than_days: int) -> int:
+        ''' Переносим оплаченные заказы старше older_than_days дней в архив, возвращаем их число '''
+        before_timestamp = int(time.time()) - older_than_days * 24 * 60 * 60
+        return await archive_orders(self.orders_storage, self.orders_archive, before_timestamp)
+
+    async def get_not_paid_orders(self, user_id: int) -> List[Order]:
+        ''' Неоплаченные заказы пользователя '''
+        return await self.orders_storage.get_unpaid_orders(str(user_id))
+
+    async def get_orders_by_date(self, day: str) -> List[Tuple[str, Order]]:
+        ''' Заказы за день (дата в формате YYYY-MM-DD) в виде пар (user_id, заказ) '''
+        return await self.orders_storage.get_orders_by_date(day)
+
+    async def get_all_not_paid_orders(self) -> List[Tuple[str, Order]]:
+        ''' Неоплаченные заказы всех пользователей в виде пар (user_id, заказ) '''
+        return await self.orders_storage.get_all_unpaid_orders()
     
     async def check_not_paid(self, user_id: int):
         ''' Смотрим неоплаченные заказы. Когда будем состыковывать можно будет изменить print на return '''
-        user_orders = await self.get_orders(user_id)
-        for order in user_orders:
-            if (not order.paid):
-                print(f"Ваш заказ '{order.item}' на сумму '{order.price}$' еще не оплачен")
+        for order in await self.get_not_paid_orders(user_id):
+            print(f"Ваш заказ '{order.item}' на сумму '{order.price}$' еще не оплачен")
     
     async def get_product_from_base(self, item: str):
         ''' Получаем изделие по имени из базы, возвращаем данные в формате словаря. Нужно для того, чтобы передать словарь в параметры функции добавления заказа, 
         или для вывода информации о заказе клиенту(если это будем делать)'''
-        product_base = await self.load_products_base()
-        for product in product_base:
-            if product.item == item:
-                today = date.today().isoformat()
-                order_data = {
-                "item": product.item,
-                "type": product.type,
-                "price": product.price,
-                "paid": False,
-                "date": today
-                }
-                return order_data
+        catalog = await self.get_products_catalog()
+        product = catalog.by_name.get(item)
+        if product is None:
+            return None
+
+        return {
+            "item": product.item,
+            "type": product.type,
+            "price": product.price,
+            "paid": False,
+            "date": date.today().isoformat()
+        }
     
     async def get_course_from_base(self, item: str):
         ''' Получаем курс по имени из базы, возвращаем данные в формате словаря. Нужно для того, чтобы передать словарь в параметры функции добавления заказа, 
         или для вывода информации о заказе клиенту(если это будем делать)'''
-        courses_base = await self.load_courses_base()
-        for course in courses_base:
-            if course.item == item:
-                today = date.today().isoformat()
-                order_data = {
-                "item": course.item,
-                "type": course.type,
-                "price": course.price,
-                "paid": False,
-                "date": today
-                }
-                return order_data
-        
-
-
-
-
+        catalog = await self.get_courses_catalog()
+        course = catalog.by_id.get(item)
+        if course is None:
+            return None
+
+        return {
+            "item": course.item,
+            "type": course.type,
+            "price": course.price,
+            "paid": False,
+            "date": date.today().isoformat()
+        }
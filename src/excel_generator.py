@@ -1,25 +1,229 @@
+import argparse
+import asyncio
 import json
-import pandas as pd
-
-def json_to_xlsx():
-    with open("orders.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
-    rows = []
-    for user_id, orders in data.items():
-        for order in orders:
-            row = {"Id клиента": user_id}
-            row["Номер заказа"] = order["order_id"]
-            row["Товар"] = order["item"]
-            row["Вид товара"] = order["type"]
-            row["Цена"] = order["price"]
-            row["Оплачено"] = order["paid"]
-            row["Дата заказа"] = order["date"]
-            rows.append(row)
-    rows.sort(key=lambda x: (x["Id клиента"], x.get("Дата заказа", "")))
-    df = pd.DataFrame(rows)
-    df.to_excel("orders.xlsx", index=False)
-
-    print("Excel-файл создан: orders.xlsx")
-
-print(pd.__version__)
-json_to_xlsx()
\ No newline at end of file
+import os
+import time
+from typing import Optional, Tuple
+
+from config import read_orders_backend
+from order_archive import OrderArchive, archive_dir_for
+from order_storage import OrderStorage, create_order_storage
+
+
+ORDERS_FILE = "../data/orders.json"
+REPORT_FILE = "../reports/orders.xlsx"
+
+COLUMNS = ["Id клиента", "Номер заказа", "Товар", "Вид товара", "Цена", "Оплачено", "Дата заказа"]
+PAID_CHANGES_COLUMNS = ["Id клиента", "Номер заказа", "Оплачено"]
+SHEET_NAME = "Заказы"
+PAID_CHANGES_SHEET_NAME = "Изменения оплаты"
+
+# Отметка инкрементальной выгрузки лежит рядом с отчётом: orders.xlsx -> orders.xlsx.watermark.json,
+# чтобы для дозаписи не открывать сам отчёт
+WATERMARK_SUFFIX = ".watermark.json"
+# Запас по времени: заказ мог получить timestamp чуть раньше начала выгрузки, а попасть в базу позже
+WATERMARK_OVERLAP = 60
+
+
+def _order_row(user_id: str, order) -> list:
+    return [user_id, order.order_id, order.item, order.type, order.price, order.paid, order.date]
+
+
+def _watermark_path(destination: str) -> str:
+    return destination + WATERMARK_SUFFIX
+
+
+def _write_watermark(destination: str, watermark: dict) -> None:
+    path = _watermark_path(destination)
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(watermark, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def _read_watermark(destination: str) -> Optional[dict]:
+    try:
+        with open(_watermark_path(destination), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def delta_path_for(destination: str, started_at: int) -> str:
+    ''' Новый файл дозаписи: orders.xlsx -> orders.delta-20240131-120000.xlsx (-2, -3... в ту же секунду) '''
+    root, ext = os.path.splitext(destination)
+    base = f"{root}.delta-{time.strftime('%Y%m%d-%H%M%S', time.localtime(started_at))}"
+    path = base + (ext or ".xlsx")
+    suffix = 1
+    while os.path.exists(path):
+        suffix += 1
+        path = f"{base}-{suffix}{ext or '.xlsx'}"
+    return path
+
+
+def _save_workbook(workbook, destination: str) -> None:
+    directory = os.path.dirname(destination)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = destination + ".tmp"
+    workbook.save(tmp_path)
+    os.replace(tmp_path, destination)
+
+
+async def export_orders(storage: OrderStorage, destination: str, backend: Optional[str] = None,
+                        archive: Optional[OrderArchive] = None) -> int:
+    '''
+    Выгружаем заказы в Excel построчно: заказы идут из хранилища уже отсортированными
+    по (id клиента, дата), а книга открыта в режиме write-only, так что в памяти не
+    копится ни список строк, ни сама таблица. Возвращает число выгруженных заказов.
+    Память не растёт с числом заказов только у sqlite (потоковое чтение по индексу) и,
+    с точностью до одной корзины, у sharded. Хранилища json и journal сначала целиком
+    поднимают orders.json (и журнал) в память, у них пик памяти линеен по числу заказов.
+    Если указан backend, рядом с отчётом сохраняется отметка для export_orders_incremental.
+    Если указан archive, после живых заказов выгружаются архивные (по месяцам).
+    '''
+    from openpyxl import Workbook
+
+    watermark = None
+    if backend is not None:
+        # Отметку снимаем до чтения заказов: всё, что изменится во время выгрузки, попадёт в следующую
+        watermark = {
+            "backend": backend,
+            "timestamp": int(time.time()) - WATERMARK_OVERLAP,
+            "paid_position": await storage.paid_changes_position(),
+            "archive": archive is not None,
+            "recent": [],
+        }
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(SHEET_NAME)
+    sheet.append(COLUMNS)
+
+    count = 0
+    async for user_id, order in storage.iter_orders_sorted():
+        sheet.append(_order_row(user_id, order))
+        count += 1
+        if watermark is not None and order.timestamp >= watermark["timestamp"]:
+            # Заказы из окна перекрытия уже в отчёте - следующая дозапись их пропустит
+            watermark["recent"].append([user_id, order.order_id, order.timestamp])
+    if archive is not None:
+        async for user_id, order in archive.iter_orders():
+            sheet.append(_order_row(user_id, order))
+            count += 1
+
+    _save_workbook(workbook, destination)
+    if watermark is not None:
+        _write_watermark(destination, watermark)
+    return count
+
+
+async def export_orders_incremental(storage: OrderStorage, destination: str, backend: str,
+                                    archive: Optional[OrderArchive] = None) -> Tuple[str, int, int]:
+    '''
+    Дозапись к уже выгруженному отчёту без его открытия: новые заказы (новее отметки)
+    и изменения оплаты (после сохранённой позиции в логе) пишутся в отдельную небольшую
+    книгу рядом с отчётом (delta_path_for) - листы SHEET_NAME и PAID_CHANGES_SHEET_NAME.
+    Отчёт плюс его дозаписи по порядку дают актуальную картину; новая полная выгрузка
+    заменяет их все. Запись - O(изменений). Чтение хранилища O(изменений) у sqlite
+    (индекс по timestamp и таблица изменений оплаты); sharded открывает шарды начиная
+    с месяца отметки, а json и journal сначала поднимают всю базу заказов.
+    Если отчёта или отметки нет (или отчёт строился из другого хранилища либо с архивом,
+    а теперь без него, и наоборот) - выгружаем всё заново в destination, вместе с archive.
+    Возвращает (путь к записанной книге, добавлено заказов, изменений оплаты).
+    '''
+    from openpyxl import Workbook
+
+    watermark = _read_watermark(destination) if os.path.exists(destination) else None
+    if (watermark is None or watermark.get("backend") != backend
+            or watermark.get("archive", False) != (archive is not None)):
+        return destination, await export_orders(storage, destination, backend, archive), 0
+
+    started_at = int(time.time())
+    next_timestamp = started_at - WATERMARK_OVERLAP
+    paid_position, changes = await storage.get_paid_changes_since(watermark["paid_position"])
+    new_orders = await storage.get_orders_since(watermark["timestamp"])
+
+    workbook = Workbook(write_only=True)
+    orders_sheet = workbook.create_sheet(SHEET_NAME)
+    orders_sheet.append(COLUMNS)
+    recent = {(user_id, order_id): timestamp for user_id, order_id, timestamp in watermark.get("recent", [])}
+    added = 0
+    for user_id, order in new_orders:
+        if (user_id, order.order_id) in recent:
+            continue
+        orders_sheet.append(_order_row(user_id, order))
+        recent[(user_id, order.order_id)] = order.timestamp
+        added += 1
+
+    paid_sheet = workbook.create_sheet(PAID_CHANGES_SHEET_NAME)
+    paid_sheet.append(PAID_CHANGES_COLUMNS)
+    for user_id, order_id, paid in changes:
+        paid_sheet.append([user_id, order_id, paid])
+
+    delta_path = delta_path_for(destination, started_at)
+    _save_workbook(workbook, delta_path)
+    _write_watermark(destination, {
+        "backend": backend,
+        "timestamp": next_timestamp,
+        "paid_position": paid_position,
+        "archive": archive is not None,
+        "recent": [[user_id, order_id, timestamp] for (user_id, order_id), timestamp in recent.items()
+                   if timestamp >= next_timestamp],
+    })
+    return delta_path, added, len(changes)
+
+
+async def json_to_xlsx_async(source: str = ORDERS_FILE, destination: str = REPORT_FILE, backend: Optional[str] = None,
+                             with_archive: bool = True) -> int:
+    backend = backend or read_orders_backend()
+    storage = create_order_storage(backend, source)
+    archive = OrderArchive(archive_dir_for(source)) if with_archive else None
+    try:
+        return await export_orders(storage, destination, backend, archive)
+    finally:
+        await storage.close()
+
+
+def json_to_xlsx(source: str = ORDERS_FILE, destination: str = REPORT_FILE, backend: Optional[str] = None,
+                 with_archive: bool = True) -> int:
+    ''' Отчёт по заказам из source (orders.json или база рядом с ним, плюс архив) в destination '''
+    return asyncio.run(json_to_xlsx_async(source, destination, backend, with_archive))
+
+
+async def update_xlsx_async(source: str = ORDERS_FILE, destination: str = REPORT_FILE,
+                            backend: Optional[str] = None, with_archive: bool = True) -> Tuple[str, int, int]:
+    backend = backend or read_orders_backend()
+    storage = create_order_storage(backend, source)
+    archive = OrderArchive(archive_dir_for(source)) if with_archive else None
+    try:
+        return await export_orders_incremental(storage, destination, backend, archive)
+    finally:
+        await storage.close()
+
+
+def update_xlsx(source: str = ORDERS_FILE, destination: str = REPORT_FILE, backend: Optional[str] = None,
+                with_archive: bool = True) -> Tuple[str, int, int]:
+    ''' Дозапись к отчёту destination: только новые заказы и изменения оплаты, в отдельной книге '''
+    return asyncio.run(update_xlsx_async(source, destination, backend, with_archive))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка заказов в Excel")
+    parser.add_argument("--source", default=ORDERS_FILE, help="путь к orders.json (журнал и база ищутся рядом)")
+    parser.add_argument("--dest", default=REPORT_FILE, help="куда сохранить xlsx")
+    parser.add_argument("--backend", default=read_orders_backend(), choices=["json", "journal", "sqlite", "sharded"],
+                        help="хранилище заказов, из которого читаем (по умолчанию ORDERS_BACKEND)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="записать рядом с отчётом книгу только с изменениями с прошлой выгрузки")
+    parser.add_argument("--no-archive", action="store_true", help="не выгружать заказы из архива")
+    args = parser.parse_args()
+
+    if args.incremental:
+        path, added, updated = update_xlsx(args.source, args.dest, args.backend, not args.no_archive)
+        print(f"Excel-файл записан: {path} (новых заказов: {added}, изменений оплаты: {updated})")
+        return
+
+    count = json_to_xlsx(args.source, args.dest, args.backend, not args.no_archive)
+    print(f"Excel-файл создан: {args.dest} (заказов: {count})")
+
+
+if __name__ == "__main__":
+    main()
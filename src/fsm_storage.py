@@ -0,0 +1,226 @@
+import asyncio
+import copy
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+from metrics import metrics
+
+
+FSM_STORAGE_FILE = "../data/fsm.db"
+# Сколько сессий держим в памяти
+FSM_CACHE_SIZE = 10000
+# Как часто изменения уходят в базу, секунды
+FSM_FLUSH_INTERVAL = 1.0
+# Через сколько секунд без активности сессия (и брошенная корзина) удаляется
+FSM_SESSION_TTL = 7 * 24 * 60 * 60
+# Как часто чистим устаревшие сессии
+FSM_CLEANUP_INTERVAL = 60 * 60
+
+FSM_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm (
+    key        TEXT PRIMARY KEY,
+    state      TEXT,
+    data       TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fsm_updated_at_idx ON fsm (updated_at);
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class _Session:
+    __slots__ = ("state", "data", "touched_at")
+
+    def __init__(self, state: Optional[str], data: Dict[str, Any], touched_at: float):
+        self.state = state
+        self.data = data
+        self.touched_at = touched_at
+
+
+class SqliteFsmStorage(BaseStorage):
+    '''
+    Хранилище FSM (состояние и данные пользователя, в том числе корзина) в SQLite.
+    Активные сессии держатся в памяти в LRU ограниченного размера, чтение идёт из него.
+    Изменения сразу попадают в LRU и в буфер записи, который фоновая задача раз
+    в flush_interval сбрасывает в базу одной транзакцией (write-behind). Сессии без
+    активности дольше ttl удаляются и из памяти, и из базы. Данные должны сериализоваться в JSON.
+    '''
+
+    def __init__(self, db_file_path: str = FSM_STORAGE_FILE, cache_size: int = FSM_CACHE_SIZE,
+                 flush_interval: float = FSM_FLUSH_INTERVAL, ttl: float = FSM_SESSION_TTL,
+                 cleanup_interval: float = FSM_CLEANUP_INTERVAL):
+        self.db_file_path = db_file_path
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self._key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self._cache: "OrderedDict[str, _Session]" = OrderedDict()
+        # Ещё не записанные в базу изменения: ключ -> (state, data в JSON, время)
+        self._pending: Dict[str, Tuple[Optional[str], str, float]] = {}
+        # Изменения, которые прямо сейчас пишутся в базу
+        self._flushing: Dict[str, Tuple[Optional[str], str, float]] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm-sqlite")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._last_cleanup = time.time()
+        self._closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_file_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(FSM_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _load_sync(self, key: str) -> Optional[Tuple[Optional[str], str, float]]:
+        row = self._connect().execute("SELECT state, data, updated_at FROM fsm WHERE key = ?", (key,)).fetchone()
+        return tuple(row) if row else None
+
+    def _write_sync(self, changes: List[Tuple[str, Optional[str], str, float]]) -> None:
+        conn = self._connect()
+        with conn:
+            for key, state, data, updated_at in changes:
+                if state is None and data == "{}":
+                    conn.execute("DELETE FROM fsm WHERE key = ?", (key,))
+                else:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?)",
+                        (key, state, data, updated_at),
+                    )
+
+    def _cleanup_sync(self, expired_before: float) -> None:
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM fsm WHERE updated_at < ?", (expired_before,))
+
+    def _close_sync(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def _session(self, key: StorageKey) -> Tuple[str, _Session]:
+        ''' Сессия из LRU; при промахе - из буфера записи или из базы '''
+        storage_key = self._key_builder.build(key)
+        now = time.time()
+        session = self._cache.get(storage_key)
+        if session is not None and now - session.touched_at <= self.ttl:
+            self._cache.move_to_end(storage_key)
+            metrics.cache("fsm", hit=True)
+            return storage_key, session
+
+        metrics.cache("fsm", hit=False)
+        record = self._pending.get(storage_key) or self._flushing.get(storage_key)
+        if record is None:
+            record = await self._run(self._load_sync, storage_key)
+            # Пока читали базу, сессию могли создать параллельно
+            session = self._cache.get(storage_key)
+            if session is not None:
+                self._cache.move_to_end(storage_key)
+                return storage_key, session
+
+        if record is None or now - record[2] > self.ttl:
+            session = _Session(None, {}, now)
+        else:
+            session = _Session(record[0], json.loads(record[1]), record[2])
+        self._cache[storage_key] = session
+        while len(self._cache) > self.cache_size:
+            # Изменения вытесняемой сессии уже лежат в буфере записи
+            self._cache.popitem(last=False)
+        return storage_key, session
+
+    def _mark_dirty(self, storage_key: str, session: _Session) -> None:
+        session.touched_at = time.time()
+        self._pending[storage_key] = (
+            session.state,
+            json.dumps(session.data, ensure_ascii=False, separators=(",", ":")),
+            session.touched_at,
+        )
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                continue  # Уже залогировано, изменения остались в буфере - повторим
+            if not self._pending:
+                return
+
+    async def flush(self) -> None:
+        ''' Сбрасываем накопленные изменения в базу и заодно чистим устаревшие сессии '''
+        if self._pending:
+            pending, self._pending = self._pending, {}
+            self._flushing = pending
+            changes = [(key, state, data, updated_at) for key, (state, data, updated_at) in pending.items()]
+            try:
+                with metrics.timer("storage_write_seconds", store="fsm"):
+                    await self._run(self._write_sync, changes)
+            except Exception:
+                logger.exception("Не удалось записать сессии FSM, повторим позже")
+                # Более свежие изменения, пришедшие во время записи, не перетираем
+                for key, record in pending.items():
+                    self._pending.setdefault(key, record)
+                raise
+            finally:
+                self._flushing = {}
+
+        now = time.time()
+        if now - self._last_cleanup >= self.cleanup_interval:
+            self._last_cleanup = now
+            self._evict_expired(now)
+            await self._run(self._cleanup_sync, now - self.ttl)
+
+    def _evict_expired(self, now: float) -> None:
+        expired = [key for key, session in self._cache.items() if now - session.touched_at > self.ttl]
+        for key in expired:
+            del self._cache[key]
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key, session = await self._session(key)
+        session.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(storage_key, session)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, session = await self._session(key)
+        return session.state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key, session = await self._session(key)
+        session.data = copy.deepcopy(data)
+        self._mark_dirty(storage_key, session)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, session = await self._session(key)
+        return copy.deepcopy(session.data)
+
+    async def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        await self._run(self._close_sync)
+        self._executor.shutdown(wait=True)
@@ -1,22 +1,28 @@
+import asyncio
+import logging
+
 from aiogram import Router, F
 from aiogram.filters import Command
 from aiogram.types import Message, InlineKeyboardMarkup, CallbackQuery, ReplyKeyboardMarkup
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.methods import SendMessage
 from datetime import date
 
 from data_manager import DataManager
+from handlers.utils import resolve_cart
+from outbound import OutboundDispatcher
 
 common_router = Router()
-data_manager = DataManager()
+logger = logging.getLogger(__name__)
 
 
 class CartStates(StatesGroup):
     viewing_cart = State()
 
 
-async def get_cart_kb() -> InlineKeyboardMarkup:
+def _build_cart_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text="Оформить заказ", callback_data="confirm_order")
     builder.button(text="Очистить корзину", callback_data="clear_cart")
@@ -24,7 +30,7 @@ async def get_cart_kb() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
-async def get_main_menu_kb() -> ReplyKeyboardMarkup:
+def _build_main_menu_kb() -> ReplyKeyboardMarkup:
     builder = ReplyKeyboardBuilder()
     builder.button(text="Товары")
     builder.button(text="Курсы")
@@ -33,12 +39,27 @@ async def get_main_menu_kb() -> ReplyKeyboardMarkup:
     return builder.as_markup(resize_keyboard=True)
 
 
+# Статичные клавиатуры собираются один раз при импорте и общие для всех - не изменять
+CART_KB = _build_cart_kb()
+MAIN_MENU_KB = _build_main_menu_kb()
+
+CART_ITEMS_MISSING = "Некоторые позиции больше недоступны и не будут заказаны"
+
+
+async def get_cart_kb() -> InlineKeyboardMarkup:
+    return CART_KB
+
+
+async def get_main_menu_kb() -> ReplyKeyboardMarkup:
+    return MAIN_MENU_KB
+
+
 @common_router.message(F.text == "Корзина")
 @common_router.message(Command(commands="cart"))
-async def view_cart(message: Message, state: FSMContext):
+async def view_cart(message: Message, state: FSMContext, data_manager: DataManager):
     '''Показ корзины'''
     user_data = await state.get_data()
-    cart = user_data.get("cart", [])
+    cart, missing = await resolve_cart(data_manager, user_data.get("cart", []))
 
     kb = await get_cart_kb()
 
@@ -46,23 +67,32 @@ async def view_cart(message: Message, state: FSMContext):
         await message.answer("Ваша корзина пуста")
         return
 
-    total_price = sum(item["quantity"] * item["price"] for item in cart)
+    total_price = sum(line.quantity * line.price for line in cart)
     response = "Ваша корзина: \n"
-    for item in cart:
-        item_type = "Товар" if item["type"] == "product" else "Курс"
-        response += f" - {item_type}: {item['item']} ({item['quantity']} шт) - {item['quantity'] * item['price']} руб \n"
+    for line in cart:
+        item_type = "Товар" if line.type == "product" else "Курс"
+        response += f" - {item_type}: {line.item} ({line.quantity} шт) - {line.quantity * line.price} руб \n"
 
     response += f"Итого - {total_price} руб"
+    if missing:
+        response += f"\n\n{CART_ITEMS_MISSING}"
 
     await message.answer(response, reply_markup=kb)
     await state.set_state(CartStates.viewing_cart)
 
 
+def _log_delivery_failure(delivery: asyncio.Future) -> None:
+    if not delivery.cancelled() and delivery.exception() is not None:
+        logger.warning("Не удалось отправить подтверждение заказа: %s", delivery.exception())
+
+
 @common_router.callback_query(CartStates.viewing_cart, F.data == "confirm_order")
-async def confirm_order(call: CallbackQuery, state: FSMContext):
+async def confirm_order(call: CallbackQuery, state: FSMContext, data_manager: DataManager,
+                        outbound: OutboundDispatcher):
     '''Подтверждение заказа'''
     user_data = await state.get_data()
-    cart = user_data.get("cart", [])
+    # Цены берутся из каталога на момент оформления
+    cart, _ = await resolve_cart(data_manager, user_data.get("cart", []))
 
     if not cart:
         await call.message.answer("Ваша корзина пуста")
@@ -70,18 +100,23 @@ async def confirm_order(call: CallbackQuery, state: FSMContext):
         return
 
     user_id = call.from_user.id
-    for item in cart:
-        order_data = {
-            "item": item["item"],
-            "type": item["type"],
-            "price": item["price"] * item["quantity"],
+    today = date.today().isoformat()
+    orders_data = [
+        {
+            "item": line.item,
+            "type": line.type,
+            "price": line.price * line.quantity,
             "paid": False,
-            "date": date.today().isoformat()
+            "date": today
         }
-        await data_manager.add_order(user_id, order_data)
+        for line in cart
+    ]
+    await data_manager.add_orders(user_id, orders_data)
 
     await call.message.edit_reply_markup(reply_markup=None)
-    await call.message.answer("Ваш заказ сформирован")
+    # Подтверждение уходит через очередь исходящих, хэндлер не ждёт доставки
+    delivery = outbound.submit(SendMessage(chat_id=call.message.chat.id, text="Ваш заказ сформирован"))
+    delivery.add_done_callback(_log_delivery_failure)
     await state.clear()
     await call.answer()
 
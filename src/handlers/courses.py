@@ -1,14 +1,15 @@
 from aiogram import Router, F
-from aiogram.types import Message, InlineKeyboardMarkup, CallbackQuery, BufferedInputFile
+from aiogram.types import Message, InlineKeyboardMarkup, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
-import os
 
+from catalog import CourseCatalog
 from data_manager import DataManager
 from handlers.common import get_main_menu_kb
+from handlers.utils import keyboard_cache, answer_item_card, edit_item_card, quantity_edits, course_cart_id
+from image_registry import ImageRegistry
 
 MAX_QUANTITY = 5
 ERROR_IMAGE_NOT_FOUND = "\n\n(Изображение курса не найдено)"
@@ -17,10 +18,6 @@ ERROR_QUANTITY_ADJUST_FAILED = "Произошла ошибка при изме
 ERROR_COURSE_NOT_FOUND = "Курс не найден"
 ERROR_COURSE_DATA_MISSING = "Ошибка: данные курса не найдены. Попробуйте выбрать курс заново."
 
-# Определяем базовый путь до корня проекта
-BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-
-data_manager = DataManager()
 courses_router = Router()
 
 # Определение состояний FSM
@@ -39,20 +36,17 @@ def _format_course_description(course_data, quantity: int) -> str:
         f"Хотите изменить количество мест или подтвердить выбор? (максимальное количество мест - {MAX_QUANTITY})"
     )
 
-async def get_courses_kb() -> InlineKeyboardMarkup:
-    """Создает inline-клавиатуру со списком курсов."""
-    courses_data = await data_manager.load_courses_base()
+def _build_courses_kb(catalog: CourseCatalog) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
-    if not courses_data:
+    if not catalog.courses:
         builder.button(text="Курсы отсутствуют", callback_data="no_courses")
     else:
-        for course in courses_data:
+        for course in catalog.courses:
             builder.button(text=course.item, callback_data=f"course_{course.item}")
     builder.adjust(1)
     return builder.as_markup()
 
-async def get_quantity_adjust_kb() -> InlineKeyboardMarkup:
-    """Создает inline-клавиатуру для изменения количества мест."""
+def _build_quantity_adjust_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text="Уменьшить (-1)", callback_data="decrease")
     builder.button(text="Увеличить (+1)", callback_data="increase")
@@ -60,29 +54,41 @@ async def get_quantity_adjust_kb() -> InlineKeyboardMarkup:
     builder.adjust(2)
     return builder.as_markup()
 
+QUANTITY_ADJUST_KB = _build_quantity_adjust_kb()
+
+async def get_courses_kb(data_manager: DataManager) -> InlineKeyboardMarkup:
+    """Создает inline-клавиатуру со списком курсов (кэшируется до перезагрузки каталога)."""
+    catalog = await data_manager.get_courses_catalog()
+    return keyboard_cache.get(("courses",), data_manager.catalog_version, lambda: _build_courses_kb(catalog))
+
+async def get_quantity_adjust_kb() -> InlineKeyboardMarkup:
+    """Inline-клавиатура для изменения количества мест."""
+    return QUANTITY_ADJUST_KB
+
 # Обработчики
 @courses_router.message(F.text == "Курсы")
 @courses_router.message(Command(commands=["courses"]))  # Разделили фильтры на два декоратора
-async def start_course_order(message: Message, state: FSMContext) -> None:
+async def start_course_order(message: Message, state: FSMContext, data_manager: DataManager) -> None:
     """Обработчик для начала заказа курсов через текст 'Курсы' или команду /courses."""
     user_data = await state.get_data()
     if "cart" not in user_data:
         await state.update_data(cart=[])
 
-    kb = await get_courses_kb()
+    kb = await get_courses_kb(data_manager)
     await message.answer("Выберите курс:", reply_markup=kb)
     await state.set_state(None)
 
 @courses_router.callback_query(F.data.startswith("course_"))
-async def select_course(call: CallbackQuery, state: FSMContext) -> None:
+async def select_course(call: CallbackQuery, state: FSMContext, data_manager: DataManager,
+                        image_registry: ImageRegistry) -> None:
     """Обработчик выбора курса."""
     # Сбрасываем состояние перед новым выбором
     await state.set_state(None)
 
     # Извлекаем имя курса из callback_data
     course_name = call.data[len("course_"):]
-    courses_data = await data_manager.load_courses_base()
-    course_data = next((course for course in courses_data if course.item == course_name), None)
+    catalog = await data_manager.get_courses_catalog()
+    course_data = catalog.by_id.get(course_name)
 
     if not course_data:
         await call.message.answer(ERROR_COURSE_NOT_FOUND)
@@ -94,57 +100,25 @@ async def select_course(call: CallbackQuery, state: FSMContext) -> None:
     kb = await get_quantity_adjust_kb()
 
     # Проверяем и отправляем изображение, если оно есть
-    is_photo = False
-    if course_data.image_url:
-        image_path = os.path.join(BASE_DIR, course_data.image_url)
-        if os.path.exists(image_path):
-            try:
-                with open(image_path, "rb") as photo_file:
-                    photo = BufferedInputFile(photo_file.read(), filename=os.path.basename(image_path))
-                await call.message.answer_photo(
-                    photo=photo,
-                    caption=description,
-                    parse_mode="HTML",
-                    reply_markup=kb
-                )
-                is_photo = True
-            except TelegramBadRequest:
-                await call.message.answer(
-                    text=description + ERROR_IMAGE_UPLOAD_FAILED,
-                    parse_mode="HTML",
-                    reply_markup=kb
-                )
-            except Exception:
-                await call.message.answer(
-                    text=description + ERROR_IMAGE_UPLOAD_FAILED,
-                    parse_mode="HTML",
-                    reply_markup=kb
-                )
-        else:
-            await call.message.answer(
-                text=description + ERROR_IMAGE_NOT_FOUND,
-                parse_mode="HTML",
-                reply_markup=kb
-            )
-    else:
-        await call.message.answer(
-            text=description,
-            parse_mode="HTML",
-            reply_markup=kb
-        )
+    is_photo = await answer_item_card(
+        call.message, image_registry, course_data.image_url, description, kb,
+        ERROR_IMAGE_NOT_FOUND, ERROR_IMAGE_UPLOAD_FAILED
+    )
 
-    # Сохраняем данные в состоянии
-    await state.update_data(course_data=course_data, quantity=1, is_photo=is_photo)
+    # В состоянии только id курса (название), описание и цена берутся из каталога при отрисовке
+    await state.update_data(course_id=course_data.item, quantity=1, is_photo=is_photo)
     await state.set_state(CourseOrderStates.adjusting_quantity)
     await call.answer()
 
 @courses_router.callback_query(CourseOrderStates.adjusting_quantity, F.data.in_({"decrease", "increase", "confirm"}))
-async def adjust_quantity(call: CallbackQuery, state: FSMContext) -> None:
+async def adjust_quantity(call: CallbackQuery, state: FSMContext, data_manager: DataManager) -> None:
     """Обработчик изменения количества мест или подтверждения."""
     # Проверяем наличие данных курса
     user_data = await state.get_data()
     quantity = user_data.get("quantity", 1)
-    course_data = user_data.get("course_data")
+    course_id = user_data.get("course_id")
+    catalog = await data_manager.get_courses_catalog()
+    course_data = catalog.by_id.get(course_id) if course_id else None
     is_photo = user_data.get("is_photo", False)
 
     if not course_data:
@@ -164,44 +138,29 @@ async def adjust_quantity(call: CallbackQuery, state: FSMContext) -> None:
             await call.answer()
             return
 
+        # Состояние обновляем сразу, а карточку перерисовываем одним редактированием после серии нажатий
         await state.update_data(quantity=quantity)
         description = _format_course_description(course_data, quantity)
-
-        try:
-            if is_photo:
-                await call.message.edit_caption(
-                    caption=description,
-                    parse_mode="HTML",
-                    reply_markup=kb
-                )
-            else:
-                await call.message.edit_text(
-                    text=description,
-                    parse_mode="HTML",
-                    reply_markup=kb
-                )
-        except Exception:
-            await call.message.answer(
-                text=ERROR_QUANTITY_ADJUST_FAILED,
-                reply_markup=kb
-            )
+        message = call.message
+        quantity_edits.schedule(
+            (message.chat.id, message.message_id),
+            lambda: edit_item_card(message, is_photo, description, kb, ERROR_QUANTITY_ADJUST_FAILED)
+        )
         await call.answer()
         return
 
     # Подтверждение выбора
     if call.data == "confirm":
-        cart = user_data["cart"]
-        cart.append({
-            "item": course_data.item,
-            "type": "course",
-            "quantity": quantity,
-            "price": course_data.price,
-            "callback_data": f"course_{course_data.item}",
-            "description": course_data.description
-        })
-
-        await state.update_data(cart=cart)
-        await call.message.edit_reply_markup(reply_markup=None)
+        cart = user_data.get("cart", [])
+        cart.append([course_cart_id(course_data.item), quantity])
+
+        await state.update_data(cart=cart, course_id=None)
+        if await quantity_edits.cancel((call.message.chat.id, call.message.message_id)):
+            # Карточка ещё не перерисована - показываем итоговое количество и убираем кнопки одним запросом
+            description = _format_course_description(course_data, quantity)
+            await edit_item_card(call.message, is_photo, description, None, ERROR_QUANTITY_ADJUST_FAILED)
+        else:
+            await call.message.edit_reply_markup(reply_markup=None)
         await call.message.answer(
             f"Курс '{course_data.item}' ({quantity} шт.) добавлен в корзину. Хотите продолжить?",
             reply_markup=await get_main_menu_kb()
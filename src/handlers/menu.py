@@ -1,21 +1,19 @@
 from aiogram import Router, F
-from aiogram.types import Message, InlineKeyboardMarkup, CallbackQuery, BufferedInputFile
+from aiogram.types import Message, InlineKeyboardMarkup, CallbackQuery
 from aiogram.filters import Command
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.exceptions import TelegramBadRequest
-import os
 
+from catalog import CatalogItem, ProductCatalog
 from data_manager import DataManager
 from handlers.common import get_main_menu_kb
+from handlers.utils import keyboard_cache, answer_item_card, edit_item_card, quantity_edits, product_cart_id
+from image_registry import ImageRegistry
 
-data_manager = DataManager()
 menu_router = Router()
 
 
-BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-
 MAX_QUANTITY = 5
 ERROR_IMAGE_NOT_FOUND = "\n\n(Изображение товара не найдено)"
 ERROR_IMAGE_UPLOAD_FAILED = "\n\n(Не удалось загрузить изображение товара)"
@@ -28,39 +26,33 @@ class OrderStates(StatesGroup):
     adjusting_quantity = State() 
 
 
-def _format_item_description(item_data, quantity: int) -> str:
+def _format_item_description(item: CatalogItem, quantity: int) -> str:
     """Форматирует описание товара с указанием количества."""
     return (
-        f"<b>{item_data['item']}</b>\n"
-        f"<b>Стоимость:</b> {item_data['price']} руб.\n\n"
-        f"Вы выбрали '{item_data['item']}'. Количество: {quantity}\n"
+        f"<b>{item.item}</b>\n"
+        f"<b>Стоимость:</b> {item.price} руб.\n\n"
+        f"Вы выбрали '{item.item}'. Количество: {quantity}\n"
         f"Хотите изменить количество или подтвердить выбор? (максимум {MAX_QUANTITY} шт.)"
     )
 
 
-async def get_category_kb() -> InlineKeyboardMarkup:
-    """Генерирует inline-клавиатуру с категориями."""
-    products_data = await data_manager.load_products_base()
+def _build_category_kb(catalog: ProductCatalog) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
-    for category in products_data:
-        builder.button(text=category["name"], callback_data=category["category"])
+    for category in catalog.categories:
+        builder.button(text=category.name, callback_data=category.category)
     builder.adjust(1)
     return builder.as_markup()
 
-async def get_item_kb(category_callback: str) -> InlineKeyboardMarkup:
-    """Генерирует inline-клавиатуру с товарами."""
-    products_data = await data_manager.load_products_base()
+def _build_item_kb(catalog: ProductCatalog, category_callback: str) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
-    for category in products_data:
-        if category["category"] == category_callback:
-            for item in category["items"]:
-                builder.button(text=item["item"], callback_data=item["callback_data"])
-            break
+    category = catalog.by_category.get(category_callback)
+    if category is not None:
+        for item in category.items:
+            builder.button(text=item.item, callback_data=item.callback_data)
     builder.adjust(2)
     return builder.as_markup()
 
-async def get_quantity_adjust_kb() -> InlineKeyboardMarkup:
-    """Создает inline-клавиатуру для изменения количества товаров."""
+def _build_quantity_adjust_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text="Уменьшить (-1)", callback_data="decrease")
     builder.button(text="Увеличить (+1)", callback_data="increase")
@@ -68,16 +60,36 @@ async def get_quantity_adjust_kb() -> InlineKeyboardMarkup:
     builder.adjust(2)
     return builder.as_markup()
 
+QUANTITY_ADJUST_KB = _build_quantity_adjust_kb()
+
+
+async def get_category_kb(data_manager: DataManager) -> InlineKeyboardMarkup:
+    """Генерирует inline-клавиатуру с категориями (кэшируется до перезагрузки каталога)."""
+    catalog = await data_manager.get_products_catalog()
+    return keyboard_cache.get(("categories",), data_manager.catalog_version, lambda: _build_category_kb(catalog))
+
+async def get_item_kb(data_manager: DataManager, category_callback: str) -> InlineKeyboardMarkup:
+    """Генерирует inline-клавиатуру с товарами (кэшируется до перезагрузки каталога)."""
+    catalog = await data_manager.get_products_catalog()
+    return keyboard_cache.get(
+        ("items", category_callback), data_manager.catalog_version,
+        lambda: _build_item_kb(catalog, category_callback)
+    )
+
+async def get_quantity_adjust_kb() -> InlineKeyboardMarkup:
+    """Inline-клавиатура для изменения количества товаров."""
+    return QUANTITY_ADJUST_KB
+
 
 @menu_router.message(F.text == "Товары")
 @menu_router.message(Command(commands="order"))
-async def start_order(message: Message, state: FSMContext):
+async def start_order(message: Message, state: FSMContext, data_manager: DataManager):
     """Обработчик команды /order или текста 'Товары'."""
     user_data = await state.get_data()
     if "cart" not in user_data:
         await state.update_data(cart=[])
 
-    kb = await get_category_kb()
+    kb = await get_category_kb(data_manager)
     if not kb.inline_keyboard:
         await message.answer("Извините, товары временно недоступны.", reply_markup=await get_main_menu_kb())
         return
@@ -85,12 +97,16 @@ async def start_order(message: Message, state: FSMContext):
     await message.answer("Выберите категорию:", reply_markup=kb)
     await state.set_state(None)
 
-@menu_router.callback_query(F.data.in_({"cupcake", "cake", "bouquet"}))
-async def order_item(call: CallbackQuery, state: FSMContext):
+async def is_product_category(call: CallbackQuery, data_manager: DataManager) -> bool:
+    """Фильтр: нажата кнопка категории из каталога."""
+    catalog = await data_manager.get_products_catalog()
+    return call.data in catalog.by_category
+
+
+@menu_router.callback_query(is_product_category)
+async def order_item(call: CallbackQuery, state: FSMContext, data_manager: DataManager):
     """Обработчик выбора категории."""
-    category = call.data
-    await state.update_data(category=category)
-    kb = await get_item_kb(category)
+    kb = await get_item_kb(data_manager, call.data)
     if not kb.inline_keyboard:
         await call.message.answer("В этой категории нет товаров.", reply_markup=await get_main_menu_kb())
         await call.answer()
@@ -100,83 +116,42 @@ async def order_item(call: CallbackQuery, state: FSMContext):
     await call.answer()
 
 @menu_router.callback_query(OrderStates.choosing_item)
-async def select_item(call: CallbackQuery, state: FSMContext):
+async def select_item(call: CallbackQuery, state: FSMContext, data_manager: DataManager,
+                      image_registry: ImageRegistry):
     """Обработчик выбора товара."""
-    item_callback = call.data
-    products_data = await data_manager.load_products_base()
-    item_data = None
-    user_data = await state.get_data()
-    category_data = user_data.get("category")
-
-    for categ in products_data:
-        if categ["category"] == category_data:
-            for item in categ["items"]:
-                if item["callback_data"] == item_callback:
-                    item_data = item
-                    break
-            break
+    catalog = await data_manager.get_products_catalog()
+    item = catalog.by_callback.get(call.data)
 
-    if not item_data:
+    if item is None:
         await call.message.answer(ERROR_ITEM_NOT_FOUND, reply_markup=await get_main_menu_kb())
         await call.answer()
         return
 
-    description = _format_item_description(item_data, quantity=1)
+    description = _format_item_description(item, quantity=1)
     kb = await get_quantity_adjust_kb()
 
-    is_photo = False
-    if item_data.get("image_url"):
-        image_path = os.path.join(BASE_DIR, item_data["image_url"])
-        if os.path.exists(image_path):
-            try:
-                with open(image_path, "rb") as photo_file:
-                    photo = BufferedInputFile(photo_file.read(), filename=os.path.basename(image_path))
-                await call.message.answer_photo(
-                    photo=photo,
-                    caption=description,
-                    parse_mode="HTML",
-                    reply_markup=kb
-                )
-                is_photo = True
-            except TelegramBadRequest:
-                await call.message.answer(
-                    text=description + ERROR_IMAGE_UPLOAD_FAILED,
-                    parse_mode="HTML",
-                    reply_markup=kb
-                )
-            except Exception:
-                await call.message.answer(
-                    text=description + ERROR_IMAGE_UPLOAD_FAILED,
-                    parse_mode="HTML",
-                    reply_markup=kb
-                )
-        else:
-            await call.message.answer(
-                text=description + ERROR_IMAGE_NOT_FOUND,
-                parse_mode="HTML",
-                reply_markup=kb
-            )
-    else:
-        await call.message.answer(
-            text=description,
-            parse_mode="HTML",
-            reply_markup=kb
-        )
+    is_photo = await answer_item_card(
+        call.message, image_registry, item.image_url, description, kb,
+        ERROR_IMAGE_NOT_FOUND, ERROR_IMAGE_UPLOAD_FAILED
+    )
 
-    await state.update_data(item_data=item_data, quantity=1, is_photo=is_photo)
+    # В состоянии только id товара, название и цена берутся из каталога при отрисовке
+    await state.update_data(item_id=item.callback_data, quantity=1, is_photo=is_photo)
     await state.set_state(OrderStates.adjusting_quantity)
     await call.answer()
 
 @menu_router.callback_query(OrderStates.adjusting_quantity, F.data.in_({"decrease", "increase", "confirm"}))
-async def adjust_quantity(call: CallbackQuery, state: FSMContext):
+async def adjust_quantity(call: CallbackQuery, state: FSMContext, data_manager: DataManager):
     """Обработчик изменения количества товаров или подтверждения."""
     # Проверяем наличие данных товара
     user_data = await state.get_data()
     quantity = user_data.get("quantity", 1)
-    item_data = user_data.get("item_data")
+    item_id = user_data.get("item_id")
     is_photo = user_data.get("is_photo", False)
+    catalog = await data_manager.get_products_catalog()
+    item = catalog.by_callback.get(item_id) if item_id else None
 
-    if not item_data:
+    if item is None:
         await call.message.answer(ERROR_ITEM_DATA_MISSING, reply_markup=await get_main_menu_kb())
         await state.set_state(None)
         await call.answer()
@@ -193,45 +168,31 @@ async def adjust_quantity(call: CallbackQuery, state: FSMContext):
             await call.answer()
             return
 
+        # Состояние обновляем сразу, а карточку перерисовываем одним редактированием после серии нажатий
         await state.update_data(quantity=quantity)
-        description = _format_item_description(item_data, quantity)
-
-        try:
-            if is_photo:
-                await call.message.edit_caption(
-                    caption=description,
-                    parse_mode="HTML",
-                    reply_markup=kb
-                )
-            else:
-                await call.message.edit_text(
-                    text=description,
-                    parse_mode="HTML",
-                    reply_markup=kb
-                )
-        except Exception:
-            await call.message.answer(
-                text=ERROR_QUANTITY_ADJUST_FAILED,
-                reply_markup=kb
-            )
+        description = _format_item_description(item, quantity)
+        message = call.message
+        quantity_edits.schedule(
+            (message.chat.id, message.message_id),
+            lambda: edit_item_card(message, is_photo, description, kb, ERROR_QUANTITY_ADJUST_FAILED)
+        )
         await call.answer()
         return
 
     # Подтверждение выбора
     if call.data == "confirm":
-        cart = user_data["cart"]
-        cart.append({
-            "item": item_data["item"],
-            "type": "product",
-            "quantity": quantity,
-            "price": item_data["price"],
-            "callback_data": item_data["callback_data"]
-        })
-
-        await state.update_data(cart=cart)
-        await call.message.edit_reply_markup(reply_markup=None)
+        cart = user_data.get("cart", [])
+        cart.append([product_cart_id(item.callback_data), quantity])
+
+        await state.update_data(cart=cart, item_id=None)
+        if await quantity_edits.cancel((call.message.chat.id, call.message.message_id)):
+            # Карточка ещё не перерисована - показываем итоговое количество и убираем кнопки одним запросом
+            description = _format_item_description(item, quantity)
+            await edit_item_card(call.message, is_photo, description, None, ERROR_QUANTITY_ADJUST_FAILED)
+        else:
+            await call.message.edit_reply_markup(reply_markup=None)
         await call.message.answer(
-            f"Товар '{item_data['item']}' ({quantity} шт.) добавлен в корзину. Хотите продолжить?",
+            f"Товар '{item.item}' ({quantity} шт.) добавлен в корзину. Хотите продолжить?",
             reply_markup=await get_main_menu_kb()
         )
         await state.set_state(None)
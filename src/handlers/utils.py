@@ -0,0 +1,204 @@
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message, InlineKeyboardMarkup, BufferedInputFile
+from typing import Awaitable, Callable, Dict, Hashable, List, NamedTuple, Optional, Tuple, TypeVar
+import asyncio
+import logging
+import os
+
+from data_manager import DataManager
+from image_registry import ImageRegistry
+from metrics import metrics
+
+Markup = TypeVar("Markup")
+
+# Сколько секунд тишины ждём после нажатия +/- перед тем, как перерисовать карточку
+QUANTITY_EDIT_DELAY = 0.4
+
+logger = logging.getLogger(__name__)
+
+
+class KeyboardCache:
+    """
+    Кэш готовых клавиатур, зависящих от каталога. Каждая запись помнит версию каталога,
+    из которой построена; после reload_products/reload_courses версия меняется и
+    клавиатура пересобирается при первом обращении.
+    Клавиатуры общие для всех пользователей - изменять их после получения нельзя.
+    """
+
+    def __init__(self):
+        self._entries: Dict[Hashable, Tuple[int, object]] = {}
+
+    def get(self, key: Hashable, version: int, build: Callable[[], Markup]) -> Markup:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            metrics.cache("keyboards", hit=True)
+            return entry[1]
+
+        metrics.cache("keyboards", hit=False)
+        markup = build()
+        self._entries[key] = (version, markup)
+        return markup
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+keyboard_cache = KeyboardCache()
+
+
+class EditDebouncer:
+    """
+    Откладывает редактирование сообщения до паузы в нажатиях: каждое новое изменение
+    по тому же ключу (чат, сообщение) отменяет ещё не выполненное и заново отсчитывает delay.
+    Серия быстрых нажатий превращается в одно редактирование с последним значением.
+    """
+
+    def __init__(self, delay: float = QUANTITY_EDIT_DELAY):
+        self.delay = delay
+        self._pending: Dict[Hashable, asyncio.TimerHandle] = {}
+        self._running: Dict[Hashable, asyncio.Task] = {}
+
+    def schedule(self, key: Hashable, edit: Callable[[], Awaitable[None]]) -> None:
+        handle = self._pending.pop(key, None)
+        if handle is not None:
+            handle.cancel()
+        loop = asyncio.get_running_loop()
+        self._pending[key] = loop.call_later(self.delay, self._fire, key, edit)
+
+    async def cancel(self, key: Hashable) -> bool:
+        """
+        Отменяет отложенное редактирование и дожидается уже начатого, чтобы оно
+        не легло поверх следующего. True, если отложенное редактирование было.
+        """
+        handle = self._pending.pop(key, None)
+        if handle is not None:
+            handle.cancel()
+        task = self._running.get(key)
+        if task is not None:
+            await asyncio.wait([task])
+        return handle is not None
+
+    def _fire(self, key: Hashable, edit: Callable[[], Awaitable[None]]) -> None:
+        self._pending.pop(key, None)
+        task = asyncio.create_task(self._run(edit))
+        self._running[key] = task
+        task.add_done_callback(lambda done: self._running.pop(key, None) if self._running.get(key) is done else None)
+
+    @staticmethod
+    async def _run(edit: Callable[[], Awaitable[None]]) -> None:
+        try:
+            await edit()
+        except Exception:
+            logger.exception("Не удалось отредактировать сообщение")
+
+
+quantity_edits = EditDebouncer()
+
+
+async def edit_item_card(message: Message, is_photo: bool, description: str,
+                         reply_markup: Optional[InlineKeyboardMarkup], error_text: str) -> None:
+    """Перерисовывает карточку товара или курса (подпись к фото или текст)."""
+    try:
+        if is_photo:
+            await message.edit_caption(caption=description, parse_mode="HTML", reply_markup=reply_markup)
+        else:
+            await message.edit_text(text=description, parse_mode="HTML", reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            return  # Количество вернулось к уже показанному
+        await message.answer(text=error_text, reply_markup=reply_markup)
+    except Exception:
+        await message.answer(text=error_text, reply_markup=reply_markup)
+
+
+# Корзина в состоянии FSM - список пар [id позиции в каталоге, количество].
+# id товара - его callback_data, id курса - название; префикс отличает одно от другого
+PRODUCT_ID_PREFIX = "p:"
+COURSE_ID_PREFIX = "c:"
+
+
+def product_cart_id(callback_data: str) -> str:
+    return PRODUCT_ID_PREFIX + callback_data
+
+
+def course_cart_id(course_name: str) -> str:
+    return COURSE_ID_PREFIX + course_name
+
+
+class CartLine(NamedTuple):
+    """Позиция корзины с данными из текущего каталога (price - цена за штуку)."""
+    item: str
+    type: str
+    price: int
+    quantity: int
+
+
+async def resolve_cart(data_manager: DataManager, cart: List[list]) -> Tuple[List[CartLine], int]:
+    """
+    Подставляет в корзину названия и цены из каталога. Возвращает позиции и число
+    пропущенных - тех, что за это время пропали из каталога.
+    """
+    products = await data_manager.get_products_catalog()
+    courses = await data_manager.get_courses_catalog()
+
+    lines = []
+    missing = 0
+    for entry in cart:
+        item_id, quantity = entry if isinstance(entry, (list, tuple)) else (None, 0)
+        if item_id and item_id.startswith(PRODUCT_ID_PREFIX):
+            product = products.by_callback.get(item_id[len(PRODUCT_ID_PREFIX):])
+            if product is not None:
+                lines.append(CartLine(product.item, "product", product.price, quantity))
+                continue
+        elif item_id and item_id.startswith(COURSE_ID_PREFIX):
+            course = courses.by_id.get(item_id[len(COURSE_ID_PREFIX):])
+            if course is not None:
+                lines.append(CartLine(course.item, "course", course.price, quantity))
+                continue
+        missing += 1
+    return lines, missing
+
+
+async def answer_item_card(
+    message: Message,
+    image_registry: ImageRegistry,
+    image_url: Optional[str],
+    description: str,
+    reply_markup: InlineKeyboardMarkup,
+    error_image_not_found: str,
+    error_image_upload_failed: str,
+) -> bool:
+    """
+    Отправляет карточку товара или курса: фото с подписью, если картинка есть, иначе текст.
+    Картинка уходит по сохранённому file_id, а загружается с диска только в первый раз
+    или после изменения файла. Возвращает True, если отправлено фото.
+    """
+    if not image_url:
+        await message.answer(text=description, parse_mode="HTML", reply_markup=reply_markup)
+        return False
+
+    file_id = image_registry.get_file_id(image_url)
+    if file_id is not None:
+        try:
+            await message.answer_photo(photo=file_id, caption=description, parse_mode="HTML", reply_markup=reply_markup)
+            return True
+        except TelegramBadRequest:
+            # file_id больше не принимается - забываем его и загружаем файл заново
+            await image_registry.forget(image_url)
+
+    image_path = image_registry.resolve(image_url)
+    if not os.path.exists(image_path):
+        await message.answer(text=description + error_image_not_found, parse_mode="HTML", reply_markup=reply_markup)
+        return False
+
+    try:
+        with open(image_path, "rb") as photo_file:
+            photo = BufferedInputFile(photo_file.read(), filename=os.path.basename(image_path))
+        sent = await message.answer_photo(photo=photo, caption=description, parse_mode="HTML", reply_markup=reply_markup)
+    except Exception:
+        await message.answer(text=description + error_image_upload_failed, parse_mode="HTML", reply_markup=reply_markup)
+        return False
+
+    if sent.photo:
+        await image_registry.remember(image_url, sent.photo[-1].file_id)
+    return True
@@ -0,0 +1,89 @@
+import aiofiles
+import asyncio
+import json
+import os
+from typing import Dict, Optional
+
+from metrics import metrics
+from order_journal import write_file_atomic
+
+
+IMAGES_REGISTRY_FILE = "../data/images.json"
+# Пути картинок в products.json / courses.json указаны относительно папки src
+IMAGES_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class ImageRegistry:
+    '''
+    Реестр file_id картинок, уже загруженных в Telegram (ключ - image_url из каталога).
+    После первой загрузки файла запоминаем file_id, который вернул Telegram, и дальше
+    отправляем по нему, не читая и не выгружая файл заново. Запись действительна, пока у файла не изменились
+    время модификации и размер. Реестр хранится в images.json и переживает перезапуск.
+    file_id привязан к боту, поэтому при смене токена файл реестра нужно удалить.
+    '''
+
+    def __init__(self, registry_file_path: str = IMAGES_REGISTRY_FILE, base_dir: str = IMAGES_BASE_DIR):
+        self.registry_file_path = registry_file_path
+        self.base_dir = base_dir
+        self._entries: Dict[str, dict] = {}
+        self._lock = asyncio.Lock()
+
+    async def load(self) -> None:
+        ''' Загружаем реестр с диска (битый или отсутствующий файл - пустой реестр) '''
+        if not os.path.exists(self.registry_file_path):
+            self._entries = {}
+            return
+
+        try:
+            async with aiofiles.open(self.registry_file_path, mode='r', encoding='utf-8') as f:
+                content = await f.read()
+            self._entries = json.loads(content) if content.strip() else {}
+        except (json.JSONDecodeError, OSError):
+            self._entries = {}
+
+    def resolve(self, image_url: str) -> str:
+        ''' Путь к файлу картинки на диске '''
+        return os.path.join(self.base_dir, image_url)
+
+    def _fingerprint(self, image_url: str) -> Optional[dict]:
+        try:
+            stat = os.stat(self.resolve(image_url))
+        except OSError:
+            return None
+        return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+    def get_file_id(self, image_url: str) -> Optional[str]:
+        ''' file_id для картинки, если она уже загружалась и с тех пор не менялась '''
+        entry = self._entries.get(image_url)
+        if entry is None:
+            metrics.cache("images", hit=False)
+            return None
+
+        fingerprint = self._fingerprint(image_url)
+        if fingerprint is None or fingerprint["mtime_ns"] != entry["mtime_ns"] or fingerprint["size"] != entry["size"]:
+            metrics.cache("images", hit=False)
+            return None
+        metrics.cache("images", hit=True)
+        return entry["file_id"]
+
+    async def remember(self, image_url: str, file_id: str) -> None:
+        ''' Запоминаем file_id после загрузки картинки '''
+        fingerprint = self._fingerprint(image_url)
+        if fingerprint is None:
+            return
+
+        self._entries[image_url] = {"file_id": file_id, **fingerprint}
+        await self._save()
+
+    async def forget(self, image_url: str) -> None:
+        ''' Убираем запись (например, Telegram перестал принимать file_id) '''
+        if self._entries.pop(image_url, None) is not None:
+            await self._save()
+
+    async def _save(self) -> None:
+        async with self._lock:
+            await write_file_atomic(
+                self.registry_file_path,
+                json.dumps(self._entries, indent=4, ensure_ascii=False),
+                store="images",
+            )
@@ -0,0 +1,158 @@
+'''
+Реестр метрик процесса. Модуль без зависимостей от aiogram/aiohttp, чтобы хранилища
+и офлайн-утилиты могли считать метрики, не подтягивая фреймворк бота. Middleware
+лежат в middlewares/metrics.py, HTTP-сервер /metrics - в metrics_server.py.
+'''
+import bisect
+import contextlib
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+# Границы корзин гистограмм длительности, секунды
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+API_CALLS_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+# Описания метрик для /metrics: имя -> (тип, описание)
+METRICS_HELP = {
+    "bot_update_seconds": ("histogram", "Время обработки обновления целиком"),
+    "bot_update_api_calls": ("histogram", "Вызовов Bot API, сделанных прямо из обработки одного обновления"),
+    "bot_handler_seconds": ("histogram", "Время работы хэндлера"),
+    "bot_api_calls_total": ("counter", "Вызовы Bot API"),
+    "bot_api_call_seconds": ("histogram", "Время вызова Bot API"),
+    "storage_read_seconds": ("histogram", "Время чтения хранилища"),
+    "storage_write_seconds": ("histogram", "Время записи в хранилище"),
+    "storage_query_seconds": ("histogram", "Время запроса к базе заказов"),
+    "storage_read_bytes_total": ("counter", "Прочитано байт из файлов хранилища"),
+    "storage_written_bytes_total": ("counter", "Записано байт в файлы хранилища"),
+    "cache_requests_total": ("counter", "Обращения к кэшам (result=hit|miss)"),
+    "outbound_jobs_total": ("counter", "Задания очереди исходящих сообщений"),
+}
+
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class _Timer:
+    __slots__ = ("registry", "name", "labels", "started")
+
+    def __init__(self, registry: "MetricsRegistry", name: str, labels: Dict[str, Any]):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+_NULL_TIMER = contextlib.nullcontext()
+
+
+class MetricsRegistry:
+    '''
+    Счётчики и гистограммы в памяти процесса с выдачей в текстовом формате Prometheus.
+    Пока метрики выключены (по умолчанию), каждый вызов - одна проверка флага,
+    а timer() возвращает общий пустой контекстный менеджер.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self._counters: Dict[str, Dict[LabelsKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelsKey, _Histogram]] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {"bot_update_api_calls": API_CALLS_BUCKETS}
+
+    @staticmethod
+    def _key(labels: Dict[str, Any]) -> LabelsKey:
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        if not self.enabled:
+            return
+        series = self._counters.setdefault(name, {})
+        key = self._key(labels)
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        if not self.enabled:
+            return
+        series = self._histograms.setdefault(name, {})
+        key = self._key(labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = _Histogram(self._buckets.get(name, DEFAULT_BUCKETS))
+        histogram.observe(value)
+
+    def timer(self, name: str, **labels: Any):
+        ''' with metrics.timer("storage_read_seconds", file="orders"): ... '''
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def count_bytes(self, name: str, content, **labels: Any) -> None:
+        ''' Счётчик байт; строка кодируется в UTF-8 только при включённых метриках '''
+        if not self.enabled:
+            return
+        size = len(content.encode("utf-8")) if isinstance(content, str) else len(content)
+        self.inc(name, size, **labels)
+
+    def cache(self, cache_name: str, hit: bool) -> None:
+        if not self.enabled:
+            return
+        self.inc("cache_requests_total", cache=cache_name, result="hit" if hit else "miss")
+
+    @staticmethod
+    def _format_labels(key: LabelsKey, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(key) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        escaped = (
+            '{}="{}"'.format(name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for name, value in pairs
+        )
+        return "{" + ",".join(escaped) + "}"
+
+    def _header(self, name: str, kind: str) -> List[str]:
+        help_text = METRICS_HELP.get(name, (kind, name))[1]
+        return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+
+    def render(self) -> str:
+        ''' Все метрики в текстовом формате Prometheus '''
+        lines: List[str] = []
+        for name, series in sorted(self._counters.items()):
+            lines.extend(self._header(name, "counter"))
+            for key, value in series.items():
+                lines.append(f"{name}{self._format_labels(key)} {value:g}")
+
+        for name, series in sorted(self._histograms.items()):
+            lines.extend(self._header(name, "histogram"))
+            for key, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._format_labels(key, ('le', f'{bound:g}'))} {cumulative}")
+                lines.append(f"{name}_bucket{self._format_labels(key, ('le', '+Inf'))} {histogram.count}")
+                lines.append(f"{name}_sum{self._format_labels(key)} {histogram.total:g}")
+                lines.append(f"{name}_count{self._format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
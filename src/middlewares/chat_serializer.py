@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, Hashable, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+
+# Сколько обновлений одного чата может ждать своей очереди; лишние отбрасываются
+MAX_CHAT_QUEUE_DEPTH = 5
+# Кнопки, каждое нажатие которых что-то меняет (+1 / -1): их нельзя схлопывать как дубли
+REPEATABLE_CALLBACKS = frozenset({"increase", "decrease"})
+
+logger = logging.getLogger(__name__)
+
+
+class _ChatQueue:
+    __slots__ = ("lock", "depth", "waiting_callbacks")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.depth = 0
+        # Сообщения, на которых ждёт очереди нажатие, меняющее или закрывающее сообщение
+        # (подтверждение, выбор категории и т.п.) и ещё не начавшее обрабатываться
+        self.waiting_callbacks: Counter = Counter()
+
+
+class ChatSerializerMiddleware(BaseMiddleware):
+    '''
+    Внешний middleware на обновления: обновления разных чатов обрабатываются параллельно,
+    а одного чата - строго по очереди (FIFO-замок на чат). Так get_data -> изменить корзину ->
+    update_data в хэндлерах не перемешиваются при быстрых нажатиях, а медленная загрузка
+    картинки одному пользователю не задерживает остальных.
+    Очередь чата ограничена max_depth. Нажатия repeatable-кнопок (+1 / -1) встают в очередь
+    все. Остальные кнопки меняют или закрывают своё сообщение, поэтому пока такое нажатие
+    ждёт очереди, следующие нажатия на том же сообщении устарели и отбрасываются.
+    '''
+
+    def __init__(self, max_depth: int = MAX_CHAT_QUEUE_DEPTH,
+                 repeatable_callbacks: FrozenSet[str] = REPEATABLE_CALLBACKS):
+        self.max_depth = max_depth
+        self.repeatable_callbacks = repeatable_callbacks
+        self._chats: Dict[Hashable, _ChatQueue] = {}
+
+    @staticmethod
+    def _chat_key(data: Dict[str, Any]) -> Optional[Hashable]:
+        chat = data.get("event_chat")
+        if chat is not None:
+            return chat.id
+        user = data.get("event_from_user")
+        return ("user", user.id) if user is not None else None
+
+    @staticmethod
+    def _callback_message(event: Update) -> Optional[Hashable]:
+        call = event.callback_query
+        if call is None:
+            return None
+        return call.message.message_id if call.message else call.inline_message_id
+
+    async def _drop(self, event: Update, data: Dict[str, Any], reason: str) -> None:
+        logger.info("Отбрасываем обновление %s: %s", event.update_id, reason)
+        if event.callback_query is not None:
+            # Убираем "часики" на кнопке, иначе клиент будет ждать ответа
+            try:
+                await data["bot"].answer_callback_query(event.callback_query.id)
+            except Exception:
+                pass
+
+    @staticmethod
+    def _stop_waiting(queue: _ChatQueue, callback_key: Optional[Hashable]) -> None:
+        if callback_key is None:
+            return
+        queue.waiting_callbacks[callback_key] -= 1
+        if not queue.waiting_callbacks[callback_key]:
+            del queue.waiting_callbacks[callback_key]
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        chat_key = self._chat_key(data) if isinstance(event, Update) else None
+        if chat_key is None:
+            return await handler(event, data)
+
+        queue = self._chats.get(chat_key)
+        if queue is None:
+            queue = self._chats[chat_key] = _ChatQueue()
+
+        message_key = self._callback_message(event)
+        if message_key is not None and queue.waiting_callbacks[message_key]:
+            await self._drop(event, data, "нажатие на сообщении, которое уже меняется")
+            return None
+        if queue.depth >= self.max_depth:
+            await self._drop(event, data, f"очередь чата {chat_key} переполнена")
+            return None
+
+        callback_key = None
+        if message_key is not None and event.callback_query.data not in self.repeatable_callbacks:
+            callback_key = message_key
+        queue.depth += 1
+        waiting = callback_key is not None
+        if waiting:
+            queue.waiting_callbacks[callback_key] += 1
+        try:
+            async with queue.lock:
+                waiting = False
+                self._stop_waiting(queue, callback_key)
+                return await handler(event, data)
+        finally:
+            if waiting:  # Отменили, пока ждали очереди
+                self._stop_waiting(queue, callback_key)
+            queue.depth -= 1
+            if queue.depth == 0:
+                del self._chats[chat_key]
@@ -0,0 +1,88 @@
+import contextvars
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from aiogram.types import TelegramObject, Update
+
+from metrics import metrics
+
+
+# Сколько вызовов Bot API сделала обработка текущего обновления
+_update_api_calls: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar("update_api_calls", default=None)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    ''' Внешний middleware на обновления: время обработки и число вызовов Bot API на обновление '''
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not metrics.enabled or not isinstance(event, Update):
+            return await handler(event, data)
+
+        calls = [0]
+        token = _update_api_calls.set(calls)
+        update_type = event.event_type
+        try:
+            with metrics.timer("bot_update_seconds", type=update_type):
+                return await handler(event, data)
+        finally:
+            _update_api_calls.reset(token)
+            metrics.observe("bot_update_api_calls", calls[0], type=update_type)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    ''' Middleware на сообщения и нажатия кнопок роутера: время работы каждого хэндлера '''
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not metrics.enabled:
+            return await handler(event, data)
+
+        # Полное имя: одноимённые хэндлеры есть в разных модулях (adjust_quantity в menu и courses)
+        callback = getattr(data.get("handler"), "callback", None)
+        name = f"{callback.__module__}.{callback.__qualname__}" if callback is not None else "unknown"
+        with metrics.timer("bot_handler_seconds", handler=name):
+            return await handler(event, data)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    ''' Middleware сессии Bot API: число и время вызовов по методам '''
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        if not metrics.enabled:
+            return await make_request(bot, method)
+
+        method_name = type(method).__name__
+        metrics.inc("bot_api_calls_total", method=method_name)
+        calls = _update_api_calls.get()
+        if calls is not None:
+            calls[0] += 1
+        with metrics.timer("bot_api_call_seconds", method=method_name):
+            return await make_request(bot, method)
+
+
+def setup_metrics(bot: Bot, dp: Dispatcher, routers: List[Router]) -> None:
+    ''' Включаем метрики и подключаем middleware к диспетчеру, роутерам и сессии бота '''
+    metrics.enabled = True
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    handler_middleware = HandlerMetricsMiddleware()
+    for router in routers:
+        router.message.middleware(handler_middleware)
+        router.callback_query.middleware(handler_middleware)
+    bot.session.middleware(ApiMetricsMiddleware())
@@ -0,0 +1,42 @@
+import argparse
+import asyncio
+import os
+
+from order_storage import JournalOrderStorage, ShardedOrderStorage, SqliteOrderStorage
+
+
+async def migrate(orders_file_path: str, target_path: str, target: str = "sqlite") -> int:
+    '''
+    Переносим заказы из orders.json (вместе с недосвёрнутым журналом) в SQLite
+    или в шарды (target_path - файл базы или папка шардов). Возвращает число заказов
+    '''
+    journal_file_path = os.path.splitext(orders_file_path)[0] + ".journal"
+    source = JournalOrderStorage(orders_file_path, journal_file_path)
+    data = await source.load_all()
+
+    if target == "sharded":
+        storage = ShardedOrderStorage(target_path)
+    else:
+        storage = SqliteOrderStorage(target_path)
+    try:
+        await storage.import_orders(data)
+    finally:
+        await storage.close()
+    return sum(len(orders) for orders in data.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перенос заказов из orders.json в базу SQLite или в шарды")
+    parser.add_argument("--source", default="../data/orders.json", help="путь к orders.json")
+    parser.add_argument("--target", default="sqlite", choices=["sqlite", "sharded"], help="куда переносим")
+    parser.add_argument("--db", default="../data/orders.db", help="путь к файлу базы SQLite")
+    parser.add_argument("--shards", default="../data/orders.shards", help="папка шардов")
+    args = parser.parse_args()
+
+    target_path = args.shards if args.target == "sharded" else args.db
+    count = asyncio.run(migrate(args.source, target_path, args.target))
+    print(f"Перенесено заказов: {count} -> {target_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+from pydantic import BaseModel, ConfigDict, Field
+import time
+
+
+'''АРТЁМ: поменял атрибуты класса'''
+class Course(BaseModel):
+    model_config = ConfigDict(frozen=True)  # Курсы лежат в неизменяемом каталоге
+
+    item: str
+    type: str
+    description: str
+    price: int
+    image_url: str = None  # Новое поле для URL изображения
+
+class Product(BaseModel):
+    item: str
+    type: str
+    price: int
+
+class Order(BaseModel):
+    order_id: int
+    item: str
+    type: str
+    price: int
+    paid: bool
+    date: str
+    timestamp: int = Field(default_factory=lambda: int(time.time()))
@@ -0,0 +1,160 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import zlib
+from typing import AsyncIterator, Dict, List, Sequence, Tuple
+
+from metrics import metrics
+from models import Order
+from order_storage import OrderStorage
+
+
+# Через сколько дней оплаченный заказ уходит в архив
+ARCHIVE_AFTER_DAYS = 90
+
+logger = logging.getLogger(__name__)
+
+ArchiveRecord = Tuple[str, dict]
+
+
+def archive_dir_for(orders_file_path: str) -> str:
+    ''' Папка архива лежит рядом с orders.json: orders.json -> orders.archive '''
+    return os.path.splitext(orders_file_path)[0] + ".archive"
+
+
+class OrderArchive:
+    '''
+    Холодный архив заказов: <папка>/<YYYY-MM>.jsonl.gz, по строке {"u": user_id, "o": заказ}.
+    Сегменты только дописываются - каждая архивация добавляет к файлу месяца новый gzip-member
+    (склеенные members читаются как один поток). Бот в архив не заглядывает, его читают
+    отчёты и запрос полной истории пользователя. Сегмент, оборванный на середине записи,
+    читается до обрыва и при следующей записи в него переписывается целиком.
+    '''
+
+    def __init__(self, archive_dir: str):
+        self.archive_dir = archive_dir
+
+    def _segment_path(self, month: str) -> str:
+        return os.path.join(self.archive_dir, month + ".jsonl.gz")
+
+    def list_months(self) -> List[str]:
+        if not os.path.isdir(self.archive_dir):
+            return []
+        return sorted(name[:-len(".jsonl.gz")] for name in os.listdir(self.archive_dir) if name.endswith(".jsonl.gz"))
+
+    def _read_segment_sync(self, month: str) -> Tuple[List[ArchiveRecord], bool]:
+        ''' Записи сегмента и признак, что он прочитан до конца без ошибок '''
+        path = self._segment_path(month)
+        records: List[ArchiveRecord] = []
+        if not os.path.exists(path):
+            return records, True
+
+        try:
+            with gzip.open(path, mode='rt', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    records.append((record["u"], record["o"]))
+        except (EOFError, OSError, zlib.error, json.JSONDecodeError, KeyError):
+            logger.warning("Архив %s повреждён, прочитано записей: %s", path, len(records))
+            return records, False
+        return records, True
+
+    @staticmethod
+    def _encode(records: List[ArchiveRecord]) -> bytes:
+        return "".join(
+            json.dumps({"u": user_id, "o": order}, ensure_ascii=False, separators=(",", ":")) + "\n"
+            for user_id, order in records
+        ).encode("utf-8")
+
+    def _append_sync(self, month: str, records: List[ArchiveRecord]) -> int:
+        ''' Дописываем в сегмент записи, которых в нём ещё нет; возвращаем, сколько дописано '''
+        existing, intact = self._read_segment_sync(month)
+        known = {(user_id, order["order_id"]) for user_id, order in existing}
+        fresh = [(user_id, order) for user_id, order in records if (user_id, order["order_id"]) not in known]
+        if not fresh and intact:
+            return 0
+
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = self._segment_path(month)
+        if intact:
+            payload = gzip.compress(self._encode(fresh), mtime=0)
+            mode = 'ab'
+            target = path
+        else:
+            # За оборванным member ничего не прочитается - переписываем сегмент целиком
+            payload = gzip.compress(self._encode(existing + fresh), mtime=0)
+            mode = 'wb'
+            target = path + ".tmp"
+
+        with open(target, mode) as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        if target != path:
+            os.replace(target, path)
+        metrics.inc("storage_written_bytes_total", len(payload), store="archive")
+        return len(fresh)
+
+    async def append(self, orders: List[Tuple[str, Order]]) -> int:
+        ''' Переносим заказы в сегменты их месяцев; уже лежащие в архиве пропускаются '''
+        by_month: Dict[str, List[ArchiveRecord]] = {}
+        for user_id, order in orders:
+            by_month.setdefault(order.date[:7], []).append((user_id, order.model_dump()))
+
+        appended = 0
+        with metrics.timer("storage_write_seconds", store="archive"):
+            for month, records in sorted(by_month.items()):
+                appended += await asyncio.to_thread(self._append_sync, month, records)
+        return appended
+
+    async def _read_segment(self, month: str) -> List[ArchiveRecord]:
+        with metrics.timer("storage_read_seconds", store="archive"):
+            records, _ = await asyncio.to_thread(self._read_segment_sync, month)
+        return records
+
+    async def iter_orders(self) -> AsyncIterator[Tuple[str, Order]]:
+        ''' Все архивные заказы, сегмент за сегментом (в памяти один месяц) '''
+        for month in self.list_months():
+            for user_id, order in await self._read_segment(month):
+                yield user_id, Order(**order)
+
+    async def load_columns(self, fields: Sequence[str]) -> Dict[str, list]:
+        ''' Архивные заказы по колонкам user_id + fields, как OrderStorage.load_columns '''
+        columns = {name: [] for name in ("user_id", *fields)}
+        for month in self.list_months():
+            records = await self._read_segment(month)
+            columns["user_id"].extend([user_id for user_id, _ in records])
+            for name in fields:
+                columns[name].extend([order[name] for _, order in records])
+        return columns
+
+    async def get_user_orders(self, user_id: str) -> List[Order]:
+        ''' Архивные заказы пользователя. Просматривает весь архив - для редких запросов '''
+        found = []
+        for month in self.list_months():
+            found.extend(Order(**order) for owner, order in await self._read_segment(month) if owner == user_id)
+        return found
+
+
+async def archive_orders(storage: OrderStorage, archive: OrderArchive, before_timestamp: int) -> int:
+    '''
+    Переносим оплаченные заказы старше before_timestamp из хранилища в архив.
+    Сначала заказы надёжно дописываются в архив и только потом удаляются из хранилища:
+    если процесс упадёт между шагами, следующий запуск не задублирует их в архиве, а удалит.
+    Возвращает число перенесённых заказов.
+    '''
+    candidates = await storage.get_archivable_orders(before_timestamp)
+    if not candidates:
+        return 0
+
+    await archive.append(candidates)
+    return await storage.remove_orders(candidates)
+
+
+def merge_history(live: List[Order], archived: List[Order]) -> List[Order]:
+    ''' Полная история: архив + живые заказы по order_id (живая копия важнее архивной) '''
+    merged: Dict[int, Order] = {order.order_id: order for order in archived}
+    merged.update((order.order_id, order) for order in live)
+    return [merged[order_id] for order_id in sorted(merged)]
@@ -0,0 +1,237 @@
+import aiofiles
+import asyncio
+import json
+import os
+from typing import Dict, List, Iterable, Optional, Tuple
+
+from metrics import metrics
+
+
+async def write_file_atomic(path: str, content: str, store: str = "file") -> None:
+    '''
+    Записываем файл атомарно: сначала во временный файл рядом, затем os.replace.
+    Падение посреди записи оставляет на диске либо старую, либо новую версию, но не обрезок.
+    store - подпись файла в метриках.
+    '''
+    tmp_path = f"{path}.tmp"
+    with metrics.timer("storage_write_seconds", store=store):
+        async with aiofiles.open(tmp_path, mode='w', encoding='utf-8') as f:
+            await f.write(content)
+            await f.flush()
+            await asyncio.to_thread(os.fsync, f.fileno())
+        os.replace(tmp_path, path)
+    metrics.count_bytes("storage_written_bytes_total", content, store=store)
+
+
+def make_add_record(user_id: str, order: dict) -> dict:
+    ''' Запись журнала о новом заказе '''
+    return {"op": "add", "u": user_id, "o": order}
+
+
+def make_paid_record(user_id: str, order_id: int, paid: bool) -> dict:
+    ''' Запись журнала об изменении статуса оплаты '''
+    return {"op": "paid", "u": user_id, "id": order_id, "paid": paid}
+
+
+def make_remove_record(user_id: str, order_id: int) -> dict:
+    ''' Запись журнала об удалении заказа (перенесён в архив) '''
+    return {"op": "remove", "u": user_id, "id": order_id}
+
+
+def apply_record(data: Dict[str, List[dict]], record: dict) -> None:
+    '''
+    Применяем одну запись журнала к словарю заказов (user_id -> список заказов в виде словарей).
+    Применение идемпотентно: повторное проигрывание той же записи не создаёт дублей,
+    поэтому журнал можно безопасно проиграть поверх снапшота, в который он уже попал.
+    '''
+    op = record.get("op")
+    user_orders = data.setdefault(record["u"], [])
+
+    if op == "add":
+        order = record["o"]
+        for index, existing in enumerate(user_orders):
+            if existing["order_id"] == order["order_id"]:
+                user_orders[index] = order
+                return
+        user_orders.append(order)
+    elif op == "paid":
+        for existing in user_orders:
+            if existing["order_id"] == record["id"]:
+                existing["paid"] = record["paid"]
+                return
+    elif op == "remove":
+        user_orders[:] = [existing for existing in user_orders if existing["order_id"] != record["id"]]
+        if not user_orders:
+            del data[record["u"]]
+
+
+class OrderJournal:
+    '''
+    Дописываемый журнал заказов в формате JSON Lines: одна компактная запись на каждый
+    новый заказ или изменение оплаты. Полный снапшот (orders.json) переписывается
+    только при компактизации, поэтому стоимость записи не зависит от размера истории.
+    '''
+
+    def __init__(self, journal_file_path: str):
+        self.journal_file_path = journal_file_path
+        # Во время компактизации текущий журнал переименовывается сюда
+        self.rotated_file_path = journal_file_path + ".old"
+        self.records_count = 0
+
+    async def append(self, records: Iterable[dict]) -> None:
+        ''' Дописываем записи в конец журнала '''
+        lines = "".join(
+            json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+            for record in records
+        )
+        if not lines:
+            return
+
+        with metrics.timer("storage_write_seconds", store="journal"):
+            async with aiofiles.open(self.journal_file_path, mode='a', encoding='utf-8') as f:
+                await f.write(lines)
+                await f.flush()
+                await asyncio.to_thread(os.fsync, f.fileno())
+        metrics.count_bytes("storage_written_bytes_total", lines, store="journal")
+        self.records_count += lines.count("\n")
+
+    async def _read_records(self, path: str) -> List[dict]:
+        if not os.path.exists(path):
+            return []
+
+        with metrics.timer("storage_read_seconds", store="journal"):
+            async with aiofiles.open(path, mode='r', encoding='utf-8') as f:
+                content = await f.read()
+        metrics.count_bytes("storage_read_bytes_total", content, store="journal")
+
+        records = []
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # Недописанная строка после аварийной остановки - дальше журнала нет
+                break
+        return records
+
+    async def replay(self, data: Dict[str, List[dict]]) -> None:
+        ''' Проигрываем журнал (включая недоудалённый после компактизации) поверх снапшота '''
+        rotated = await self._read_records(self.rotated_file_path)
+        current = await self._read_records(self.journal_file_path)
+        for record in rotated + current:
+            apply_record(data, record)
+        self.records_count = len(rotated) + len(current)
+
+    def rotate(self) -> None:
+        '''
+        Начинаем компактизацию: текущий журнал откладывается в сторону, новые записи
+        пойдут в пустой файл. Вызывать синхронно, сразу после снятия снапшота из памяти.
+        '''
+        if os.path.exists(self.journal_file_path):
+            if os.path.exists(self.rotated_file_path):
+                # Прошлая компактизация не завершилась - сохраняем оба хвоста журнала
+                with open(self.journal_file_path, 'r', encoding='utf-8') as src, \
+                        open(self.rotated_file_path, 'a', encoding='utf-8') as dst:
+                    dst.write(src.read())
+                os.remove(self.journal_file_path)
+            else:
+                os.replace(self.journal_file_path, self.rotated_file_path)
+        self.records_count = 0
+
+    def drop_rotated(self) -> None:
+        ''' Завершаем компактизацию: снапшот записан, отложенный журнал больше не нужен '''
+        if os.path.exists(self.rotated_file_path):
+            os.remove(self.rotated_file_path)
+
+
+class GroupCommitter:
+    '''
+    Групповая запись в журнал: все записи, поставленные в очередь за одно окно
+    (flush_window секунд), уходят на диск одним append + fsync под общим замком хранилища.
+    При всплеске заказов пропускная способность растёт, а не упирается в число записей.
+    '''
+
+    def __init__(self, journal: OrderJournal, lock: asyncio.Lock, flush_window: float):
+        self.journal = journal
+        self.lock = lock
+        self.flush_window = flush_window
+        self._pending: List[Tuple[List[dict], asyncio.Future]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def commit(self, records: List[dict]) -> None:
+        ''' Ставим записи в очередь и ждём, пока они окажутся на диске '''
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((records, future))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+        await future
+
+    async def _flush(self) -> None:
+        await asyncio.sleep(self.flush_window)
+        while self._pending:
+            async with self.lock:
+                batch, self._pending = self._pending, []
+                try:
+                    await self.journal.append([record for records, _ in batch for record in records])
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_result(None)
+
+
+PaidChange = Tuple[str, int, bool]
+
+
+class PaidChangeLog:
+    '''
+    Лог изменений статуса оплаты для инкрементальных отчётов: одна строка JSON на каждое
+    изменение. В отличие от журнала заказов, лог не сворачивается, а позиция в нём -
+    смещение в байтах, поэтому читатель забирает только то, что добавилось с прошлого раза.
+    '''
+
+    def __init__(self, log_file_path: str):
+        self.log_file_path = log_file_path
+        self._lock = asyncio.Lock()
+
+    async def append(self, user_id: str, order_id: int, paid: bool) -> None:
+        line = json.dumps({"u": user_id, "id": order_id, "paid": paid}, ensure_ascii=False, separators=(",", ":"))
+        async with self._lock:
+            with metrics.timer("storage_write_seconds", store="paidlog"):
+                async with aiofiles.open(self.log_file_path, mode='a', encoding='utf-8') as f:
+                    await f.write(line + "\n")
+                    await f.flush()
+        metrics.count_bytes("storage_written_bytes_total", line + "\n", store="paidlog")
+
+    def position(self) -> int:
+        ''' Текущий конец лога '''
+        if not os.path.exists(self.log_file_path):
+            return 0
+        return os.path.getsize(self.log_file_path)
+
+    async def read_since(self, position: int) -> Tuple[int, List[PaidChange]]:
+        ''' Изменения после position и новая позиция (недописанная последняя строка не читается) '''
+        if not os.path.exists(self.log_file_path):
+            return 0, []
+        if position > os.path.getsize(self.log_file_path):
+            # Лог пересоздан - читаем с начала
+            position = 0
+
+        with metrics.timer("storage_read_seconds", store="paidlog"):
+            async with aiofiles.open(self.log_file_path, mode='rb') as f:
+                await f.seek(position)
+                content = await f.read()
+        metrics.count_bytes("storage_read_bytes_total", content, store="paidlog")
+
+        complete = content[:content.rfind(b"\n") + 1]
+        changes = []
+        for line in complete.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            changes.append((record["u"], record["id"], record["paid"]))
+        return position + len(complete), changes
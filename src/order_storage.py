@@ -0,0 +1,944 @@
+import aiofiles
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+from metrics import metrics
+from models import Order
+from order_store import OrderStore
+from order_journal import (
+    OrderJournal, GroupCommitter, PaidChange, PaidChangeLog,
+    make_add_record, make_paid_record, make_remove_record, write_file_atomic,
+)
+
+
+# После скольких записей в журнале сворачиваем его в снапшот orders.json
+JOURNAL_COMPACT_THRESHOLD = 1000
+# Окно групповой записи в журнал, секунды
+GROUP_COMMIT_WINDOW = 0.005
+# На сколько корзин по хэшу user_id делятся заказы в шардированном хранилище
+SHARD_BUCKETS = 64
+
+
+def _paid_log_path(orders_file_path: str) -> str:
+    return os.path.splitext(orders_file_path)[0] + ".paidlog"
+
+
+def _archivable(data: Dict[str, List[Order]], before_timestamp: int) -> List[Tuple[str, Order]]:
+    ''' Оплаченные заказы старше before_timestamp, кроме последнего заказа каждого пользователя '''
+    found = []
+    for user_id, orders in data.items():
+        latest_order_id = max((order.order_id for order in orders), default=0)
+        found.extend(
+            (user_id, order) for order in orders
+            if order.paid and order.timestamp < before_timestamp and order.order_id != latest_order_id
+        )
+    return found
+
+
+def _build_orders(next_order_id: int, items: List[dict]) -> List[Order]:
+    return [
+        Order(order_id=next_order_id + offset, **order_data)
+        for offset, order_data in enumerate(items)
+    ]
+
+
+def _raw_columns(data: Dict[str, List[dict]], fields: Sequence[str],
+                 columns: Optional[Dict[str, list]] = None) -> Dict[str, list]:
+    ''' Раскладываем заказы-словари по колонкам user_id + fields (дописываем в columns, если передан) '''
+    if columns is None:
+        columns = {name: [] for name in ("user_id", *fields)}
+    for user_id, orders in data.items():
+        columns["user_id"].extend([user_id] * len(orders))
+        for name in fields:
+            columns[name].extend([order[name] for order in orders])
+    return columns
+
+
+class OrderStorage(ABC):
+    '''
+    Интерфейс хранилища заказов, которое стоит за DataManager.
+    user_id везде передаётся строкой - так же, как ключи в orders.json.
+    '''
+
+    @abstractmethod
+    async def load_all(self) -> Dict[str, List[Order]]:
+        ''' Вся база заказов: user_id -> список заказов '''
+
+    @abstractmethod
+    async def replace_all(self, data: Dict[str, List[Order]]) -> None:
+        ''' Полностью заменяем базу заказов '''
+
+    @abstractmethod
+    async def add_orders(self, user_id: str, items: List[dict]) -> List[Order]:
+        ''' Добавляем заказы пользователя одной записью, order_id идут подряд '''
+
+    @abstractmethod
+    async def set_paid(self, user_id: str, order_id: int, paid: bool) -> Optional[Order]:
+        ''' Меняем статус оплаты заказа, None - если заказа нет '''
+
+    @abstractmethod
+    async def get_user_orders(self, user_id: str) -> List[Order]:
+        ''' Все заказы пользователя '''
+
+    @abstractmethod
+    async def get_unpaid_orders(self, user_id: str) -> List[Order]:
+        ''' Неоплаченные заказы пользователя '''
+
+    @abstractmethod
+    async def get_orders_by_date(self, day: str) -> List[Tuple[str, Order]]:
+        ''' Заказы за день (YYYY-MM-DD) в виде пар (user_id, заказ) '''
+
+    @abstractmethod
+    async def get_all_unpaid_orders(self) -> List[Tuple[str, Order]]:
+        ''' Неоплаченные заказы всех пользователей в виде пар (user_id, заказ) '''
+
+    async def iter_orders_sorted(self) -> AsyncIterator[Tuple[str, Order]]:
+        ''' Все заказы по порядку (user_id, дата заказа) - для отчётов '''
+        data = await self.load_all()
+        for user_id in sorted(data):
+            for order in sorted(data[user_id], key=lambda order: order.date):
+                yield user_id, order
+
+    async def load_columns(self, fields: Sequence[str]) -> Dict[str, list]:
+        '''
+        Все заказы без сортировки, разложенные по колонкам: user_id + fields -> список значений.
+        Для аналитики, где порядок не важен: бэкенды читают сырые записи, не собирая Order
+        '''
+        data = await self.load_all()
+        columns = {"user_id": [user_id for user_id, orders in data.items() for _ in orders]}
+        for name in fields:
+            columns[name] = [getattr(order, name) for orders in data.values() for order in orders]
+        return columns
+
+    async def get_orders_since(self, timestamp: int) -> List[Tuple[str, Order]]:
+        ''' Заказы, созданные не раньше timestamp, по возрастанию времени создания '''
+        data = await self.load_all()
+        found = [
+            (user_id, order)
+            for user_id, orders in data.items()
+            for order in orders
+            if order.timestamp >= timestamp
+        ]
+        found.sort(key=lambda pair: (pair[1].timestamp, pair[0], pair[1].order_id))
+        return found
+
+    async def get_archivable_orders(self, before_timestamp: int) -> List[Tuple[str, Order]]:
+        '''
+        Оплаченные заказы, созданные раньше before_timestamp, - кандидаты в архив.
+        Последний заказ пользователя остаётся в хранилище, даже если он оплачен и старый:
+        по нему продолжается нумерация order_id, и номера не пересекаются с архивом
+        '''
+        return _archivable(await self.load_all(), before_timestamp)
+
+    @abstractmethod
+    async def remove_orders(self, orders: List[Tuple[str, Order]]) -> int:
+        ''' Убираем заказы (уже перенесённые в архив), возвращаем сколько убрано '''
+
+    @abstractmethod
+    async def paid_changes_position(self) -> int:
+        ''' Текущая позиция в логе изменений оплаты '''
+
+    @abstractmethod
+    async def get_paid_changes_since(self, position: int) -> Tuple[int, List[PaidChange]]:
+        ''' Изменения оплаты (user_id, order_id, paid) после position и новая позиция '''
+
+    async def compact(self) -> None:
+        ''' Обслуживание хранилища (сворачивание журнала и т.п.), по умолчанию ничего не делает '''
+
+    async def close(self) -> None:
+        ''' Освобождаем ресурсы хранилища (соединения и т.п.), по умолчанию ничего не делает '''
+
+
+class JsonFileOrderStorage(OrderStorage):
+    ''' Старый режим: orders.json перечитывается и переписывается целиком на каждую операцию '''
+
+    def __init__(self, orders_file_path: str, paid_log_file_path: Optional[str] = None):
+        self.orders_file_path = orders_file_path
+        self._paid_log = PaidChangeLog(paid_log_file_path or _paid_log_path(orders_file_path))
+        self._lock = asyncio.Lock()
+
+    async def _read(self) -> Dict[str, List[Order]]:
+        raw_data = await read_orders_snapshot(self.orders_file_path)
+        return {
+            user_id: [Order(**order) for order in orders]
+            for user_id, orders in raw_data.items()
+        }
+
+    async def _write(self, data: Dict[str, List[Order]]) -> None:
+        await write_orders_snapshot(self.orders_file_path, {
+            user_id: [order.model_dump() for order in orders]
+            for user_id, orders in data.items()
+        })
+
+    async def load_all(self) -> Dict[str, List[Order]]:
+        return await self._read()
+
+    async def load_columns(self, fields: Sequence[str]) -> Dict[str, list]:
+        return _raw_columns(await read_orders_snapshot(self.orders_file_path), fields)
+
+    async def replace_all(self, data: Dict[str, List[Order]]) -> None:
+        async with self._lock:
+            await self._write(data)
+
+    async def add_orders(self, user_id: str, items: List[dict]) -> List[Order]:
+        async with self._lock:
+            data = await self._read()
+            order_list = data.setdefault(user_id, [])
+            next_order_id = max((order.order_id for order in order_list), default=0) + 1
+            orders = _build_orders(next_order_id, items)
+            order_list.extend(orders)
+            await self._write(data)
+        return orders
+
+    async def set_paid(self, user_id: str, order_id: int, paid: bool) -> Optional[Order]:
+        async with self._lock:
+            data = await self._read()
+            order = next((o for o in data.get(user_id, []) if o.order_id == order_id), None)
+            if order is None:
+                return None
+            order.paid = paid
+            await self._write(data)
+            await self._paid_log.append(user_id, order_id, paid)
+        return order
+
+    async def remove_orders(self, orders: List[Tuple[str, Order]]) -> int:
+        keys = {(user_id, order.order_id) for user_id, order in orders}
+        async with self._lock:
+            data = await self._read()
+            removed = 0
+            for user_id in list(data):
+                kept = [order for order in data[user_id] if (user_id, order.order_id) not in keys]
+                removed += len(data[user_id]) - len(kept)
+                if kept:
+                    data[user_id] = kept
+                else:
+                    del data[user_id]
+            if removed:
+                await self._write(data)
+        return removed
+
+    async def get_user_orders(self, user_id: str) -> List[Order]:
+        data = await self._read()
+        return data.get(user_id, [])
+
+    async def get_unpaid_orders(self, user_id: str) -> List[Order]:
+        return [order for order in await self.get_user_orders(user_id) if not order.paid]
+
+    async def get_orders_by_date(self, day: str) -> List[Tuple[str, Order]]:
+        data = await self._read()
+        return [
+            (user_id, order)
+            for user_id, orders in data.items()
+            for order in orders
+            if order.date == day
+        ]
+
+    async def get_all_unpaid_orders(self) -> List[Tuple[str, Order]]:
+        data = await self._read()
+        return [
+            (user_id, order)
+            for user_id, orders in data.items()
+            for order in orders
+            if not order.paid
+        ]
+
+    async def paid_changes_position(self) -> int:
+        return self._paid_log.position()
+
+    async def get_paid_changes_since(self, position: int) -> Tuple[int, List[PaidChange]]:
+        return await self._paid_log.read_since(position)
+
+
+class JournalOrderStorage(OrderStorage):
+    '''
+    Снапшот orders.json + дописываемый журнал. Заказы поднимаются в память (OrderStore)
+    один раз, запись - это append в журнал с групповым коммитом, журнал периодически
+    сворачивается в снапшот в фоне.
+    '''
+
+    def __init__(self, orders_file_path: str, journal_file_path: str,
+                 compact_threshold: int = JOURNAL_COMPACT_THRESHOLD,
+                 group_commit_window: float = GROUP_COMMIT_WINDOW,
+                 paid_log_file_path: Optional[str] = None):
+        self.orders_file_path = orders_file_path
+        self.compact_threshold = compact_threshold
+        self._journal = OrderJournal(journal_file_path)
+        self._paid_log = PaidChangeLog(paid_log_file_path or _paid_log_path(orders_file_path))
+        self._store: Optional[OrderStore] = None
+        self._load_lock = asyncio.Lock()
+        # Замок на запись: журнал и снапшот
+        self._lock = asyncio.Lock()
+        self._group_commit = GroupCommitter(self._journal, self._lock, group_commit_window)
+        self._compaction_task: Optional[asyncio.Task] = None
+
+    async def _ensure_store(self) -> OrderStore:
+        ''' Один раз поднимаем заказы в память: снапшот + проигрывание журнала '''
+        if self._store is not None:
+            return self._store
+
+        async with self._load_lock:
+            if self._store is None:
+                raw_data = await read_orders_snapshot(self.orders_file_path)
+                await self._journal.replay(raw_data)
+                self._store = OrderStore.from_orders({
+                    user_id: [Order(**order) for order in orders]
+                    for user_id, orders in raw_data.items()
+                })
+        return self._store
+
+    async def load_all(self) -> Dict[str, List[Order]]:
+        ''' Возвращается кэш из памяти - не изменяйте его снаружи '''
+        store = await self._ensure_store()
+        return store.as_dict()
+
+    async def load_columns(self, fields: Sequence[str]) -> Dict[str, list]:
+        ''' Если заказы ещё не в памяти, не поднимаем их: снапшот + журнал читаются словарями '''
+        if self._store is not None:
+            return await super().load_columns(fields)
+        raw_data = await read_orders_snapshot(self.orders_file_path)
+        await self._journal.replay(raw_data)
+        return _raw_columns(raw_data, fields)
+
+    async def replace_all(self, data: Dict[str, List[Order]]) -> None:
+        self._store = OrderStore.from_orders(data)
+        await self.compact()
+
+    async def compact(self) -> None:
+        ''' Сворачиваем журнал в снапшот orders.json '''
+        store = await self._ensure_store()
+        async with self._lock:
+            # Снимок и ротация журнала выполняются без await между ними: всё, что попадёт
+            # в новый журнал, гарантированно отсутствует в снимке, а всё из старого - есть в нём
+            serializable_data = {
+                user_id: [order.model_dump() for order in orders]
+                for user_id, orders in store.as_dict().items()
+            }
+            self._journal.rotate()
+            await write_orders_snapshot(self.orders_file_path, serializable_data)
+            self._journal.drop_rotated()
+
+    def _schedule_compaction(self) -> None:
+        ''' Запускаем компактизацию в фоне, когда журнал разросся '''
+        if self._journal.records_count < self.compact_threshold:
+            return
+        if self._compaction_task is not None and not self._compaction_task.done():
+            return
+        self._compaction_task = asyncio.create_task(self.compact())
+
+    async def add_orders(self, user_id: str, items: List[dict]) -> List[Order]:
+        store = await self._ensure_store()
+        # Номера назначаются синхронно, поэтому параллельные оформления не получат одинаковых order_id
+        orders = _build_orders(store.next_order_id(user_id), items)
+        for order in orders:
+            store.add(user_id, order)
+
+        try:
+            await self._group_commit.commit([make_add_record(user_id, order.model_dump()) for order in orders])
+        except Exception:
+            # Запись не легла в журнал - убираем заказы из памяти, иначе они пропадут после рестарта
+            for order in orders:
+                store.remove(user_id, order.order_id)
+            raise
+        self._schedule_compaction()
+        return [order.model_copy() for order in orders]
+
+    async def set_paid(self, user_id: str, order_id: int, paid: bool) -> Optional[Order]:
+        store = await self._ensure_store()
+        current = store.get(user_id, order_id)
+        if current is None:
+            return None
+        was_paid = current.paid
+        order = store.set_paid(user_id, order_id, paid)
+
+        try:
+            await self._group_commit.commit([make_paid_record(user_id, order_id, paid)])
+        except Exception:
+            store.set_paid(user_id, order_id, was_paid)
+            raise
+        await self._paid_log.append(user_id, order_id, paid)
+        self._schedule_compaction()
+        return order
+
+    async def get_user_orders(self, user_id: str) -> List[Order]:
+        store = await self._ensure_store()
+        return store.user_orders(user_id)
+
+    async def get_unpaid_orders(self, user_id: str) -> List[Order]:
+        store = await self._ensure_store()
+        return store.unpaid_orders(user_id)
+
+    async def get_orders_by_date(self, day: str) -> List[Tuple[str, Order]]:
+        store = await self._ensure_store()
+        return store.orders_by_date(day)
+
+    async def get_all_unpaid_orders(self) -> List[Tuple[str, Order]]:
+        store = await self._ensure_store()
+        return list(store.iter_unpaid())
+
+    async def get_orders_since(self, timestamp: int) -> List[Tuple[str, Order]]:
+        store = await self._ensure_store()
+        return store.orders_since(timestamp)
+
+    async def get_archivable_orders(self, before_timestamp: int) -> List[Tuple[str, Order]]:
+        store = await self._ensure_store()
+        return _archivable(store.as_dict(), before_timestamp)
+
+    async def remove_orders(self, orders: List[Tuple[str, Order]]) -> int:
+        store = await self._ensure_store()
+        removed = []
+        for user_id, order in orders:
+            current = store.remove(user_id, order.order_id)
+            if current is not None:
+                removed.append((user_id, current))
+        if removed:
+            try:
+                await self._group_commit.commit([make_remove_record(user_id, order.order_id) for user_id, order in removed])
+            except Exception:
+                for user_id, order in removed:
+                    store.add(user_id, order)
+                raise
+            self._schedule_compaction()
+        return len(removed)
+
+    async def paid_changes_position(self) -> int:
+        return self._paid_log.position()
+
+    async def get_paid_changes_since(self, position: int) -> Tuple[int, List[PaidChange]]:
+        return await self._paid_log.read_since(position)
+
+
+ORDER_COLUMNS = ("order_id", "item", "type", "price", "paid", "date", "timestamp")
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    user_id   TEXT    NOT NULL,
+    order_id  INTEGER NOT NULL,
+    item      TEXT    NOT NULL,
+    type      TEXT    NOT NULL,
+    price     INTEGER NOT NULL,
+    paid      INTEGER NOT NULL,
+    date      TEXT    NOT NULL,
+    timestamp INTEGER NOT NULL,
+    PRIMARY KEY (user_id, order_id)
+);
+CREATE INDEX IF NOT EXISTS orders_paid_idx ON orders (paid, user_id);
+CREATE INDEX IF NOT EXISTS orders_date_idx ON orders (date);
+CREATE INDEX IF NOT EXISTS orders_user_date_idx ON orders (user_id, date);
+CREATE INDEX IF NOT EXISTS orders_timestamp_idx ON orders (timestamp);
+CREATE TABLE IF NOT EXISTS paid_changes (
+    seq      INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id  TEXT    NOT NULL,
+    order_id INTEGER NOT NULL,
+    paid     INTEGER NOT NULL
+);
+"""
+
+
+class SqliteOrderStorage(OrderStorage):
+    '''
+    Хранилище заказов в SQLite (WAL). Все обращения к базе идут через отдельный поток,
+    поэтому event loop не блокируется, а одно соединение не используется параллельно.
+    '''
+
+    def __init__(self, db_file_path: str):
+        self.db_file_path = db_file_path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="orders-sqlite")
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_file_path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SQLITE_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        # Время запроса вместе с ожиданием своей очереди в потоке базы
+        with metrics.timer("storage_query_seconds", store="sqlite", op=func.__name__.strip("_").removesuffix("_sync")):
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    @staticmethod
+    def _row_to_order(row: sqlite3.Row) -> Order:
+        return Order(
+            order_id=row["order_id"],
+            item=row["item"],
+            type=row["type"],
+            price=row["price"],
+            paid=bool(row["paid"]),
+            date=row["date"],
+            timestamp=row["timestamp"],
+        )
+
+    @staticmethod
+    def _order_to_row(user_id: str, order: Order) -> tuple:
+        return (user_id, order.order_id, order.item, order.type, order.price,
+                int(order.paid), order.date, order.timestamp)
+
+    def _select(self, where: str = "", params: tuple = ()) -> List[Tuple[str, Order]]:
+        conn = self._connect()
+        rows = conn.execute(
+            f"SELECT user_id, {', '.join(ORDER_COLUMNS)} FROM orders {where} ORDER BY user_id, order_id",
+            params,
+        ).fetchall()
+        return [(row["user_id"], self._row_to_order(row)) for row in rows]
+
+    def _load_columns_sync(self, fields: Sequence[str]) -> Dict[str, list]:
+        conn = self._connect()
+        rows = conn.execute(f"SELECT user_id, {', '.join(fields)} FROM orders").fetchall()
+        columns = {name: [row[index] for row in rows] for index, name in enumerate(("user_id", *fields))}
+        if "paid" in columns:
+            columns["paid"] = [bool(paid) for paid in columns["paid"]]
+        return columns
+
+    def _load_all_sync(self) -> Dict[str, List[Order]]:
+        data: Dict[str, List[Order]] = {}
+        for user_id, order in self._select():
+            data.setdefault(user_id, []).append(order)
+        return data
+
+    def _insert_sync(self, rows: List[tuple], replace_all: bool = False) -> None:
+        conn = self._connect()
+        with conn:
+            if replace_all:
+                conn.execute("DELETE FROM orders")
+            conn.executemany(
+                "INSERT OR REPLACE INTO orders (user_id, order_id, item, type, price, paid, date, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def _add_orders_sync(self, user_id: str, items: List[dict]) -> List[Order]:
+        conn = self._connect()
+        with conn:
+            (max_order_id,) = conn.execute(
+                "SELECT COALESCE(MAX(order_id), 0) FROM orders WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            orders = _build_orders(max_order_id + 1, items)
+            conn.executemany(
+                "INSERT INTO orders (user_id, order_id, item, type, price, paid, date, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [self._order_to_row(user_id, order) for order in orders],
+            )
+        return orders
+
+    def _set_paid_sync(self, user_id: str, order_id: int, paid: bool) -> Optional[Order]:
+        conn = self._connect()
+        with conn:
+            updated = conn.execute(
+                "UPDATE orders SET paid = ? WHERE user_id = ? AND order_id = ?",
+                (int(paid), user_id, order_id),
+            ).rowcount
+            if updated:
+                conn.execute(
+                    "INSERT INTO paid_changes (user_id, order_id, paid) VALUES (?, ?, ?)",
+                    (user_id, order_id, int(paid)),
+                )
+        found = self._select("WHERE user_id = ? AND order_id = ?", (user_id, order_id))
+        return found[0][1] if found else None
+
+    def _archivable_sync(self, before_timestamp: int) -> List[Tuple[str, Order]]:
+        return self._select(
+            "WHERE paid = 1 AND timestamp < ? AND order_id < "
+            "(SELECT MAX(latest.order_id) FROM orders AS latest WHERE latest.user_id = orders.user_id)",
+            (before_timestamp,),
+        )
+
+    def _remove_sync(self, keys: List[Tuple[str, int]]) -> int:
+        conn = self._connect()
+        with conn:
+            return conn.executemany("DELETE FROM orders WHERE user_id = ? AND order_id = ?", keys).rowcount
+
+    def _paid_changes_position_sync(self) -> int:
+        conn = self._connect()
+        (position,) = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM paid_changes").fetchone()
+        return position
+
+    def _paid_changes_since_sync(self, position: int) -> Tuple[int, List[PaidChange]]:
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT seq, user_id, order_id, paid FROM paid_changes WHERE seq > ? ORDER BY seq", (position,)
+        ).fetchall()
+        if not rows:
+            return position, []
+        return rows[-1]["seq"], [(row["user_id"], row["order_id"], bool(row["paid"])) for row in rows]
+
+    def _close_sync(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def load_all(self) -> Dict[str, List[Order]]:
+        return await self._run(self._load_all_sync)
+
+    async def load_columns(self, fields: Sequence[str]) -> Dict[str, list]:
+        unknown = set(fields) - set(ORDER_COLUMNS)
+        if unknown:
+            raise ValueError(f"Неизвестные колонки заказов: {sorted(unknown)}")
+        return await self._run(self._load_columns_sync, tuple(fields))
+
+    async def replace_all(self, data: Dict[str, List[Order]]) -> None:
+        rows = [self._order_to_row(user_id, order) for user_id, orders in data.items() for order in orders]
+        await self._run(self._insert_sync, rows, True)
+
+    async def import_orders(self, data: Dict[str, List[Order]]) -> None:
+        ''' Добавляем заказы как есть (с их order_id), существующие с тем же ключом заменяются '''
+        rows = [self._order_to_row(user_id, order) for user_id, orders in data.items() for order in orders]
+        await self._run(self._insert_sync, rows)
+
+    async def add_orders(self, user_id: str, items: List[dict]) -> List[Order]:
+        return await self._run(self._add_orders_sync, user_id, items)
+
+    async def set_paid(self, user_id: str, order_id: int, paid: bool) -> Optional[Order]:
+        return await self._run(self._set_paid_sync, user_id, order_id, paid)
+
+    async def get_user_orders(self, user_id: str) -> List[Order]:
+        rows = await self._run(self._select, "WHERE user_id = ?", (user_id,))
+        return [order for _, order in rows]
+
+    async def get_unpaid_orders(self, user_id: str) -> List[Order]:
+        rows = await self._run(self._select, "WHERE paid = 0 AND user_id = ?", (user_id,))
+        return [order for _, order in rows]
+
+    async def get_orders_by_date(self, day: str) -> List[Tuple[str, Order]]:
+        return await self._run(self._select, "WHERE date = ?", (day,))
+
+    async def get_all_unpaid_orders(self) -> List[Tuple[str, Order]]:
+        return await self._run(self._select, "WHERE paid = 0")
+
+    async def get_orders_since(self, timestamp: int) -> List[Tuple[str, Order]]:
+        rows = await self._run(self._select, "WHERE timestamp >= ?", (timestamp,))
+        rows.sort(key=lambda pair: (pair[1].timestamp, pair[0], pair[1].order_id))
+        return rows
+
+    async def get_archivable_orders(self, before_timestamp: int) -> List[Tuple[str, Order]]:
+        return await self._run(self._archivable_sync, before_timestamp)
+
+    async def remove_orders(self, orders: List[Tuple[str, Order]]) -> int:
+        return await self._run(self._remove_sync, [(user_id, order.order_id) for user_id, order in orders])
+
+    async def paid_changes_position(self) -> int:
+        return await self._run(self._paid_changes_position_sync)
+
+    async def get_paid_changes_since(self, position: int) -> Tuple[int, List[PaidChange]]:
+        return await self._run(self._paid_changes_since_sync, position)
+
+    def _open_sorted_cursor(self) -> sqlite3.Cursor:
+        # Отдельное соединение: в WAL чтение идёт по снимку и не мешает записи
+        self._connect()
+        conn = sqlite3.connect(self.db_file_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn.execute(
+            f"SELECT user_id, {', '.join(ORDER_COLUMNS)} FROM orders ORDER BY user_id, date, order_id"
+        )
+
+    async def iter_orders_sorted(self, batch_size: int = 1000) -> AsyncIterator[Tuple[str, Order]]:
+        ''' Потоковое чтение по индексу (user_id, date): в памяти не больше одной пачки строк '''
+        cursor = await self._run(self._open_sorted_cursor)
+        try:
+            while True:
+                rows = await self._run(cursor.fetchmany, batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row["user_id"], self._row_to_order(row)
+        finally:
+            await self._run(cursor.connection.close)
+
+    async def close(self) -> None:
+        await self._run(self._close_sync)
+        self._executor.shutdown(wait=True)
+
+
+def _shard_bucket(user_id: str, buckets: int) -> str:
+    ''' Корзина пользователя: стабильный хэш user_id (не hash(), он меняется между запусками) '''
+    digest = hashlib.sha256(user_id.encode("utf-8")).digest()
+    return f"{int.from_bytes(digest[:4], 'big') % buckets:02x}"
+
+
+class ShardedOrderStorage(OrderStorage):
+    '''
+    Заказы разложены по файлам-шардам <папка>/<корзина>/<YYYY-MM>.json: корзина - хэш
+    user_id по модулю buckets, месяц - из даты заказа. Шард - такой же словарь
+    user_id -> заказы, как orders.json. Запись переписывает один шард, заказы пользователя
+    читаются только из шардов его корзины, выборки по дате и времени - только из шардов
+    нужных месяцев, отчёты идут корзина за корзиной. В памяти ничего, кроме следующих
+    order_id уже встречавшихся пользователей, не держится.
+    '''
+
+    def __init__(self, shards_dir: str, buckets: int = SHARD_BUCKETS, paid_log_file_path: Optional[str] = None):
+        self.shards_dir = shards_dir
+        self.buckets = buckets
+        self._paid_log = PaidChangeLog(paid_log_file_path or _paid_log_path(shards_dir))
+        # Замок на корзину: order_id пользователя выдаются и шарды переписываются по очереди
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._next_order_ids: Dict[str, int] = {}
+
+    def _bucket(self, user_id: str) -> str:
+        return _shard_bucket(user_id, self.buckets)
+
+    def _lock(self, bucket: str) -> asyncio.Lock:
+        lock = self._locks.get(bucket)
+        if lock is None:
+            lock = self._locks[bucket] = asyncio.Lock()
+        return lock
+
+    def _shard_path(self, bucket: str, month: str) -> str:
+        return os.path.join(self.shards_dir, bucket, month + ".json")
+
+    def _list_buckets(self) -> List[str]:
+        if not os.path.isdir(self.shards_dir):
+            return []
+        return sorted(name for name in os.listdir(self.shards_dir)
+                      if os.path.isdir(os.path.join(self.shards_dir, name)))
+
+    def _list_months(self, bucket: str) -> List[str]:
+        bucket_dir = os.path.join(self.shards_dir, bucket)
+        if not os.path.isdir(bucket_dir):
+            return []
+        return sorted(name[:-len(".json")] for name in os.listdir(bucket_dir) if name.endswith(".json"))
+
+    async def _read_shard(self, bucket: str, month: str) -> Dict[str, List[dict]]:
+        return await read_orders_snapshot(self._shard_path(bucket, month), store="shard")
+
+    async def _write_shard(self, bucket: str, month: str, data: Dict[str, List[dict]]) -> None:
+        path = self._shard_path(bucket, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        await write_file_atomic(path, json.dumps(data, ensure_ascii=False, separators=(",", ":")), store="shard")
+
+    async def _iter_shards(self, from_month: str = "") -> AsyncIterator[Tuple[str, Dict[str, List[dict]]]]:
+        ''' Шарды корзина за корзиной (месяцы по возрастанию, не раньше from_month): (корзина, данные) '''
+        for bucket in self._list_buckets():
+            for month in self._list_months(bucket):
+                if month >= from_month:
+                    yield bucket, await self._read_shard(bucket, month)
+
+    async def _read_user_orders(self, user_id: str) -> List[Order]:
+        bucket = self._bucket(user_id)
+        orders = []
+        for month in self._list_months(bucket):
+            shard = await self._read_shard(bucket, month)
+            orders.extend(Order(**order) for order in shard.get(user_id, []))
+        return orders
+
+    async def _read_bucket(self, bucket: str) -> Dict[str, List[Order]]:
+        ''' Все заказы одной корзины: user_id -> заказы по месяцам '''
+        bucket_orders: Dict[str, List[Order]] = {}
+        for month in self._list_months(bucket):
+            shard = await self._read_shard(bucket, month)
+            for user_id, orders in shard.items():
+                bucket_orders.setdefault(user_id, []).extend(Order(**order) for order in orders)
+        return bucket_orders
+
+    async def load_all(self) -> Dict[str, List[Order]]:
+        data: Dict[str, List[Order]] = {}
+        async for _, shard in self._iter_shards():
+            for user_id, orders in shard.items():
+                data.setdefault(user_id, []).extend(Order(**order) for order in orders)
+        return data
+
+    async def load_columns(self, fields: Sequence[str]) -> Dict[str, list]:
+        columns = None
+        async for _, shard in self._iter_shards():
+            columns = _raw_columns(shard, fields, columns)
+        return columns if columns is not None else _raw_columns({}, fields)
+
+    def _group_by_shard(self, data: Dict[str, List[Order]]) -> Dict[Tuple[str, str], Dict[str, List[dict]]]:
+        shards: Dict[Tuple[str, str], Dict[str, List[dict]]] = {}
+        for user_id, orders in data.items():
+            bucket = self._bucket(user_id)
+            for order in orders:
+                shard = shards.setdefault((bucket, order.date[:7]), {})
+                shard.setdefault(user_id, []).append(order.model_dump())
+        return shards
+
+    async def replace_all(self, data: Dict[str, List[Order]]) -> None:
+        ''' Раскладываем базу в соседнюю папку и подменяем ею старую '''
+        new_dir = self.shards_dir + ".new"
+        old_dir = self.shards_dir + ".old"
+        shutil.rmtree(new_dir, ignore_errors=True)
+        for (bucket, month), shard in self._group_by_shard(data).items():
+            path = os.path.join(new_dir, bucket, month + ".json")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            await write_file_atomic(path, json.dumps(shard, ensure_ascii=False, separators=(",", ":")), store="shard")
+
+        os.makedirs(new_dir, exist_ok=True)
+        if os.path.isdir(self.shards_dir):
+            os.replace(self.shards_dir, old_dir)
+        os.replace(new_dir, self.shards_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        self._next_order_ids.clear()
+
+    async def import_orders(self, data: Dict[str, List[Order]]) -> None:
+        ''' Добавляем заказы как есть (с их order_id), существующие с тем же ключом заменяются '''
+        for (bucket, month), imported in self._group_by_shard(data).items():
+            async with self._lock(bucket):
+                shard = await self._read_shard(bucket, month)
+                for user_id, orders in imported.items():
+                    merged = {order["order_id"]: order for order in shard.get(user_id, [])}
+                    merged.update((order["order_id"], order) for order in orders)
+                    shard[user_id] = list(merged.values())
+                await self._write_shard(bucket, month, shard)
+        self._next_order_ids.clear()
+
+    async def add_orders(self, user_id: str, items: List[dict]) -> List[Order]:
+        bucket = self._bucket(user_id)
+        async with self._lock(bucket):
+            next_order_id = self._next_order_ids.get(user_id)
+            if next_order_id is None:
+                existing = await self._read_user_orders(user_id)
+                next_order_id = max((order.order_id for order in existing), default=0) + 1
+
+            orders = _build_orders(next_order_id, items)
+            by_month: Dict[str, List[Order]] = {}
+            for order in orders:
+                by_month.setdefault(order.date[:7], []).append(order)
+            for month, month_orders in by_month.items():
+                shard = await self._read_shard(bucket, month)
+                shard.setdefault(user_id, []).extend(order.model_dump() for order in month_orders)
+                await self._write_shard(bucket, month, shard)
+
+            self._next_order_ids[user_id] = next_order_id + len(orders)
+        return orders
+
+    async def set_paid(self, user_id: str, order_id: int, paid: bool) -> Optional[Order]:
+        bucket = self._bucket(user_id)
+        async with self._lock(bucket):
+            # Оплачивают обычно свежие заказы - идём с последнего месяца
+            for month in reversed(self._list_months(bucket)):
+                shard = await self._read_shard(bucket, month)
+                order = next((order for order in shard.get(user_id, []) if order["order_id"] == order_id), None)
+                if order is not None:
+                    order["paid"] = paid
+                    await self._write_shard(bucket, month, shard)
+                    break
+            else:
+                return None
+
+        await self._paid_log.append(user_id, order_id, paid)
+        return Order(**order)
+
+    async def get_archivable_orders(self, before_timestamp: int) -> List[Tuple[str, Order]]:
+        found = []
+        for bucket in self._list_buckets():
+            found.extend(_archivable(await self._read_bucket(bucket), before_timestamp))
+        return found
+
+    async def remove_orders(self, orders: List[Tuple[str, Order]]) -> int:
+        by_shard: Dict[Tuple[str, str], set] = {}
+        for user_id, order in orders:
+            by_shard.setdefault((self._bucket(user_id), order.date[:7]), set()).add((user_id, order.order_id))
+
+        removed = 0
+        for (bucket, month), keys in by_shard.items():
+            async with self._lock(bucket):
+                shard = await self._read_shard(bucket, month)
+                shard_removed = 0
+                for user_id in list(shard):
+                    kept = [order for order in shard[user_id] if (user_id, order["order_id"]) not in keys]
+                    shard_removed += len(shard[user_id]) - len(kept)
+                    if kept:
+                        shard[user_id] = kept
+                    else:
+                        del shard[user_id]
+                if not shard_removed:
+                    continue
+                if shard:
+                    await self._write_shard(bucket, month, shard)
+                else:
+                    os.remove(self._shard_path(bucket, month))
+                removed += shard_removed
+        return removed
+
+    async def get_user_orders(self, user_id: str) -> List[Order]:
+        return await self._read_user_orders(user_id)
+
+    async def get_unpaid_orders(self, user_id: str) -> List[Order]:
+        return [order for order in await self._read_user_orders(user_id) if not order.paid]
+
+    async def get_orders_by_date(self, day: str) -> List[Tuple[str, Order]]:
+        month = day[:7]
+        found = []
+        for bucket in self._list_buckets():
+            shard = await self._read_shard(bucket, month)
+            for user_id, orders in shard.items():
+                found.extend((user_id, Order(**order)) for order in orders if order["date"] == day)
+        return found
+
+    async def get_all_unpaid_orders(self) -> List[Tuple[str, Order]]:
+        found = []
+        async for _, shard in self._iter_shards():
+            for user_id, orders in shard.items():
+                found.extend((user_id, Order(**order)) for order in orders if not order["paid"])
+        return found
+
+    async def get_orders_since(self, timestamp: int) -> List[Tuple[str, Order]]:
+        # Дата заказа - местная дата его timestamp, поэтому более ранние месяцы можно не открывать
+        from_month = date.fromtimestamp(timestamp).isoformat()[:7]
+        found = []
+        async for _, shard in self._iter_shards(from_month):
+            for user_id, orders in shard.items():
+                found.extend((user_id, Order(**order)) for order in orders if order["timestamp"] >= timestamp)
+        found.sort(key=lambda pair: (pair[1].timestamp, pair[0], pair[1].order_id))
+        return found
+
+    async def iter_orders_sorted(self) -> AsyncIterator[Tuple[str, Order]]:
+        '''
+        В памяти одновременно только одна корзина: пользователи идут по корзинам,
+        внутри корзины - по user_id, заказы пользователя - по дате
+        '''
+        for bucket in self._list_buckets():
+            bucket_orders = await self._read_bucket(bucket)
+            for user_id in sorted(bucket_orders):
+                for order in sorted(bucket_orders[user_id], key=lambda order: order.date):
+                    yield user_id, order
+
+    async def paid_changes_position(self) -> int:
+        return self._paid_log.position()
+
+    async def get_paid_changes_since(self, position: int) -> Tuple[int, List[PaidChange]]:
+        return await self._paid_log.read_since(position)
+
+
+async def read_orders_snapshot(orders_file_path: str, store: str = "snapshot") -> Dict[str, List[dict]]:
+    ''' Читаем снапшот заказов из orders.json (или шард того же формата) в виде словарей '''
+    if not os.path.exists(orders_file_path):
+        return {}
+
+    with metrics.timer("storage_read_seconds", store=store):
+        async with aiofiles.open(orders_file_path, mode='r', encoding='utf-8') as f:
+            content = await f.read()
+    metrics.count_bytes("storage_read_bytes_total", content, store=store)
+    if not content.strip():
+        return {}
+
+    return json.loads(content)
+
+
+async def write_orders_snapshot(orders_file_path: str, serializable_data: Dict[str, List[dict]]) -> None:
+    await write_file_atomic(orders_file_path, json.dumps(serializable_data, indent=4, ensure_ascii=False), store="snapshot")
+
+
+def create_order_storage(backend: str, orders_file_path: str) -> OrderStorage:
+    ''' Создаём хранилище заказов по имени бэкенда: json, journal, sqlite или sharded '''
+    base_path = os.path.splitext(orders_file_path)[0]
+    if backend == "json":
+        return JsonFileOrderStorage(orders_file_path)
+    if backend == "journal":
+        return JournalOrderStorage(orders_file_path, base_path + ".journal")
+    if backend == "sqlite":
+        return SqliteOrderStorage(base_path + ".db")
+    if backend == "sharded":
+        return ShardedOrderStorage(base_path + ".shards")
+    raise ValueError(f"Неизвестное хранилище заказов: {backend}")
@@ -0,0 +1,147 @@
+import bisect
+from typing import Dict, List, Optional, Tuple, Iterator
+
+from models import Order
+
+
+OrderKey = Tuple[str, int]
+
+
+class OrderStore:
+    '''
+    Резидентное хранилище заказов. Загружается один раз и дальше поддерживается
+    инкрементально при записи. Индексы:
+    - по пользователю (user_id -> список заказов в порядке добавления);
+    - по ключу (user_id, order_id);
+    - по статусу оплаты (неоплаченные заказы каждого пользователя);
+    - по дате заказа;
+    - по времени создания (отсортированный список для выборок "новее чем").
+    Все изменения заказов должны идти через методы хранилища, иначе индексы разъедутся,
+    поэтому выборки отдают новые списки с копиями заказов. Исключение - as_dict(),
+    который отдаёт внутренние списки только для чтения (снапшот, выгрузки).
+    '''
+
+    def __init__(self):
+        self._by_user: Dict[str, List[Order]] = {}
+        self._by_key: Dict[OrderKey, Order] = {}
+        self._unpaid_by_user: Dict[str, Dict[int, Order]] = {}
+        self._by_date: Dict[str, Dict[OrderKey, Order]] = {}
+        self._max_order_id: Dict[str, int] = {}
+        self._by_time: List[Tuple[int, str, int]] = []
+
+    @classmethod
+    def from_orders(cls, data: Dict[str, List[Order]]) -> "OrderStore":
+        store = cls()
+        for user_id, orders in data.items():
+            store._by_user.setdefault(user_id, [])
+            for order in orders:
+                store.add(user_id, order)
+        store._by_time.sort()
+        return store
+
+    def __len__(self) -> int:
+        return len(self._by_key)
+
+    def add(self, user_id: str, order: Order) -> None:
+        ''' Добавляем заказ (повторное добавление того же order_id заменяет старый) '''
+        key = (user_id, order.order_id)
+        user_orders = self._by_user.setdefault(user_id, [])
+        existing = self._by_key.get(key)
+        if existing is not None:
+            self._unindex(user_id, existing)
+            user_orders[user_orders.index(existing)] = order
+        else:
+            user_orders.append(order)
+
+        self._by_key[key] = order
+        if not order.paid:
+            self._unpaid_by_user.setdefault(user_id, {})[order.order_id] = order
+        self._by_date.setdefault(order.date, {})[key] = order
+        time_entry = (order.timestamp, user_id, order.order_id)
+        if not self._by_time or self._by_time[-1] <= time_entry:
+            self._by_time.append(time_entry)
+        else:
+            bisect.insort(self._by_time, time_entry)
+        if order.order_id > self._max_order_id.get(user_id, 0):
+            self._max_order_id[user_id] = order.order_id
+
+    def _unindex(self, user_id: str, order: Order) -> None:
+        key = (user_id, order.order_id)
+        unpaid = self._unpaid_by_user.get(user_id)
+        if unpaid is not None:
+            unpaid.pop(order.order_id, None)
+            if not unpaid:
+                del self._unpaid_by_user[user_id]
+        day = self._by_date.get(order.date)
+        if day is not None:
+            day.pop(key, None)
+            if not day:
+                del self._by_date[order.date]
+        time_entry = (order.timestamp, user_id, order.order_id)
+        index = bisect.bisect_left(self._by_time, time_entry)
+        if index < len(self._by_time) and self._by_time[index] == time_entry:
+            del self._by_time[index]
+
+    def remove(self, user_id: str, order_id: int) -> Optional[Order]:
+        ''' Убираем заказ (при архивации). Максимальный order_id пользователя не уменьшается '''
+        order = self._by_key.pop((user_id, order_id), None)
+        if order is None:
+            return None
+
+        self._unindex(user_id, order)
+        user_orders = self._by_user[user_id]
+        user_orders.remove(order)
+        if not user_orders:
+            del self._by_user[user_id]
+        return order
+
+    def set_paid(self, user_id: str, order_id: int, paid: bool) -> Optional[Order]:
+        ''' Меняем статус оплаты и поддерживаем индекс неоплаченных '''
+        order = self._by_key.get((user_id, order_id))
+        if order is None:
+            return None
+
+        order.paid = paid
+        if paid:
+            unpaid = self._unpaid_by_user.get(user_id)
+            if unpaid is not None:
+                unpaid.pop(order_id, None)
+                if not unpaid:
+                    del self._unpaid_by_user[user_id]
+        else:
+            self._unpaid_by_user.setdefault(user_id, {})[order_id] = order
+        return order.model_copy()
+
+    def next_order_id(self, user_id: str) -> int:
+        return self._max_order_id.get(user_id, 0) + 1
+
+    def get(self, user_id: str, order_id: int) -> Optional[Order]:
+        order = self._by_key.get((user_id, order_id))
+        return order.model_copy() if order is not None else None
+
+    def user_orders(self, user_id: str) -> List[Order]:
+        return [order.model_copy() for order in self._by_user.get(user_id, [])]
+
+    def unpaid_orders(self, user_id: str) -> List[Order]:
+        return [order.model_copy() for order in self._unpaid_by_user.get(user_id, {}).values()]
+
+    def iter_unpaid(self) -> Iterator[Tuple[str, Order]]:
+        ''' Все неоплаченные заказы всех пользователей '''
+        for user_id, orders in self._unpaid_by_user.items():
+            for order in orders.values():
+                yield user_id, order.model_copy()
+
+    def orders_by_date(self, day: str) -> List[Tuple[str, Order]]:
+        return [(user_id, order.model_copy()) for (user_id, _), order in self._by_date.get(day, {}).items()]
+
+    def orders_since(self, timestamp: int) -> List[Tuple[str, Order]]:
+        ''' Заказы, созданные не раньше timestamp, по возрастанию времени '''
+        start = bisect.bisect_left(self._by_time, (timestamp,))
+        return [
+            (user_id, self._by_key[(user_id, order_id)].model_copy())
+            for _, user_id, order_id in self._by_time[start:]
+        ]
+
+    def as_dict(self) -> Dict[str, List[Order]]:
+        ''' Представление в формате load_orders_base: user_id -> список заказов (только для чтения) '''
+        return self._by_user
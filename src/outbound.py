@@ -0,0 +1,313 @@
+import asyncio
+import itertools
+import logging
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Union
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, SendMessage, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from metrics import metrics
+
+
+# Приоритеты: меньше - раньше. Ответы пользователям обгоняют массовые рассылки
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+# Ограничения Telegram: около 30 сообщений в секунду на бота и около 1 в секунду в один чат
+GLOBAL_RATE = 25.0
+GLOBAL_BURST = 25
+PER_CHAT_RATE = 1.0
+PER_CHAT_BURST = 3
+WORKERS_COUNT = 4
+MAX_RETRIES = 3
+# Сколько при остановке ждём отправки того, что ещё лежит в очереди, секунды
+STOP_DRAIN_TIMEOUT = 10
+# Когда вёдер чатов становится больше, выбрасываем полные (чат давно ничего не получал)
+MAX_CHAT_BUCKETS = 10000
+# Лимиты Telegram касаются отправки новых сообщений; getUpdates, ответы на нажатия
+# и правки сообщений идут без очереди (только выдерживают паузу flood control)
+RATE_LIMITED_PREFIXES = ("send", "copy", "forward")
+# Сколько токенов общего ведра рассылки оставляют про запас для ответов пользователям
+INTERACTIVE_RESERVE = 5
+
+logger = logging.getLogger(__name__)
+
+# Приоритет текущего вызова Bot API: воркеры очереди помечают им свои отправки
+_request_priority: ContextVar[int] = ContextVar("outbound_request_priority", default=PRIORITY_INTERACTIVE)
+
+
+class OutboundStoppedError(Exception):
+    ''' Очередь остановили раньше, чем задание удалось отправить '''
+
+
+class TokenBucket:
+    ''' Ведро токенов: rate токенов в секунду, не больше capacity про запас '''
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        if now <= self.updated_at:
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, now: float) -> float:
+        ''' Сколько ждать до появления токена (0 - токен есть) '''
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+
+def is_rate_limited(method: TelegramMethod) -> bool:
+    ''' Засчитывается ли вызов в лимиты бота и чата (отправка нового сообщения) '''
+    return method.__api_method__.startswith(RATE_LIMITED_PREFIXES)
+
+
+class RateLimiter(BaseRequestMiddleware):
+    '''
+    Ограничение скорости отправки сообщений - middleware сессии бота, через него проходят
+    и ответы хэндлеров, и очередь исходящих. Общее ведро держит лимит бота, ведро чата -
+    лимит чата; считаются только методы отправки (RATE_LIMITED_PREFIXES). Рассылка не забирает последние INTERACTIVE_RESERVE
+    токенов общего ведра, чтобы ответы пользователям не ждали за ней. После
+    TelegramRetryAfter все вызовы выдерживают паузу.
+    '''
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, global_burst: float = GLOBAL_BURST,
+                 per_chat_rate: float = PER_CHAT_RATE, per_chat_burst: float = PER_CHAT_BURST,
+                 interactive_reserve: float = INTERACTIVE_RESERVE):
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.interactive_reserve = interactive_reserve
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+        self._chat_buckets: Dict[Union[int, str], TokenBucket] = {}
+        self._paused_until = 0.0
+        self._interactive_lock = asyncio.Lock()
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= MAX_CHAT_BUCKETS:
+                self._drop_idle_buckets()
+            bucket = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _drop_idle_buckets(self) -> None:
+        now = time.monotonic()
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            bucket._refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._chat_buckets[chat_id]
+
+    def pause_delay(self, now: float) -> float:
+        '''Сколько ещё длится пауза после flood control'''
+        return max(0.0, self._paused_until - now)
+
+    def chat_delay(self, chat_id: Optional[Union[int, str]], now: float) -> float:
+        '''Сколько чату ждать следующего токена (0 - можно отправлять)'''
+        if chat_id is None:
+            return 0.0
+        return self._chat_bucket(chat_id).delay(now)
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _global_delay(self, now: float, priority: int) -> float:
+        delay = self._global_bucket.delay(now)
+        if delay > 0 or priority == PRIORITY_INTERACTIVE:
+            return delay
+        # Рассылка ждёт, пока в ведре останется запас для ответов пользователям
+        missing = 1 + self.interactive_reserve - self._global_bucket.tokens
+        return missing / self._global_bucket.rate if missing > 0 else 0.0
+
+    async def _wait(self, chat_id: Optional[Union[int, str]], priority: Optional[int]) -> float:
+        '''Ждём паузу и лимит чата, а при заданном priority - ещё и общий токен'''
+        while True:
+            now = time.monotonic()
+            delay = max(self.pause_delay(now), self.chat_delay(chat_id, now))
+            if priority is not None:
+                delay = max(delay, self._global_delay(now, priority))
+            if delay <= 0:
+                return now
+            await asyncio.sleep(delay)
+
+    async def acquire(self, chat_id: Optional[Union[int, str]], priority: int = PRIORITY_INTERACTIVE) -> None:
+        '''Ждём, пока вызов в чат chat_id уложится в лимиты, и забираем токены'''
+        if priority == PRIORITY_INTERACTIVE:
+            # Лимит чата ждём порознь, а общие токены ответы пользователям получают
+            # по очереди, в порядке прихода
+            await self._wait(chat_id, None)
+            async with self._interactive_lock:
+                now = await self._wait(chat_id, priority)
+        else:
+            now = await self._wait(chat_id, priority)
+
+        self._global_bucket.take(now)
+        if chat_id is not None:
+            self._chat_bucket(chat_id).take(now)
+
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType], bot: Bot,
+                       method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        if is_rate_limited(method):
+            await self.acquire(getattr(method, "chat_id", None), _request_priority.get())
+        else:
+            await self._wait(None, None)
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            self.pause(e.retry_after)
+            raise
+
+
+@dataclass(order=True)
+class _Job:
+    priority: int
+    seq: int
+    method: TelegramMethod = field(compare=False)
+    chat_id: Union[int, str] = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    attempts: int = field(default=0, compare=False)
+
+
+class OutboundDispatcher:
+    '''
+    Очередь исходящих сообщений. Лимиты держит RateLimiter, который стоит в сессии бота
+    (build_dispatcher подключает outbound.rate_limiter), очередь добавляет к нему приоритеты,
+    ограниченный пул воркеров и повторы после TelegramRetryAfter. Задание в чат, упёршийся
+    в свой лимит, откладывается, и воркер занимается другими чатами. Используется
+    напоминаниями и хэндлерами.
+    '''
+
+    def __init__(self, bot: Bot, workers_count: int = WORKERS_COUNT,
+                 global_rate: float = GLOBAL_RATE, global_burst: float = GLOBAL_BURST,
+                 per_chat_rate: float = PER_CHAT_RATE, per_chat_burst: float = PER_CHAT_BURST,
+                 max_retries: int = MAX_RETRIES):
+        self.bot = bot
+        self.workers_count = workers_count
+        self.max_retries = max_retries
+        self.rate_limiter = RateLimiter(global_rate, global_burst, per_chat_rate, per_chat_burst)
+        self._queue: "asyncio.PriorityQueue[_Job]" = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._workers: List[asyncio.Task] = []
+        # Задания, результат которых ещё не известен (в очереди, отложенные или в отправке)
+        self._pending: Dict[int, _Job] = {}
+
+    def install(self, session: BaseSession) -> None:
+        '''Подключаем ограничение скорости ко всем вызовам Bot API этой сессии'''
+        if self.rate_limiter not in session.middleware:
+            session.middleware(self.rate_limiter)
+
+    def start(self) -> None:
+        if self._workers:
+            return
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers_count)]
+
+    async def stop(self, drain_timeout: float = STOP_DRAIN_TIMEOUT) -> None:
+        '''
+        Останавливаем воркеры. Сначала до drain_timeout секунд даём отправиться тому, что уже
+        в очереди; недоставленные задания записываются в лог и завершаются OutboundStoppedError
+        '''
+        if self._workers and self._pending:
+            await asyncio.wait([job.future for job in self._pending.values()], timeout=drain_timeout)
+
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+        for job in sorted(self._pending.values()):
+            metrics.inc("outbound_jobs_total", result="dropped")
+            logger.warning("Очередь остановлена, не отправлено %s в чат %s: %r",
+                           type(job.method).__name__, job.chat_id, getattr(job.method, "text", None))
+            self._resolve(job, error=OutboundStoppedError(f"не отправлено в чат {job.chat_id}"))
+        self._pending.clear()
+
+    def submit(self, method: TelegramMethod, priority: int = PRIORITY_INTERACTIVE) -> asyncio.Future:
+        ''' Ставим метод Bot API в очередь, результат придёт в future '''
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(priority, next(self._seq), method, method.chat_id, future)
+        self._pending[job.seq] = job
+        future.add_done_callback(lambda _: self._pending.pop(job.seq, None))
+        self._queue.put_nowait(job)
+        return future
+
+    async def send(self, method: TelegramMethod, priority: int = PRIORITY_INTERACTIVE) -> Any:
+        ''' Отправляем метод Bot API через очередь и ждём результата '''
+        return await self.submit(method, priority)
+
+    async def send_message(self, chat_id: Union[int, str], text: str,
+                           priority: int = PRIORITY_INTERACTIVE, **kwargs) -> Any:
+        return await self.send(SendMessage(chat_id=chat_id, text=text, **kwargs), priority)
+
+    def _requeue_later(self, job: _Job, delay: float) -> None:
+        asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, job)
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._process(job)
+            except Exception:
+                # Воркер не должен умирать из-за одного задания - иначе пул тает навсегда
+                logger.exception("Ошибка обработки задания очереди исходящих в чат %s", job.chat_id)
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def _resolve(job: _Job, result: Any = None, error: Optional[BaseException] = None) -> None:
+        # Отправитель мог перестать ждать (отмена, таймаут вокруг send), пока шёл вызов
+        if job.future.done():
+            return
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+    async def _process(self, job: _Job) -> None:
+        if job.future.done():  # Отправитель уже не ждёт результата
+            return
+
+        now = time.monotonic()
+        # Flood wait или исчерпанный лимит чата: задание возвращается в очередь и сохраняет своё место в ней
+        chat_id = job.chat_id if is_rate_limited(job.method) else None
+        delay = max(self.rate_limiter.pause_delay(now), self.rate_limiter.chat_delay(chat_id, now))
+        if delay > 0:
+            self._requeue_later(job, delay)
+            return
+
+        priority_token = _request_priority.set(job.priority)
+        try:
+            result = await self.bot(job.method)
+        except TelegramRetryAfter as e:
+            job.attempts += 1
+            if job.attempts > self.max_retries:
+                metrics.inc("outbound_jobs_total", result="failed")
+                self._resolve(job, error=e)
+                return
+            metrics.inc("outbound_jobs_total", result="retried")
+            logger.warning("Flood control, ждём %s с перед повтором в чат %s", e.retry_after, job.chat_id)
+            self._requeue_later(job, e.retry_after)
+        except Exception as e:
+            metrics.inc("outbound_jobs_total", result="failed")
+            self._resolve(job, error=e)
+        else:
+            metrics.inc("outbound_jobs_total", result="sent")
+            self._resolve(job, result)
+        finally:
+            _request_priority.reset(priority_token)
@@ -0,0 +1,205 @@
+import aiofiles
+import asyncio
+import heapq
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+from data_manager import DataManager, OrderListener
+from models import Order
+from order_journal import write_file_atomic
+from outbound import OutboundDispatcher, PRIORITY_BULK
+
+
+REMINDERS_STATE_FILE = "../data/reminders.json"
+# Через сколько секунд после заказа напоминаем впервые и как часто повторяем
+REMINDER_FIRST_DELAY = 24 * 60 * 60
+REMINDER_REPEAT_INTERVAL = 24 * 60 * 60
+# Повтор после временной ошибки отправки: 1, 2, 4... минуты, но не реже обычного интервала
+REMINDER_RETRY_DELAY = 60
+
+logger = logging.getLogger(__name__)
+
+OrderKey = Tuple[str, int]
+
+
+def format_reminder(orders: List[Order]) -> str:
+    ''' Одно сообщение со всеми неоплаченными заказами пользователя '''
+    total = sum(order.price for order in orders)
+    if len(orders) == 1:
+        order = orders[0]
+        return f"Пожалуйста, оплатите заказ '{order.item}' на сумму {order.price} рублей"
+
+    lines = [f" - {order.item} ({order.date}) - {order.price} руб" for order in orders]
+    return (
+        "Пожалуйста, оплатите заказы:\n"
+        + "\n".join(lines)
+        + f"\nИтого к оплате: {total} рублей"
+    )
+
+
+class PaymentReminder(OrderListener):
+    '''
+    Напоминания об оплате. Вместо ежедневного прохода по всем заказам держим кучу
+    (время следующего напоминания, user_id, order_id): она заполняется один раз при старте
+    и дальше пополняется из DataManager при новых заказах и смене статуса оплаты.
+    Фоновая задача спит до ближайшего срока, а все неоплаченные заказы пользователя
+    уходят одним сообщением через очередь исходящих сообщений с низким приоритетом. Когда и сколько раз напоминали о каждом заказе, хранится
+    в reminders.json, поэтому после перезапуска напоминания не дублируются.
+    '''
+
+    def __init__(self, outbound: OutboundDispatcher, data_manager: DataManager, state_file_path: str = REMINDERS_STATE_FILE,
+                 first_delay: float = REMINDER_FIRST_DELAY, repeat_interval: float = REMINDER_REPEAT_INTERVAL,
+                 retry_delay: float = REMINDER_RETRY_DELAY):
+        self.outbound = outbound
+        self.data_manager = data_manager
+        self.state_file_path = state_file_path
+        self.first_delay = first_delay
+        self.repeat_interval = repeat_interval
+        self.retry_delay = retry_delay
+        self._heap: List[Tuple[float, str, int]] = []
+        # Актуальный срок для каждого заказа; записи кучи с другим сроком устарели
+        self._due: Dict[OrderKey, float] = {}
+        # "user_id:order_id" -> {"last_sent": ts, "count": n}
+        self._state: Dict[str, dict] = {}
+        # Сколько раз подряд не удалось напомнить пользователю (для отсрочки повтора)
+        self._failures: Dict[str, int] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _state_key(user_id: str, order_id: int) -> str:
+        return f"{user_id}:{order_id}"
+
+    async def _load_state(self) -> None:
+        if not os.path.exists(self.state_file_path):
+            return
+        try:
+            async with aiofiles.open(self.state_file_path, mode='r', encoding='utf-8') as f:
+                content = await f.read()
+            self._state = json.loads(content) if content.strip() else {}
+        except (json.JSONDecodeError, OSError):
+            logger.exception("Не удалось прочитать %s, начинаем без истории напоминаний", self.state_file_path)
+            self._state = {}
+
+    async def _save_state(self) -> None:
+        await write_file_atomic(self.state_file_path, json.dumps(self._state, ensure_ascii=False))
+
+    def _schedule(self, user_id: str, order: Order, due_at: Optional[float] = None) -> None:
+        if due_at is None:
+            state = self._state.get(self._state_key(user_id, order.order_id))
+            if state is None:
+                due_at = order.timestamp + self.first_delay
+            else:
+                due_at = state["last_sent"] + self.repeat_interval
+
+        key = (user_id, order.order_id)
+        previous = self._due.get(key)
+        self._due[key] = due_at
+        heapq.heappush(self._heap, (due_at, user_id, order.order_id))
+        if previous is None or due_at < previous:
+            self._wakeup.set()
+
+    def _unschedule(self, user_id: str, order_id: int) -> None:
+        # Запись в куче остаётся и будет пропущена при извлечении
+        self._due.pop((user_id, order_id), None)
+        self._state.pop(self._state_key(user_id, order_id), None)
+
+    def on_orders_added(self, user_id: str, orders: List[Order]) -> None:
+        for order in orders:
+            if not order.paid:
+                self._schedule(user_id, order)
+
+    def on_order_paid_changed(self, user_id: str, order: Order) -> None:
+        if order.paid:
+            self._unschedule(user_id, order.order_id)
+        else:
+            self._schedule(user_id, order)
+
+    async def start(self) -> None:
+        ''' Загружаем историю напоминаний, заполняем кучу и запускаем фоновую задачу '''
+        await self._load_state()
+        for user_id, order in await self.data_manager.get_all_not_paid_orders():
+            self._schedule(user_id, order)
+
+        # Оплаченные и удалённые заказы больше не нужны в истории
+        active = {self._state_key(user_id, order_id) for user_id, order_id in self._due}
+        self._state = {key: value for key, value in self._state.items() if key in active}
+
+        self.data_manager.add_order_listener(self)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def _pop_due_users(self, now: float) -> Set[str]:
+        ''' Достаём из кучи все наступившие сроки и возвращаем пользователей, которым пора напомнить '''
+        users = set()
+        while self._heap and self._heap[0][0] <= now:
+            due_at, user_id, order_id = heapq.heappop(self._heap)
+            if self._due.get((user_id, order_id)) != due_at:
+                continue
+            del self._due[(user_id, order_id)]
+            users.add(user_id)
+        return users
+
+    async def _remind_user(self, user_id: str, now: float) -> None:
+        orders = await self.data_manager.get_not_paid_orders(int(user_id))
+        if not orders:
+            return
+
+        try:
+            await self.outbound.send_message(int(user_id), format_reminder(orders), priority=PRIORITY_BULK)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Бот заблокирован или чата нет: напоминание не доставлено, пробуем снова через обычный интервал
+            logger.info("Напоминание пользователю %s не доставлено: %s", user_id, e)
+            self._failures.pop(user_id, None)
+            for order in orders:
+                self._schedule(user_id, order, time.time() + self.repeat_interval)
+            return
+        except Exception:
+            failures = self._failures.get(user_id, 0) + 1
+            self._failures[user_id] = failures
+            delay = min(self.retry_delay * 2 ** (failures - 1), self.repeat_interval)
+            logger.exception("Не удалось отправить напоминание пользователю %s, повтор через %s с", user_id, delay)
+            for order in orders:
+                self._schedule(user_id, order, time.time() + delay)
+            return
+
+        # Все неоплаченные заказы пользователя считаем напомненными - следующее сообщение через интервал
+        self._failures.pop(user_id, None)
+        for order in orders:
+            key = self._state_key(user_id, order.order_id)
+            state = self._state.setdefault(key, {"last_sent": now, "count": 0})
+            state["last_sent"] = now
+            state["count"] += 1
+            self._schedule(user_id, order)
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            users = self._pop_due_users(now)
+            if users:
+                # Скорость отправки ограничивает очередь исходящих, здесь отдаём всех сразу
+                await asyncio.gather(*(self._remind_user(user_id, now) for user_id in users))
+                await self._save_state()
+                continue
+
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass